@@ -0,0 +1,241 @@
+"""
+The render pipeline benchmark. Streams synthetic frames through the WebSocket handler,
+the queue, the NeoPixel thread and the renderer into simulated strips, then reports
+throughput, decode time, lateness and dropped frames per pin. Runs without LED hardware.
+
+    python benchmark.py --pins D10,D18 --leds 1200 --fps 60 --seconds 10
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import struct
+import threading
+import time
+from queue import Empty
+
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.client import connect
+
+import flask_server as server
+import neopixel_thread as np_thread
+from buffer_policy import DEFAULT_MAX_BYTES, OVERFLOW_MODES, OVERFLOW_REJECT_NEWEST, BufferPolicy
+from frame_codec import ENCODING_RLE, FrameDecoder
+from color_correction import ColorCorrection
+from lateness_policy import LATENESS_MODES, LATENESS_STRICT, LatenessPolicy
+from neopixel_config import NeoPixelConfig
+from rgb_frame import FRAME_HEADER
+from shared_frame_ring import SharedFrameRing
+from strip_backends import ShowEvent, SimulatedStripFactory
+
+# pylint: disable=too-few-public-methods
+
+
+class StreamStats:
+    """What one synthetic stream sent and had acknowledged."""
+
+    pin: str
+    sent: int
+    acked: int
+    full: int
+    # Frame timestamp by sequence number
+    timestamps: dict[int, int]
+
+    def __init__(self, pin: str):
+        self.pin = pin
+        self.sent = 0
+        self.acked = 0
+        self.full = 0
+        self.timestamps = dict[int, int]()
+
+
+def frame_message(pin: str, timestamp: int, seq: int, leds: int) -> bytes:
+    """A raw frame whose first LED carries the sequence number, so shows can be matched."""
+    head = (seq + 1).to_bytes(3, "little")
+    # Every LED changes every frame, so no write is skipped
+    body = bytes([seq % 256]) * ((leds - 1) * 3)
+    return FRAME_HEADER.pack(0, pin.encode("ascii").ljust(4), timestamp) + head + body
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """The value below which percent of the sorted values fall."""
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[index]
+
+
+def bench_decode(leds: int, iterations: int) -> dict[str, float]:
+    """Microseconds to decode one frame message, by encoding."""
+    decoder = FrameDecoder()
+    raw = frame_message("D18", 1, 1, leds)
+    runs = struct.pack("<H3s", leds // 2, b"\xff\x00\x00") * 2
+    rle = FRAME_HEADER.pack(ENCODING_RLE << 1, b"D18 ", 1) + runs
+    results = dict[str, float]()
+    for name, message in (("raw", raw), ("rle", rle)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decoder.decode(message)
+        results[name] = (time.perf_counter() - start) / iterations * 1_000_000
+    return results
+
+
+def stream(args: argparse.Namespace, stats: StreamStats, start_ms: int):
+    """Sends frames for one pin in real time, lead_ms ahead of their timestamps."""
+    period = 1000 / args.fps
+    total = int(args.seconds * args.fps)
+    with connect(f"ws://127.0.0.1:{args.port}", max_size=None) as websocket:
+        websocket.send(json.dumps({"ackWindow": args.window}))
+        websocket.recv()
+        reader = threading.Thread(target=read_acks, args=(websocket, stats), daemon=True)
+        reader.start()
+        for seq in range(total):
+            timestamp = int(start_ms + args.lead_ms + seq * period)
+            delay = (timestamp - args.lead_ms) / 1000 - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            stats.timestamps[seq] = timestamp
+            websocket.send(frame_message(stats.pin, timestamp, seq, args.leds))
+            stats.sent += 1
+        # Wait for the last acks
+        deadline = time.time() + 2
+        while stats.acked + stats.full < stats.sent and time.time() < deadline:
+            time.sleep(0.01)
+
+
+def read_acks(websocket, stats: StreamStats):
+    """Counts windowed acks until the connection closes."""
+    try:
+        for message in websocket:
+            reply = json.loads(message)
+            stats.acked += reply.get("frames", 0)
+            stats.full += 1 if "full" in reply else 0
+    except ConnectionClosed:
+        pass
+
+
+def run_streams(args: argparse.Namespace,
+                all_stats: list[StreamStats],
+                show_events: mp.Queue) -> list[ShowEvent]:
+    """Streams to every pin at once and collects the show events until the last frame is due."""
+    start_ms = int(time.time() * 1000)
+    streams = [threading.Thread(target=stream, args=(args, stats, start_ms)) for stats in all_stats]
+    for thread in streams:
+        thread.start()
+    events = list[ShowEvent]()
+    while any(thread.is_alive() for thread in streams):
+        try:
+            events.append(show_events.get(timeout=0.1))
+        except Empty:
+            pass
+    # Let the last buffered frames render
+    deadline = time.time() + args.lead_ms / 1000 + 0.5
+    while time.time() < deadline:
+        try:
+            events.append(show_events.get(timeout=0.05))
+        except Empty:
+            pass
+    return events
+
+
+def report(args: argparse.Namespace, all_stats: list[StreamStats], events: list[ShowEvent]):
+    """Prints frames/s, lateness percentiles and drops per pin."""
+    print(f"{'pin':<5}{'sent':>7}{'acked':>7}{'full':>6}{'shown':>7}{'dropped':>8}{'fps':>7}"
+          f"{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'max ms':>8}{'show ms':>9}")
+    for stats in all_stats:
+        lateness = dict[int, float]()
+        durations = list[float]()
+        for event in events:
+            seq = int.from_bytes(event.head, "little") - 1
+            if event.pin == stats.pin and seq in stats.timestamps and seq not in lateness:
+                lateness[seq] = event.shown_at - stats.timestamps[seq]
+                durations.append(event.duration)
+        late = sorted(lateness.values())
+        shown = len(late)
+        show_ms = sum(durations) / len(durations) if durations else float("nan")
+        print(f"{stats.pin:<5}{stats.sent:>7}{stats.acked:>7}{stats.full:>6}{shown:>7}"
+              f"{stats.sent - shown:>8}{shown / args.seconds:>7.1f}"
+              f"{percentile(late, 50):>8.2f}{percentile(late, 95):>8.2f}"
+              f"{percentile(late, 99):>8.2f}{percentile(late, 100):>8.2f}{show_ms:>9.2f}")
+
+
+def main():
+    """Runs the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pins", default="D18", help="comma separated pins to stream to")
+    parser.add_argument("--leds", type=int, default=300, help="LEDs per strip")
+    parser.add_argument("--fps", type=float, default=60, help="frames per second per pin")
+    parser.add_argument("--seconds", type=float, default=5, help="length of each stream")
+    parser.add_argument("--lead-ms", type=int, default=100,
+                        help="how far ahead of its timestamp each frame is sent")
+    parser.add_argument("--window", type=int, default=16, help="ack window per stream")
+    parser.add_argument("--write-cost-us", type=float, default=1.0,
+                        help="simulated CPU cost of writing one LED")
+    parser.add_argument("--show-us-per-led", type=float, default=30.0,
+                        help="simulated show() time per LED, 30us for WS2812")
+    parser.add_argument("--transport", choices=("shared_memory", "queue"),
+                        default="shared_memory")
+    parser.add_argument("--workers", action="store_true",
+                        help="render each pin on its own worker thread")
+    parser.add_argument("--lateness", choices=LATENESS_MODES, default=LATENESS_STRICT,
+                        help="lateness policy of every pin")
+    parser.add_argument("--max-lateness-ms", type=int, default=250,
+                        help="how late a frame may be shown by the catchUp and inOrder policies")
+    parser.add_argument("--overflow", choices=OVERFLOW_MODES, default=OVERFLOW_REJECT_NEWEST,
+                        help="what every pin does with frames which don't fit its buffer")
+    parser.add_argument("--buffer-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="memory budget of each pin's frame buffer")
+    parser.add_argument("--port", type=int, default=18765)
+    args = parser.parse_args()
+    pins = args.pins.split(",")
+
+    decode_us = bench_decode(args.leds, 2000)
+    print("decode us/frame: " + ", ".join(f"{k} {v:.1f}" for k, v in decode_us.items()))
+
+    # The child processes are forked, so they see these settings
+    server.configure_logging()
+    server.WS_PORT = args.port
+    np_thread.RENDER_WORKER_PER_PIN = args.workers
+    if args.transport == "shared_memory":
+        for pin in pins:
+            server.channels.frame_rings[pin] = SharedFrameRing.create(
+                pin, args.leds, server.SHARED_MEMORY_SLOTS
+            )
+    show_events = mp.Queue()
+    strip_factory = SimulatedStripFactory(args.write_cost_us, args.show_us_per_led,
+                                          show_events=show_events)
+    processes = [
+        mp.Process(name="ws_handler", target=server.ws_handler, daemon=True),
+        mp.Process(
+            name="neopixel_thread",
+            target=np_thread.neopixel_thread,
+            args=(server.channels, server.logger, strip_factory),
+            daemon=True,
+        ),
+    ]
+    for process in processes:
+        process.start()
+    policy = LatenessPolicy(args.lateness, max_lateness_ms=args.max_lateness_ms)
+    # The first LED tags each frame, so it must reach the simulated strip unchanged
+    colors = ColorCorrection(color_order="RGB")
+    buffering = BufferPolicy(args.overflow, args.buffer_bytes)
+    server.channels.queue.put_nowait(
+        [NeoPixelConfig("bench-" + pin, pin, args.leds, 100, lateness_policy=policy,
+                        color_correction=colors, buffer_policy=buffering) for pin in pins]
+    )
+    # Give the server time to start listening
+    time.sleep(1)
+
+    all_stats = [StreamStats(pin) for pin in pins]
+    events = run_streams(args, all_stats, show_events)
+
+    for process in processes:
+        process.terminate()
+    for ring in server.channels.frame_rings.values():
+        ring.close(unlink=True)
+    report(args, all_stats, events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+The buffer policy of a pin. Bounds the memory its buffered frames may take, and decides
+what happens to a frame which arrives when the buffer is full.
+"""
+
+from typing import Optional
+
+from validation_result import ValidationResult, json_object
+
+# Rejects the arriving frame, acknowledged as full
+OVERFLOW_REJECT_NEWEST = "rejectNewest"
+# Accepts the arriving frame and drops the buffered frame with the earliest timestamp
+OVERFLOW_EVICT_OLDEST = "evictOldest"
+# Rejects the arriving frame, acknowledged with when to retry, and stops reading the
+# sender's WebSocket until then
+OVERFLOW_BACKPRESSURE = "backpressure"
+OVERFLOW_MODES = (OVERFLOW_REJECT_NEWEST, OVERFLOW_EVICT_OLDEST, OVERFLOW_BACKPRESSURE)
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+# No pin may buffer more than this, so a config can't exhaust the memory of a small Pi
+MAX_BUFFER_BYTES = 64 * 1024 * 1024
+# Memory per buffered frame besides its pixels, for its entry in the scheduler's heap
+FRAME_OVERHEAD_BYTES = 128
+
+
+class BufferPolicy:
+    """How much memory a pin's buffered frames may take, and what happens when it is full."""
+
+    # One of OVERFLOW_MODES
+    overflow: str
+    # Bytes the pin's buffered frames may take, pixels and overhead
+    max_bytes: int
+
+    def __init__(self, overflow: str = OVERFLOW_REJECT_NEWEST, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.overflow = overflow
+        self.max_bytes = max_bytes
+
+    def capacity(self, leds: int) -> int:
+        """The number of frames of this many LEDs which fit in max_bytes."""
+        return self.max_bytes // (leds * 3 + FRAME_OVERHEAD_BYTES)
+
+    def check_validity(self, leds: int) -> ValidationResult:
+        """Validates this policy for a strip of this many LEDs."""
+        if self.overflow not in OVERFLOW_MODES:
+            return ValidationResult(
+                False, "Buffer policy overflow must be one of " + ", ".join(OVERFLOW_MODES)
+            )
+        if not isinstance(self.max_bytes, int) or not 0 < self.max_bytes <= MAX_BUFFER_BYTES:
+            return ValidationResult(
+                False, "Buffer policy maxBytes must be between 1 and " + str(MAX_BUFFER_BYTES)
+            )
+        if self.capacity(leds) < 1:
+            return ValidationResult(
+                False, "Buffer policy maxBytes must fit one frame of " + str(leds) + " LEDs"
+            )
+        return ValidationResult(True, "")
+
+    def to_dict(self) -> dict:
+        """The JSON serializable form of this policy."""
+        return {"overflow": self.overflow, "maxBytes": self.max_bytes}
+
+
+def from_json(json_dict: Optional[dict]) -> BufferPolicy:
+    """Deserializes a policy from json, defaulting anything missing."""
+    json_dict = json_object(json_dict, "Buffer policy")
+    return BufferPolicy(
+        json_dict.get("overflow", OVERFLOW_REJECT_NEWEST),
+        json_dict.get("maxBytes", DEFAULT_MAX_BYTES),
+    )
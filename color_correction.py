@@ -0,0 +1,69 @@
+"""
+The color correction of a pin. Gamma, white balance and the order the LEDs expect the
+color channels in, applied to every frame before it is sent to the strip.
+"""
+
+from typing import Optional
+
+from validation_result import ValidationResult, json_object
+
+CHANNELS = "RGB"
+
+DEFAULT_GAMMA = 1.0
+DEFAULT_GAIN = (1.0, 1.0, 1.0)
+# WS2812 LEDs take green first
+DEFAULT_COLOR_ORDER = "GRB"
+
+
+class ColorCorrection:
+    """Corrections applied to a pin's frames, which the server no longer has to pre-correct."""
+
+    # Output = input ^ gamma, 1.0 leaves the colors unchanged
+    gamma: float
+    # Red, green and blue multipliers from 0.0 to 1.0, for white balance
+    gain: tuple[float, float, float]
+    # The channel order the LEDs expect, a permutation of "RGB"
+    color_order: str
+
+    def __init__(self,
+                 gamma: float = DEFAULT_GAMMA,
+                 gain: tuple[float, float, float] = DEFAULT_GAIN,
+                 color_order: str = DEFAULT_COLOR_ORDER):
+        self.gamma = gamma
+        self.gain = gain
+        self.color_order = color_order
+
+    def check_validity(self) -> ValidationResult:
+        """Validates this color correction."""
+        if not isinstance(self.gamma, (int, float)) or not 0 < self.gamma <= 5:
+            return ValidationResult(False, "Color correction gamma must be above 0 and at most 5")
+        if len(self.gain) != 3 or any(
+                not isinstance(g, (int, float)) or not 0 <= g <= 1 for g in self.gain):
+            return ValidationResult(
+                False, "Color correction gain must be 3 values between 0.0 and 1.0"
+            )
+        if sorted(self.color_order) != sorted(CHANNELS):
+            return ValidationResult(
+                False, "Color correction colorOrder must be a permutation of RGB"
+            )
+        return ValidationResult(True, "")
+
+    def to_dict(self) -> dict:
+        """The JSON serializable form of this color correction."""
+        return {
+            "gamma": self.gamma,
+            "gain": list(self.gain),
+            "colorOrder": self.color_order,
+        }
+
+
+def from_json(json_dict: Optional[dict]) -> ColorCorrection:
+    """Deserializes a color correction from json, defaulting anything missing."""
+    json_dict = json_object(json_dict, "Color correction")
+    gain = json_dict.get("gain", DEFAULT_GAIN)
+    return ColorCorrection(
+        json_dict.get("gamma", DEFAULT_GAMMA),
+        # Anything but a list is left for check_validity to reject
+        tuple(gain) if isinstance(gain, (list, tuple)) else (gain,),
+        str(json_dict.get("colorOrder", DEFAULT_COLOR_ORDER)).upper(),
+    )
@@ -0,0 +1,283 @@
+"""
+The effect engine. Procedural animations the renderer generates itself from a small
+descriptor, so simple patterns don't have to be streamed a frame at a time.
+
+Every effect precomputes its pixel data when it starts, so each frame is a slice, a bytes
+repetition or a lookup table translation rather than per LED Python arithmetic.
+Effects are a pure function of the time since their start timestamp, so Pis given the
+same descriptor render the same frames in step.
+"""
+
+import math
+import random
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from rgb_frame import MAX_LAYER, MAX_LEDS
+from validation_result import ValidationResult
+
+# pylint: disable=too-few-public-methods
+
+EFFECT_RAINBOW = "rainbow"
+EFFECT_CHASE = "chase"
+EFFECT_BREATHING = "breathing"
+EFFECT_FIRE = "fire"
+# Stops the effect on the pin's layer, leaving its last frame shown
+EFFECT_NONE = "none"
+EFFECT_TYPES = (EFFECT_RAINBOW, EFFECT_CHASE, EFFECT_BREATHING, EFFECT_FIRE, EFFECT_NONE)
+
+# Effects render no faster than this, nor faster than the strip can be shown
+MAX_EFFECT_FPS = 100
+# Time to clock out one WS2812 LED, and the latch time after the last
+WS2812_US_PER_LED = 30
+WS2812_RESET_US = 50
+
+# Upper bounds of the effect parameters, so no parameter can make an effect huge or its
+# arithmetic overflow
+MAX_SPEED = 10_000
+MAX_CYCLES = 1000
+MAX_PERIOD_S = 3600
+MIN_PERIOD_S = 0.1
+
+# Precomputed fire frames, played in a loop
+FIRE_FRAMES = 240
+FIRE_FPS = 60
+# LEDs of fire simulated when it starts, on the render thread. Longer strips repeat the
+# flames, each repeat that many frames further into the loop so they don't burn in step
+FIRE_SECTION_LEDS = 120
+FIRE_SECTION_FRAME_STEP = 97
+
+
+class EffectDescriptor:
+    """Which effect a pin runs on which of its layers, from when, and with which parameters."""
+
+    effect_type: str
+    pin: str
+    # Milliseconds since the epoch when the effect starts, 0 to start immediately
+    start: int
+    params: dict
+    # The layer the effect draws, 0 for the base layer
+    layer: int
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 effect_type: str,
+                 pin: str,
+                 start: int = 0,
+                 params: Optional[dict] = None,
+                 layer: int = 0):
+        self.effect_type = effect_type
+        self.pin = pin
+        self.start = start
+        self.params = params if params is not None else {}
+        self.layer = layer
+
+    def check_validity(self) -> ValidationResult:
+        """Validates this descriptor, including the parameters of its effect."""
+        if self.effect_type not in EFFECT_TYPES:
+            return ValidationResult(False, "Effect type must be one of " + ", ".join(EFFECT_TYPES))
+        if not isinstance(self.start, int) or self.start < 0:
+            return ValidationResult(False, "Effect start must be a non-negative timestamp")
+        if not isinstance(self.params, dict):
+            return ValidationResult(False, "Effect params must be an object")
+        if not isinstance(self.layer, int) or not 0 <= self.layer <= MAX_LAYER:
+            return ValidationResult(False, "Effect layer must be between 0 and " + str(MAX_LAYER))
+        if self.effect_type != EFFECT_NONE:
+            # A one LED effect is cheap to create and checks every parameter
+            try:
+                create_effect(self, 1)
+            except (ValueError, TypeError, OverflowError) as e:
+                return ValidationResult(False, "Effect param " + str(e))
+        return ValidationResult(True, "")
+
+
+def from_json(json_dict: dict) -> EffectDescriptor:
+    """Deserializes an effect descriptor from json."""
+    return EffectDescriptor(
+        str(json_dict.get("type", "")),
+        str(json_dict.get("pin", "")).strip(),
+        json_dict.get("start", 0),
+        json_dict.get("params", {}),
+        json_dict.get("layer", 0),
+    )
+
+
+def frame_period(leds: int) -> float:
+    """Seconds between effect frames on a strip of this many LEDs."""
+    show_seconds = (leds * WS2812_US_PER_LED + WS2812_RESET_US) / 1_000_000
+    return max(show_seconds, 1 / MAX_EFFECT_FPS)
+
+
+class Effect(ABC):
+    """A running effect. Subclasses precompute in __init__ and implement pixels()."""
+
+    def __init__(self, leds: int, params: dict):
+        self.leds = leds
+        self.params = params
+
+    @abstractmethod
+    def pixels(self, elapsed: float) -> bytes:
+        """The packed RGB pixels elapsed seconds after the effect started."""
+
+    def _color(self, name: str, default: tuple[int, int, int]) -> bytes:
+        color = self.params.get(name, default)
+        if (not isinstance(color, (list, tuple)) or len(color) != 3
+                or any(isinstance(c, bool) or not isinstance(c, int) or not 0 <= c <= 255
+                       for c in color)):
+            raise ValueError(name + " must be [r, g, b] with integers from 0 to 255")
+        return bytes(color)
+
+    def _number(self, name: str, default: float, maximum: float, minimum: float = 0) -> float:
+        value = self.params.get(name, default)
+        # NaN and Infinity, which the json module accepts, are rejected too
+        if (isinstance(value, bool) or not isinstance(value, (int, float))
+                or not math.isfinite(value) or not minimum <= value <= maximum):
+            raise ValueError(f"{name} must be a number from {minimum} to {maximum}")
+        return value
+
+
+def color_wheel(position: int) -> bytes:
+    """The fully saturated hue at position 0-255, red through green and blue back to red."""
+    position %= 256
+    if position < 85:
+        return bytes((255 - position * 3, position * 3, 0))
+    if position < 170:
+        position -= 85
+        return bytes((0, 255 - position * 3, position * 3))
+    position -= 170
+    return bytes((position * 3, 0, 255 - position * 3))
+
+
+class RainbowEffect(Effect):
+    """Hues spread along the strip, scrolling by speed LEDs per second."""
+
+    def __init__(self, leds: int, params: dict):
+        super().__init__(leds, params)
+        self.speed = self._number("speed", 30, MAX_SPEED)
+        cycles = self._number("cycles", 1, MAX_CYCLES)
+        strip = b"".join(color_wheel(int(i * 256 * cycles / leds)) for i in range(leds))
+        # Doubled so every rotation is one contiguous slice
+        self._strip = strip + strip
+
+    def pixels(self, elapsed: float) -> bytes:
+        offset = int(elapsed * self.speed) % self.leds
+        return self._strip[offset * 3:(offset + self.leds) * 3]
+
+
+class ChaseEffect(Effect):
+    """Runs of length LEDs separated by gap LEDs of background, moving speed LEDs per second."""
+
+    def __init__(self, leds: int, params: dict):
+        super().__init__(leds, params)
+        self.speed = self._number("speed", 30, MAX_SPEED)
+        length = max(1, int(self._number("length", 5, MAX_LEDS)))
+        gap = int(self._number("gap", 15, MAX_LEDS))
+        self._pattern_leds = length + gap
+        pattern = self._color("color", (255, 255, 255)) * length
+        pattern += self._color("background", (0, 0, 0)) * gap
+        # Long enough for the strip starting anywhere in the first pattern
+        repeats = leds // self._pattern_leds + 2
+        self._strip = pattern * repeats
+
+    def pixels(self, elapsed: float) -> bytes:
+        # Moving forward along the strip means starting further back in the pattern
+        offset = -int(elapsed * self.speed) % self._pattern_leds
+        return self._strip[offset * 3:(offset + self.leds) * 3]
+
+
+class BreathingEffect(Effect):
+    """The whole strip fading between off and color every period seconds."""
+
+    def __init__(self, leds: int, params: dict):
+        super().__init__(leds, params)
+        self.color = self._color("color", (255, 255, 255))
+        self.period = self._number("period", 4, MAX_PERIOD_S, MIN_PERIOD_S)
+
+    def pixels(self, elapsed: float) -> bytes:
+        level = (1 - math.cos(2 * math.pi * elapsed / self.period)) / 2
+        return bytes(int(c * level) for c in self.color) * self.leds
+
+
+def fire_palette() -> tuple[bytes, bytes, bytes]:
+    """Red, green and blue lookup tables mapping heat 0-255 to black, red, yellow, white."""
+    red = bytes(min(255, heat * 3) for heat in range(256))
+    green = bytes(max(0, min(255, heat * 3 - 255)) for heat in range(256))
+    blue = bytes(max(0, min(255, heat * 3 - 510)) for heat in range(256))
+    return red, green, blue
+
+
+class FireEffect(Effect):
+    """
+    Flames rising from the start of the strip, and from every FIRE_SECTION_LEDS after it on
+    longer strips. A loop of heat frames is simulated once at start, seeded so every Pi
+    simulates the same flames, then colored by lookup table.
+    """
+
+    def __init__(self, leds: int, params: dict):
+        super().__init__(leds, params)
+        sections = -(-leds // FIRE_SECTION_LEDS)
+        self._section_frames = [section * FIRE_SECTION_FRAME_STEP for section in range(sections)]
+        # Only one section is simulated, so starting fire costs the same on any strip
+        leds = min(leds, FIRE_SECTION_LEDS)
+        cooling = int(self._number("cooling", 55, 255))
+        sparking = int(self._number("sparking", 120, 255))
+        rng = random.Random(int(self._number("seed", 0, 2 ** 32 - 1)))
+        self._palette = fire_palette()
+        self._frames = list[bytes]()
+        heat = [0] * leds
+        max_cooling = cooling * 10 // leds + 2
+        # Maps random bytes to cooling amounts from 0 to max_cooling
+        cooling_table = bytes(value % (max_cooling + 1) for value in range(256))
+        # Run the simulation in before recording, so the loop starts with the fire lit
+        for frame in range(FIRE_FRAMES + FIRE_FPS):
+            cool = rng.randbytes(leds).translate(cooling_table)
+            heat = [h - c if h > c else 0 for h, c in zip(heat, cool)]
+            # Heat drifts up the strip, each LED from the two below it
+            heat = heat[:2] + [(a + b * 2) // 3 for a, b in zip(heat[1:-1], heat[:-2])]
+            if rng.randint(0, 255) < sparking:
+                spark = rng.randint(0, min(6, leds - 1))
+                heat[spark] = min(255, heat[spark] + rng.randint(160, 255))
+            if frame >= FIRE_FPS:
+                self._frames.append(bytes(heat))
+
+    def pixels(self, elapsed: float) -> bytes:
+        frame = int(elapsed * FIRE_FPS)
+        heat = b"".join(
+            self._frames[(frame + offset) % FIRE_FRAMES] for offset in self._section_frames
+        )[:self.leds]
+        out = bytearray(self.leds * 3)
+        for channel, table in enumerate(self._palette):
+            out[channel::3] = heat.translate(table)
+        return bytes(out)
+
+
+class RunningEffect:
+    """An effect running on a pin, and when its next frame is due."""
+
+    descriptor: EffectDescriptor
+    effect: Effect
+    # Milliseconds since the epoch
+    start: int
+    next_frame_at: float
+
+    def __init__(self, descriptor: EffectDescriptor, effect: Effect, start: int):
+        self.descriptor = descriptor
+        self.effect = effect
+        self.start = start
+        self.next_frame_at = start
+
+
+EFFECTS = {
+    EFFECT_RAINBOW: RainbowEffect,
+    EFFECT_CHASE: ChaseEffect,
+    EFFECT_BREATHING: BreathingEffect,
+    EFFECT_FIRE: FireEffect,
+}
+
+
+def create_effect(descriptor: EffectDescriptor, leds: int) -> Effect:
+    """Creates the effect a descriptor names. Raises ValueError for invalid parameters."""
+    effect_class = EFFECTS.get(descriptor.effect_type)
+    if effect_class is None:
+        raise ValueError("No effect " + descriptor.effect_type)
+    return effect_class(leds, descriptor.params)
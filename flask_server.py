@@ -1,78 +1,361 @@
 """
-The main class and webserver. Handles color data WebSocket streams, and config REST APIs.
+The main class and webserver. Handles color data WebSocket streams and UDP datagrams, and
+config REST APIs.
+
+Only what every process needs is imported at the top. asyncio and the WebSocket library are
+imported in the ws_handler process, and Flask in the main process once the others have
+started, so the NeoPixel process restores the saved configs without waiting for either.
 """
 
+import json
 import logging
 import multiprocessing as mp
+import os
 import socket
 import struct
+import threading
 import time
-from datetime import datetime
 from logging.handlers import RotatingFileHandler
+from queue import Empty
+from typing import Optional
 
-from flask import Flask, Response, jsonify, request
-from websockets.exceptions import ConnectionClosed
-from websockets.sync.server import serve
-
-import neopixel_config as np_config
+import effects
+import layer_stack
 import neopixel_thread as np_thread
+from frame_ack import AckWindow, FrameAck
+from frame_codec import FrameDecoder, is_batch, layer_keys
+from frame_recording import PlaybackRequest, RecordingControl, recording_path
+from neopixel_config import PINS
 from neopixel_config_repository import NeoPixelConfigRepository
-from rgb_frame import RgbFrame, RgbFrameOptions
+from render_channels import RenderChannels
+from rgb_frame import FrameBatch, RgbFrame, layer_key
+from shared_frame_ring import SharedFrameRing
+from stream_registry import StreamRegistry
+from time_sync import TIME_SYNC_PORT, serve_time_sync
+from udp_ingest import UDP_INGEST_PORT, Sender, serve_udp_ingest
+from virtual_strip import VirtualStrips
 
 API_PORT = 8000
 WS_PORT = 8765
-# maxBytes of a log file is 5MB
-# backupCount number of log files will be created until deleting old log files
-handler = RotatingFileHandler("cc_client.log", maxBytes=5 * 1024 * 1024, backupCount=1)
-formatter = logging.Formatter(
-    "%(asctime)s - %(levelname)s - %(message)s"  # , datefmt="%Y-%m-%d %H:%M:%S.%f"
-)
+# Serve all WebSocket connections from one asyncio event loop instead of a thread each
+ASYNCIO_WS_SERVER = True
+# Send frame pixel data through shared memory instead of pickling it onto the queue
+SHARED_MEMORY_TRANSPORT = True
+# Number of frames each pin's shared memory ring can hold before falling back to the queue.
+# Rings are created in main() for the configs saved at startup, and every process has to
+# know them before it starts. Until a restart, a pin added later, or one whose LED count
+# grew, sends its frames over the queue. A warning is logged, and the NeoPixel process
+# counts those frames in queued_frames_total
+SHARED_MEMORY_SLOTS = 16
+# Also receive frames as unacknowledged UDP datagrams, for controllers on lossy networks.
+# Off by default, as anyone on the network can then draw on the strips without a connection
+UDP_INGEST = False
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 cfg_repository = NeoPixelConfigRepository("config.db", logger)
 
-app = Flask(__name__.split(".", maxsplit=1)[0])
-queue = mp.Queue()
+# The queues and frame rings to the NeoPixel process. The frame rings are created in main()
+# before the child processes start, so every process shares them
+channels = RenderChannels()
+# The open WebSocket streams, only used in the ws_handler process
+streams = StreamRegistry()
+# The stream of each UDP sender, which owns its pins until it goes silent, only used in the
+# ws_handler process
+udp_streams = dict[Sender, int]()
+# Decodes compressed frames against the last frame of each pin, only used in the ws_handler process
+frame_decoder = FrameDecoder()
+# Serializes decoding and queueing frames between the threads of the ws_handler process
+frame_lock = threading.Lock()
+# Records the decoded frames while a client has recording switched on, only used in the
+# ws_handler process
+recording = RecordingControl()
+# The pins warned about having no shared memory ring for their frames, only used in the
+# ws_handler process
+ringless_pins = set[str]()
+
+
+def configure_logging():
+    """Logs to a rotating log file. Done in main() rather than on import."""
+    # maxBytes of a log file is 5MB
+    # backupCount number of log files will be created until deleting old log files
+    handler = RotatingFileHandler("cc_client.log", maxBytes=5 * 1024 * 1024, backupCount=1)
+    formatter = logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s"  # , datefmt="%Y-%m-%d %H:%M:%S.%f"
+    )
+    logger.setLevel(logging.DEBUG)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 def websocket_handler(websocket):
     """WebSocket handler function"""
+    # pylint: disable-next=import-outside-toplevel
+    from websockets.exceptions import ConnectionClosed
+    ack_window = AckWindow()
+
+    def deliver(acks: list[FrameAck]):
+        try:
+            for ack_message in ack_window.messages(acks):
+                websocket.send(ack_message)
+        except ConnectionClosed:
+            pass
+
+    stream_id = streams.open(deliver)
     try:
         for message in websocket:
             if isinstance(message, bytes):
-                options_byte = message[0]
-                clear_buffer = (options_byte & 0x01) == 1
-                options = RgbFrameOptions(clear_buffer)
-
-                # The GPIO pin the LED strip is connected to
-                pin_bytes = message[1:5]
-                pin = pin_bytes.decode("ascii").strip()
-
-                # The time when to display the RGB data on the strip
-                timestamp_bytes = message[5:13]
-                timestamp_int = int.from_bytes(timestamp_bytes, "little")
-                i = 13
-                color_data = list[tuple[int, int, int]]()
-                while i < len(message):
-                    cd = (message[i], message[i + 1], message[i + 2])
-                    color_data.append(cd)
-                    i += 3
-                frame = RgbFrame(pin, timestamp_int, options, color_data)
-                queue.put_nowait(frame)
-                while not queue.empty():
-                    time.sleep(1 / 100)
-                websocket.send("ACK")
+                reply = __handle_frame_message(stream_id, message)
             else:
-                logger.warning("Unknown message type %s must be bytes", str(type(message)))
+                reply = __handle_control_message(stream_id, ack_window, message)
+            if reply is not None:
+                websocket.send(reply)
+            pause = streams.paused_for(stream_id)
+            if pause > 0:
+                time.sleep(pause)
     except ConnectionClosed as cc:
         logger.info("WebSocket connection closed. Code: %s Reason: %s", str(cc.code), cc.reason)
+    finally:
+        streams.close(stream_id)
+
+
+async def async_websocket_handler(websocket):
+    """WebSocket handler coroutine. All connections share one event loop."""
+    # pylint: disable-next=import-outside-toplevel
+    import asyncio
+    # pylint: disable-next=import-outside-toplevel
+    from websockets.exceptions import ConnectionClosed
+    loop = asyncio.get_running_loop()
+    ack_window = AckWindow()
+    # Acks and replies go through one outbox so they reach the client in order
+    outbox = asyncio.Queue()
+
+    def deliver(acks: list[FrameAck]):
+        loop.call_soon_threadsafe(outbox.put_nowait, ack_window.messages(acks))
+
+    async def send_outbox():
+        try:
+            while True:
+                for outgoing in await outbox.get():
+                    await websocket.send(outgoing)
+        except ConnectionClosed:
+            pass
+
+    stream_id = streams.open(deliver)
+    sender = asyncio.create_task(send_outbox())
+    try:
+        async for message in websocket:
+            if isinstance(message, bytes):
+                reply = __handle_frame_message(stream_id, message)
+            else:
+                reply = __handle_control_message(stream_id, ack_window, message)
+            if reply is not None:
+                outbox.put_nowait([reply])
+            pause = streams.paused_for(stream_id)
+            if pause > 0:
+                await asyncio.sleep(pause)
+    except ConnectionClosed as cc:
+        logger.info("WebSocket connection closed. Code: %s Reason: %s", str(cc.code), cc.reason)
+    finally:
+        streams.close(stream_id)
+        sender.cancel()
+
+
+def __handle_frame_message(stream_id: int,
+                           message: bytes,
+                           acknowledged: bool = True) -> Optional[str]:
+    """
+    Hands a frame or batch to the NeoPixel process. Returns an error reply if it was refused.
+    Unacknowledged frames are shown or dropped without the stream hearing which.
+    """
+    received_at = time.monotonic()
+    # The UDP ingest thread and the WebSocket handlers all hand frames over here, and the
+    # decoder isn't thread safe. Held until the frames are queued, so they queue in order
+    with frame_lock:
+        return __decode_and_queue(stream_id, message, acknowledged, received_at)
+
+
+def __decode_and_queue(stream_id: int,
+                       message: bytes,
+                       acknowledged: bool,
+                       received_at: float) -> Optional[str]:
+    try:
+        # Each layer of a pin is claimed separately, so overlays can come from other
+        # connections. Claimed from the headers, so a refused frame isn't decoded against
+        # the last pixels of a layer another connection streams
+        for key in layer_keys(message):
+            if not streams.claim_pin(stream_id, key):
+                return json.dumps({"error": "Pin " + key + " is streamed by another connection"})
+        if is_batch(message):
+            frames = frame_decoder.decode_batch(message)
+        else:
+            frames = [frame_decoder.decode(message)]
+    except ValueError as e:
+        logger.warning("Invalid frame message %s", str(e))
+        return json.dumps({"error": "Invalid frame " + str(e)})
+    recording.record(frames, channels.clock.now_millis())
+    # Frames are acknowledged once the NeoPixel process has buffered them
+    queued_at = time.monotonic()
+    for frame in frames:
+        frame.stream_id = stream_id if acknowledged else 0
+        frame.received_at = received_at
+        frame.queued_at = queued_at
+    if not frames:
+        return None
+    if len(frames) > 1:
+        # A batch crosses to the NeoPixel process in one queue hop
+        channels.queue.put_nowait(FrameBatch(frames))
+        return None
+    frame = frames[0]
+    ring = channels.frame_rings.get(frame.pin)
+    frame_ref = ring.write(frame) if ring is not None else None
+    # Frames which don't fit in the ring still go over the queue
+    if frame_ref is None:
+        __warn_if_ringless(frame, ring)
+    channels.queue.put_nowait(frame_ref if frame_ref is not None else frame)
+    return None
+
+
+def __warn_if_ringless(frame: RgbFrame, ring: Optional[SharedFrameRing]):
+    """
+    Warns once per pin whose frames can't use shared memory until a restart, as it has no
+    ring or one too small. A full ring only sends frames over the queue until it drains.
+    """
+    if not SHARED_MEMORY_TRANSPORT or frame.pin not in PINS or frame.pin in ringless_pins:
+        return
+    if ring is None:
+        ringless_pins.add(frame.pin)
+        logger.warning("Pin %s has no shared memory ring, its frames go over the queue until "
+                       "restart", frame.pin)
+    elif frame.led_count > ring.leds:
+        ringless_pins.add(frame.pin)
+        logger.warning("Pin %s frames of %s LEDs don't fit its shared memory ring of %s, they "
+                       "go over the queue until restart", frame.pin, frame.led_count, ring.leds)
+
+
+def __handle_control_message(stream_id: int, ack_window: AckWindow, message: str) -> Optional[str]:
+    try:
+        json_dict = json.loads(message)
+    except ValueError:
+        json_dict = None
+    ack_window_value = json_dict.get("ackWindow") if isinstance(json_dict, dict) else None
+    # bools are ints too
+    if isinstance(ack_window_value, int) and not isinstance(ack_window_value, bool):
+        window = ack_window.set_window(ack_window_value)
+        return json.dumps({"ackWindow": window})
+    if isinstance(json_dict, dict) and isinstance(json_dict.get("effect"), dict):
+        return __handle_effect_message(stream_id, json_dict["effect"])
+    if isinstance(json_dict, dict) and isinstance(json_dict.get("layer"), dict):
+        return __handle_layer_message(stream_id, json_dict["layer"])
+    if isinstance(json_dict, dict) and "record" in json_dict:
+        return __handle_record_message(json_dict["record"])
+    if isinstance(json_dict, dict) and "play" in json_dict:
+        return __handle_play_message(json_dict["play"])
+    logger.warning("Unknown control message %s", message)
+    return None
+
+
+def __handle_effect_message(stream_id: int, json_dict: dict) -> str:
+    """Starts or stops an effect on a pin, which the renderer then animates by itself."""
+    descriptor = effects.from_json(json_dict)
+    result = descriptor.check_validity()
+    if not result.valid:
+        return json.dumps({"error": "Error parsing effect JSON " + result.reason})
+    key = layer_key(descriptor.pin, descriptor.layer)
+    if not streams.claim_pin(stream_id, key):
+        return json.dumps({"error": "Pin " + key + " is streamed by another connection"})
+    channels.queue.put_nowait(descriptor)
+    return json.dumps({"effect": descriptor.effect_type, "pin": descriptor.pin,
+                       "layer": descriptor.layer})
+
+
+def __handle_layer_message(stream_id: int, json_dict: dict) -> str:
+    """Changes how an overlay layer of a pin is drawn over the layers below, or removes it."""
+    settings = layer_stack.from_json(json_dict)
+    result = settings.check_validity()
+    if not result.valid:
+        return json.dumps({"error": "Error parsing layer JSON " + result.reason})
+    key = layer_key(settings.pin, settings.layer)
+    if not streams.claim_pin(stream_id, key):
+        return json.dumps({"error": "Pin " + key + " is streamed by another connection"})
+    channels.queue.put_nowait(settings)
+    if settings.remove:
+        return json.dumps({"layer": None, "pin": settings.pin})
+    return json.dumps({"layer": settings.to_dict()})
+
+
+def __handle_record_message(name: Optional[str]) -> str:
+    """Starts recording the received frames to a named recording, or stops for no name."""
+    if not name:
+        recorder = recording.stop()
+        if recorder is not None:
+            logger.info("Recorded %s frames to %s", recorder.frames, recorder.path)
+        return json.dumps({"recording": None, "frames": recorder.frames if recorder else 0})
+    try:
+        path = recording.start(str(name))
+    except (OSError, ValueError) as e:
+        return json.dumps({"error": "Cannot record " + str(e)})
+    logger.info("Recording frames to %s", path)
+    return json.dumps({"recording": name})
+
+
+def __handle_play_message(json_dict: Optional[dict]) -> str:
+    """Plays a recording in the NeoPixel process, or stops playing for null."""
+    if not json_dict:
+        channels.queue.put_nowait(PlaybackRequest(""))
+        return json.dumps({"playing": None})
+    if not isinstance(json_dict, dict):
+        return json.dumps({"error": "play must be an object with the recording's name"})
+    name = str(json_dict.get("name", ""))
+    start_ms = json_dict.get("startMs", 0)
+    started_at = json_dict.get("at", 0)
+    try:
+        path = recording_path(name)
+    except ValueError as e:
+        return json.dumps({"error": "Cannot play " + str(e)})
+    if not os.path.isfile(path):
+        return json.dumps({"error": "No recording " + name})
+    # bools are ints too
+    if any(isinstance(v, bool) or not isinstance(v, int) for v in (start_ms, started_at)):
+        return json.dumps({"error": "startMs and at must be integer milliseconds"})
+    channels.queue.put_nowait(PlaybackRequest(name, start_ms, started_at))
+    return json.dumps({"playing": name})
+
+
+def __handle_udp_message(sender: Sender, message: memoryview):
+    """Hands the frames of a UDP datagram to the NeoPixel process, as a stream of its sender."""
+    stream_id = udp_streams.get(sender)
+    if stream_id is None:
+        # Nothing is delivered, as UDP frames are never acknowledged
+        stream_id = streams.open(lambda acks: None)
+        udp_streams[sender] = stream_id
+    error = __handle_frame_message(stream_id, message, acknowledged=False)
+    if error is not None:
+        logger.warning("UDP frames from %s refused: %s", sender[0], error)
+
+
+def __close_udp_stream(sender: Sender):
+    """Releases the pins of a UDP sender which went silent."""
+    stream_id = udp_streams.pop(sender, None)
+    if stream_id is not None:
+        streams.close(stream_id)
+
+
+def ack_dispatcher():
+    """Sends the frame acknowledgements from the NeoPixel process to the WebSocket clients."""
+    while True:
+        acks = channels.ack_queue.get()
+        # Coalesce whatever else has arrived so windowed streams get one cumulative ACK
+        try:
+            while True:
+                acks.extend(channels.ack_queue.get_nowait())
+        except Empty:
+            pass
+        streams.deliver(acks)
 
 
 def broadcast_handler():
-    """UDP broadcast handler. Used for network discovery."""
+    """UDP broadcast handler. Used for network discovery. Also serves time sync requests."""
     multicast_group = "230.0.0.0"
     multicast_port = 8007
 
@@ -83,6 +366,13 @@ def broadcast_handler():
 
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
 
+    threading.Thread(
+        name="time_sync",
+        target=serve_time_sync,
+        args=(channels.clock, logger, TIME_SYNC_PORT),
+        daemon=True,
+    ).start()
+
     while True:
         data, addr = sock.recvfrom(1024)
         logger.debug(str(data))
@@ -94,6 +384,9 @@ def broadcast_handler():
             + str(WS_PORT)
             + ', "apiPort": '
             + str(API_PORT)
+            + ', "timeSyncPort": '
+            + str(TIME_SYNC_PORT)
+            + (', "udpPort": ' + str(UDP_INGEST_PORT) if UDP_INGEST else "")
             + ', "name": '
             + '"'
             + str(socket.gethostname() + '"' + "}")
@@ -102,101 +395,90 @@ def broadcast_handler():
 
 
 def ws_handler():
-    """Routes incoming WebSocket packets to the handler function."""
-    with serve(websocket_handler, "0.0.0.0", 8765) as websocket:
-        websocket.serve_forever()
-
-
-@app.route("/time", methods=["GET"])
-def current_time():
-    """Endpoint to get the current time"""
-    now = datetime.now()
-    now_as_millis = int(now.timestamp() * 1000)
-    return jsonify({"millisSinceEpoch": now_as_millis})
-
-
-@app.route("/configuration", methods=["GET", "POST", "DELETE"])
-def configuration():
-    """Endpoint to get, create, or delete NeoPixel configs"""
-    if request.method == "GET":
-        return __handle_get()
-    if request.method == "PATCH":
-        return __handle_patch()
-    if request.method == "POST":
-        return __handle_post()
-    if request.method == "DELETE":
-        uuid = request.args.get("uuid")
-        if uuid is not None:
-            return __handle_delete(uuid)
-        return (jsonify({"error": "No uuid url parameter specified"}), 400)
-    return (jsonify({"error": "Unsupported method " + request.method}), 400)
-
-def __handle_get():
-    config_list = cfg_repository.get_configs()
-    jsonified_config_list = "["
-    i = 0
-    while i < len(config_list):
-        jsonified_config_list += config_list[i].to_json()
-        if i < len(config_list) - 1:
-            jsonified_config_list += ","
-        i += 1
-    jsonified_config_list += "]"
-    return Response('{"configList": ' + jsonified_config_list + "}",
-                    mimetype="application/json")
-
-def __handle_patch():
-    if request.is_json:
-        config_list = cfg_repository.get_configs()
-        json_dict = request.get_json()
-        updated_config = np_config.from_json(json_dict)
-        result = updated_config.check_validity()
-        if result.valid:
-            for cfg in config_list:
-                if cfg.uuid == updated_config.uuid:
-                    cfg_repository.update_config(updated_config)
-                    queue.put_nowait(updated_config)
-                    return Response(status=201)
-            return (jsonify({"error": "No config found with uuid " + updated_config.uuid}), 400)
-        return (jsonify({"error": "Error parsing config JSON " + result.reason}), 400)
-    return (jsonify({"error": "Request must be JSON"}), 400)
-
-def __handle_post():
-    if request.is_json:
-        json_dict = request.get_json()
-        config = np_config.from_json(json_dict)
-        result = config.check_validity()
-        if result.valid:
-            cfg_repository.save_config(config)
-            queue.put_nowait(config)
-            return Response(status=201)
-        return (jsonify({"error": "Error parsing config JSON " + result.reason}), 400)
-    return (jsonify({"error": "Request must be JSON"}), 400)
-
-def __handle_delete(uuid):
-    cfg_repository.delete_config(uuid)
-    # Update the queue consumers of the config change
-    config_list = cfg_repository.get_configs()
-    queue.put_nowait(config_list)
-    return Response(status=201)
+    """
+    Routes incoming WebSocket packets to the handler function. The UDP ingest runs in this
+    process too, as the frame rings, pin claims and decoder state are this process's.
+    """
+    threading.Thread(name="ack_dispatcher", target=ack_dispatcher, daemon=True).start()
+    if UDP_INGEST:
+        threading.Thread(
+            name="udp_ingest",
+            target=serve_udp_ingest,
+            args=(__handle_udp_message, __close_udp_stream, logger, UDP_INGEST_PORT),
+            daemon=True,
+        ).start()
+    if ASYNCIO_WS_SERVER:
+        # pylint: disable-next=import-outside-toplevel
+        import asyncio
+
+        asyncio.run(__serve_async())
+    else:
+        # pylint: disable-next=import-outside-toplevel
+        from websockets.sync.server import serve
+        with serve(websocket_handler, "0.0.0.0", WS_PORT) as websocket:
+            websocket.serve_forever()
+
+
+async def __serve_async():
+    # pylint: disable-next=import-outside-toplevel
+    from websockets.asyncio.server import serve as async_serve
+    async with async_serve(async_websocket_handler, "0.0.0.0", WS_PORT) as server:
+        await server.serve_forever()
+
 
 def main():
     """Main function to start the threads:
-    WebSocket handler thread, UDP broadcast handler thread, and NeoPixel thread."""
+    WebSocket handler thread, UDP broadcast handler thread, and NeoPixel thread.
+    The NeoPixel process starts first, with the saved configs already on its queue."""
+    started_at = time.monotonic()
+    phase_started_at = started_at
+
+    def log_phase(phase: str):
+        nonlocal phase_started_at
+        now = time.monotonic()
+        logger.info("Startup: %s in %.1f ms, %.1f ms since start",
+                    phase, (now - phase_started_at) * 1000, (now - started_at) * 1000)
+        phase_started_at = now
+
+    configure_logging()
     cfg_repository.create()
-    p1 = mp.Process(name="ws_handler", target=ws_handler)
-    p2 = mp.Process(name="broadcast_handler", target=broadcast_handler)
+    config_list = cfg_repository.get_configs()
+    virtual_strips = VirtualStrips(cfg_repository.get_virtual_strips())
+    # Closed before the other processes are forked, so none of them inherit it. The REST
+    # API reopens it
+    cfg_repository.close()
+    log_phase("loaded " + str(len(config_list)) + " configs")
+    if SHARED_MEMORY_TRANSPORT:
+        for cfg in config_list:
+            channels.frame_rings[cfg.pin] = SharedFrameRing.create(
+                cfg.pin, cfg.leds, SHARED_MEMORY_SLOTS
+            )
     p3 = mp.Process(
         name="neopixel_thread",
         target=np_thread.neopixel_thread,
-        args=(queue, logger),
+        args=(channels, logger),
     )
+    p3.start()
+    channels.queue.put_nowait(config_list)
+    channels.queue.put_nowait(virtual_strips)
+    log_phase("started the NeoPixel process")
+
+    p1 = mp.Process(name="ws_handler", target=ws_handler)
+    p2 = mp.Process(name="broadcast_handler", target=broadcast_handler)
     p1.start()
     p2.start()
-    p3.start()
+    log_phase("started the WebSocket and broadcast processes")
 
-    config_list = cfg_repository.get_configs()
-    queue.put_nowait(config_list)
-    app.run(debug=False, use_reloader=False, port=8000, host="0.0.0.0")
+    # pylint: disable-next=import-outside-toplevel
+    import rest_api
+
+    app = rest_api.create_app(__name__.split(".", maxsplit=1)[0], channels, cfg_repository)
+    log_phase("created the REST API")
+    try:
+        app.run(debug=False, use_reloader=False, port=API_PORT, host="0.0.0.0")
+    finally:
+        for ring in channels.frame_rings.values():
+            ring.close(unlink=True)
 
 
 if __name__ == "__main__":
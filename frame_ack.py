@@ -0,0 +1,69 @@
+"""
+Frame acknowledgements. The NeoPixel process reports whether each streamed frame made it
+into the render buffer, and the WebSocket process acknowledges it to the client.
+"""
+
+import json
+
+# pylint: disable=too-few-public-methods
+
+# Largest number of unacknowledged frames a client may have in flight
+MAX_ACK_WINDOW = 256
+# Longest a client is told to wait before resending a rejected frame, and the longest its
+# stream stops being read for. Short enough for WebSocket keepalives to get through; a frame
+# rejected again on the retry just gets another wait
+MAX_RETRY_AFTER_MS = 250
+
+
+class FrameAck:
+    """The result of handing a streamed frame to the renderer."""
+
+    stream_id: int
+    timestamp: int
+    accepted: bool
+    # For a rejected frame on a pin applying backpressure, milliseconds until the client
+    # should send it again. 0 otherwise.
+    retry_after_ms: int
+
+    def __init__(self, stream_id: int, timestamp: int, accepted: bool, retry_after_ms: int = 0):
+        self.stream_id = stream_id
+        self.timestamp = timestamp
+        self.accepted = accepted
+        self.retry_after_ms = retry_after_ms
+
+
+class AckWindow:
+    """
+    The acknowledgement mode of one WebSocket connection.
+    With a window of 0 every accepted frame gets an "ACK" text message and every rejected
+    frame a "FULL" message. With a window the client may have that many frames in flight,
+    and accepted frames are acknowledged cumulatively with the last accepted timestamp.
+    Rejected frames are reported with when to retry if their pin applies backpressure.
+    """
+
+    window: int
+
+    def __init__(self):
+        self.window = 0
+
+    def set_window(self, window: int) -> int:
+        """Switches to windowed acknowledgements. Returns the window actually used."""
+        self.window = max(0, min(window, MAX_ACK_WINDOW))
+        return self.window
+
+    def messages(self, acks: list[FrameAck]) -> list[str]:
+        """The messages acknowledging a batch of frames, in the order they were handled."""
+        if self.window == 0:
+            return ["ACK" if ack.accepted else "FULL" for ack in acks]
+        messages = list[str]()
+        accepted = [ack for ack in acks if ack.accepted]
+        if accepted:
+            messages.append(json.dumps({"ack": accepted[-1].timestamp, "frames": len(accepted)}))
+        for ack in acks:
+            if not ack.accepted:
+                # Backpressure: the client should resend this frame later or slow down
+                full = {"full": ack.timestamp}
+                if ack.retry_after_ms:
+                    full["retryAfterMs"] = ack.retry_after_ms
+                messages.append(json.dumps(full))
+        return messages
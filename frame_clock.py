@@ -0,0 +1,59 @@
+"""
+The frame clock. Gives the render process epoch milliseconds which don't jump, except to
+follow a step of the wall clock.
+"""
+
+import time
+from typing import Optional
+
+# Seconds the wall clock may differ from the frame clock before the frame clock follows it.
+# NTP slews smaller differences away, and the monotonic clock is slewed with it
+REANCHOR_THRESHOLD_S = 0.1
+# Seconds between comparing the frame clock with the wall clock
+REANCHOR_INTERVAL_S = 1.0
+
+
+class FrameClock:
+    """
+    Maps time.monotonic() onto milliseconds since the epoch.
+    The offset is only retaken when the wall clock has been stepped, e.g. by NTP correcting
+    a Pi which booted without network time, so senders' timestamps stay comparable while
+    frame deadlines don't wobble with every adjustment. Clocks created with the same
+    epoch_offset agree across processes, the monotonic clock being system wide, and each
+    follows a step within REANCHOR_INTERVAL_S.
+    """
+
+    epoch_offset: float
+
+    def __init__(self, epoch_offset: Optional[float] = None):
+        self.epoch_offset = (
+            epoch_offset if epoch_offset is not None else time.time() - time.monotonic()
+        )
+        self._next_check_at = time.monotonic() + REANCHOR_INTERVAL_S
+
+    def now_millis(self) -> int:
+        """The current time in milliseconds since the epoch."""
+        return int((self._monotonic() + self.epoch_offset) * 1000)
+
+    def now_micros(self) -> int:
+        """The current time in microseconds since the epoch."""
+        return int((self._monotonic() + self.epoch_offset) * 1_000_000)
+
+    def seconds_until(self, timestamp: int) -> float:
+        """Seconds from now until the timestamp (milliseconds since the epoch), never negative."""
+        remaining = timestamp / 1000 - (self._monotonic() + self.epoch_offset)
+        return remaining if remaining > 0 else 0.0
+
+    def seconds_since(self, timestamp: int) -> float:
+        """Seconds since the timestamp (milliseconds since the epoch), negative if it is ahead."""
+        return self._monotonic() + self.epoch_offset - timestamp / 1000
+
+    def _monotonic(self) -> float:
+        # time.monotonic(), re-anchoring the offset first if the wall clock has been stepped
+        now = time.monotonic()
+        if now >= self._next_check_at:
+            self._next_check_at = now + REANCHOR_INTERVAL_S
+            offset = time.time() - now
+            if abs(offset - self.epoch_offset) > REANCHOR_THRESHOLD_S:
+                self.epoch_offset = offset
+        return now
@@ -0,0 +1,183 @@
+"""
+The frame codec. Decodes the compressed payload encodings of frame messages into
+full RGB pixel data.
+
+Bits 1 and 2 of the options byte select the payload encoding:
+    0 raw: R, G, B bytes for every LED
+    1 run length: runs of a uint16 LED count followed by R, G, B
+    2 sparse: a uint16 LED count, then uint16 LED index and R, G, B records
+      which update the previous frame of the pin
+    3 fill: a uint16 LED count followed by R, G, B for every LED
+
+Bit 7 of the first byte marks a batch message: a uint16 record count followed by
+records of an options byte, pin, timestamp, uint32 payload length and the payload.
+All integers are little endian.
+"""
+
+import struct
+from typing import Union
+
+from rgb_frame import (FRAME_HEADER_SIZE, MAX_LEDS, RgbFrame, layer_key, options_from_byte,
+                       parse_frame_header)
+
+BATCH_FLAG = 0x80
+
+ENCODING_RAW = 0
+ENCODING_RLE = 1
+ENCODING_SPARSE = 2
+ENCODING_FILL = 3
+
+# uint16 count or index followed by a color
+COLOR_RECORD = struct.Struct("<H3s")
+LED_COUNT = struct.Struct("<H")
+# Batch flag byte, record count
+BATCH_HEADER = struct.Struct("<BH")
+# Options byte, 4 byte ASCII pin name, timestamp, payload length
+BATCH_RECORD_HEADER = struct.Struct("<B4sQI")
+
+
+def encoding_from_options(options_byte: int) -> int:
+    """The payload encoding selected by an options byte."""
+    return (options_byte >> 1) & 0x03
+
+
+def is_batch(message: bytes) -> bool:
+    """True if the message is a batch of frames."""
+    return len(message) > 0 and (message[0] & BATCH_FLAG) != 0
+
+
+def _batch_records(message: bytes):
+    """Yields the options byte, pin, timestamp and payload of each record of a batch message."""
+    if len(message) < BATCH_HEADER.size:
+        raise ValueError("Batch message is missing the record count")
+    view = memoryview(message)
+    _, record_count = BATCH_HEADER.unpack_from(view)
+    offset = BATCH_HEADER.size
+    for record in range(record_count):
+        if offset + BATCH_RECORD_HEADER.size > len(view):
+            raise ValueError(f"Batch record {record} is truncated")
+        options_byte, pin_bytes, timestamp, length = BATCH_RECORD_HEADER.unpack_from(
+            view, offset
+        )
+        offset += BATCH_RECORD_HEADER.size
+        if offset + length > len(view):
+            raise ValueError(f"Batch record {record} payload is truncated")
+        pin = pin_bytes.decode("ascii").strip()
+        yield options_byte, pin, timestamp, view[offset:offset + length]
+        offset += length
+
+
+def layer_keys(message: bytes) -> set[str]:
+    """
+    The layer_key() of each layer a frame or batch message draws, read from its headers
+    without decoding any payload. Raises ValueError if the headers are malformed.
+    """
+    if is_batch(message):
+        return {
+            layer_key(pin, options_from_byte(options_byte).layer)
+            for options_byte, pin, _, _ in _batch_records(message)
+        }
+    options_byte, pin, _ = parse_frame_header(message)
+    return {layer_key(pin, options_from_byte(options_byte).layer)}
+
+
+class FrameDecoder:
+    """
+    Decodes frame messages into RgbFrames with raw pixel data.
+    Remembers the last pixel data of each layer of each pin, which sparse frames are applied to.
+    A message which fails to decode leaves it as it was.
+    """
+
+    def __init__(self):
+        self._last_pixels = dict[str, Union[bytes, memoryview]]()
+
+    def decode(self, message: bytes) -> RgbFrame:
+        """Decodes a frame message. Raises ValueError if it is malformed."""
+        options_byte, pin, timestamp = parse_frame_header(message)
+        options = options_from_byte(options_byte)
+        decoded = dict[str, Union[bytes, memoryview]]()
+        pixels = self.decode_payload(
+            layer_key(pin, options.layer),
+            encoding_from_options(options_byte),
+            memoryview(message)[FRAME_HEADER_SIZE:],
+            decoded,
+        )
+        self._last_pixels.update(decoded)
+        return RgbFrame(pin, timestamp, options, pixels)
+
+    def decode_batch(self, message: bytes) -> list[RgbFrame]:
+        """Decodes every frame of a batch message in one pass. Raises ValueError if malformed."""
+        frames = list[RgbFrame]()
+        # Only remembered once every record has decoded
+        decoded = dict[str, Union[bytes, memoryview]]()
+        for options_byte, pin, timestamp, payload in _batch_records(message):
+            options = options_from_byte(options_byte)
+            pixels = self.decode_payload(
+                layer_key(pin, options.layer),
+                encoding_from_options(options_byte),
+                payload,
+                decoded,
+            )
+            frames.append(RgbFrame(pin, timestamp, options, pixels))
+        self._last_pixels.update(decoded)
+        return frames
+
+    def decode_payload(self,
+                       key: str,
+                       encoding: int,
+                       payload: memoryview,
+                       decoded: dict[str, Union[bytes, memoryview]]) -> Union[bytes, memoryview]:
+        """Decodes the payload of one layer of a pin, named by its layer_key(), into raw
+        pixel data. The pixels are added to decoded, which sparse payloads are applied to
+        before the remembered pixels."""
+        if encoding == ENCODING_RAW:
+            # Drop any trailing partial LED
+            pixels = payload[:len(payload) // 3 * 3]
+        elif encoding == ENCODING_RLE:
+            pixels = self.__expand_runs(payload)
+        elif encoding == ENCODING_SPARSE:
+            previous = decoded.get(key, self._last_pixels.get(key, b""))
+            pixels = self.__apply_sparse(previous, payload)
+        else:
+            if len(payload) != LED_COUNT.size + 3:
+                raise ValueError(f"Fill payload is {len(payload)} bytes, must be 5")
+            (led_count,) = LED_COUNT.unpack_from(payload)
+            if led_count > MAX_LEDS:
+                raise ValueError(f"Fill LED count {led_count} is over {MAX_LEDS}")
+            pixels = bytes(payload[LED_COUNT.size:]) * led_count
+        decoded[key] = pixels
+        return pixels
+
+    @classmethod
+    def __apply_sparse(cls, previous: Union[bytes, memoryview], payload: memoryview) -> bytes:
+        if len(payload) < LED_COUNT.size:
+            raise ValueError("Sparse payload is missing the LED count")
+        (led_count,) = LED_COUNT.unpack_from(payload)
+        if led_count > MAX_LEDS:
+            raise ValueError(f"Sparse LED count {led_count} is over {MAX_LEDS}")
+        pixels = bytearray(previous[:led_count * 3])
+        if len(pixels) < led_count * 3:
+            pixels.extend(bytes(led_count * 3 - len(pixels)))
+        for index, color in cls.__records(payload[LED_COUNT.size:]):
+            if index >= led_count:
+                raise ValueError(f"Sparse LED index {index} is outside of {led_count} LEDs")
+            pixels[index * 3:index * 3 + 3] = color
+        return bytes(pixels)
+
+    @classmethod
+    def __expand_runs(cls, payload: memoryview) -> bytes:
+        runs = list[bytes]()
+        led_count = 0
+        for count, color in cls.__records(payload):
+            # Checked before expanding, so a small payload can't expand into a huge frame
+            led_count += count
+            if led_count > MAX_LEDS:
+                raise ValueError(f"Run length payload expands to over {MAX_LEDS} LEDs")
+            runs.append(color * count)
+        return b"".join(runs)
+
+    @staticmethod
+    def __records(payload: memoryview):
+        if len(payload) % COLOR_RECORD.size != 0:
+            raise ValueError(f"Payload of {len(payload)} bytes is not a whole number of records")
+        return COLOR_RECORD.iter_unpack(payload)
@@ -0,0 +1,269 @@
+"""
+Frame recordings. Decoded frames appended to a memory-mapped file as they are received,
+and played back later through the renderer's scheduler with their original relative timing.
+
+The file is a header, then one record per frame in the order received, then on close an
+end marker and an index of the first record at or after each second of the recording:
+    header  <8sQ    magic, epoch milliseconds of the first frame
+    record  <4sQBI  pin, milliseconds since the first frame, flags and layer, payload length,
+                    payload
+    index   <QQ     milliseconds since the first frame, record offset
+    footer  <QI8s   index offset, index entries, magic
+A recording which was never closed has no index and is read by hopping from record header
+to record header. Unwritten space is zeros, so a zero pin marks the end of the records.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Iterator, Optional
+
+from rgb_frame import MAX_LAYER, RgbFrame, RgbFrameOptions
+
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+RECORDING_MAGIC = b"CCREC001"
+INDEX_MAGIC = b"CCRECIDX"
+RECORDING_HEADER = struct.Struct("<8sQ")
+RECORD_HEADER = struct.Struct("<4sQBI")
+INDEX_ENTRY = struct.Struct("<QQ")
+RECORDING_FOOTER = struct.Struct("<QI8s")
+END_OF_RECORDS = b"\0\0\0\0"
+
+# The payload is zlib compressed, set when that makes it smaller
+FLAG_ZLIB = 0x01
+# Bits 1 to 3 of the flags are the layer the frame drew
+FLAG_LAYER_SHIFT = 1
+# Milliseconds of recording between index entries
+INDEX_INTERVAL_MS = 1000
+# The file is grown this many bytes at a time, then truncated to its length on close
+GROW_BYTES = 8 * 1024 * 1024
+# Recordings are only read and written in this directory
+RECORDINGS_DIR = "recordings"
+
+
+def recording_path(name: str) -> str:
+    """The path of a recording by file name. Raises ValueError for names with a directory."""
+    if not name or os.path.basename(name) != name or name in (".", ".."):
+        raise ValueError("Recording name must be a plain file name")
+    return os.path.join(RECORDINGS_DIR, name)
+
+
+class FrameRecorder:
+    """Appends frames to a new recording file. Thread safe."""
+
+    path: str
+    # Epoch milliseconds of the first frame, 0 until one is recorded
+    base_timestamp: int
+    frames: int
+
+    def __init__(self, path: str):
+        self.path = path
+        self.base_timestamp = 0
+        self.frames = 0
+        self._lock = threading.Lock()
+        self._file = open(path, "w+b")  # pylint: disable=consider-using-with
+        self._size = GROW_BYTES
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        # Rewritten with the first frame's timestamp
+        RECORDING_HEADER.pack_into(self._map, 0, RECORDING_MAGIC, 0)
+        self._offset = RECORDING_HEADER.size
+        self._index = list[tuple[int, int]]()
+        self._next_index_ms = 0
+
+    def record(self, frame: RgbFrame, now_millis: int):
+        """Appends a frame. Frames without a timestamp are recorded at now_millis."""
+        timestamp = frame.timestamp if frame.timestamp != 0 else now_millis
+        pixels = bytes(frame.pixels)
+        compressed = zlib.compress(pixels, 1)
+        flags = FLAG_ZLIB if len(compressed) < len(pixels) else 0
+        flags |= frame.options.layer << FLAG_LAYER_SHIFT
+        payload = compressed if flags & FLAG_ZLIB else pixels
+        with self._lock:
+            if self._map is None:
+                return
+            if self.frames == 0:
+                self.base_timestamp = timestamp
+                RECORDING_HEADER.pack_into(self._map, 0, RECORDING_MAGIC, timestamp)
+            relative = max(0, timestamp - self.base_timestamp)
+            record_size = RECORD_HEADER.size + len(payload)
+            # Room for the end marker too
+            if self._offset + record_size + RECORD_HEADER.size > self._size:
+                self._grow(record_size)
+            if relative >= self._next_index_ms:
+                self._index.append((relative, self._offset))
+                self._next_index_ms = relative - relative % INDEX_INTERVAL_MS + INDEX_INTERVAL_MS
+            RECORD_HEADER.pack_into(self._map, self._offset, frame.pin.encode("ascii").ljust(4),
+                                    relative, flags, len(payload))
+            start = self._offset + RECORD_HEADER.size
+            self._map[start:start + len(payload)] = payload
+            self._offset = start + len(payload)
+            self.frames += 1
+
+    def _grow(self, at_least: int):
+        self._map.close()
+        self._size += max(GROW_BYTES, at_least)
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+
+    def close(self):
+        """Writes the end marker and index, and truncates the file to its length."""
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.truncate(self._offset)
+            self._file.seek(self._offset)
+            self._file.write(END_OF_RECORDS.ljust(RECORD_HEADER.size, b"\0"))
+            index_offset = self._file.tell()
+            self._file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in self._index))
+            self._file.write(RECORDING_FOOTER.pack(index_offset, len(self._index), INDEX_MAGIC))
+            self._file.close()
+
+
+class FrameRecording:
+    """A recording file opened for reading."""
+
+    # Epoch milliseconds of the first frame when it was recorded
+    base_timestamp: int
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.base_timestamp = RECORDING_HEADER.unpack_from(self._map, 0)
+        if magic != RECORDING_MAGIC:
+            self._map.close()
+            raise ValueError("Not a frame recording " + path)
+        self._index = list[tuple[int, int]]()
+        self._end = len(self._map)
+        if len(self._map) >= RECORDING_HEADER.size + RECORDING_FOOTER.size:
+            index_offset, entries, index_magic = RECORDING_FOOTER.unpack_from(
+                self._map, len(self._map) - RECORDING_FOOTER.size
+            )
+            if index_magic == INDEX_MAGIC:
+                self._index = [
+                    INDEX_ENTRY.unpack_from(self._map, index_offset + i * INDEX_ENTRY.size)
+                    for i in range(entries)
+                ]
+                self._end = index_offset
+
+    def seek(self, relative_ms: int) -> int:
+        """
+        The offset of a record at or before the first one relative_ms into the recording.
+        Uses the index, so at most INDEX_INTERVAL_MS of records are read to find it.
+        """
+        entry = bisect.bisect_right(self._index, (relative_ms, len(self._map))) - 1
+        return self._index[entry][1] if entry >= 0 else RECORDING_HEADER.size
+
+    def records(self, offset: int) -> Iterator[tuple[str, int, int, bytes]]:
+        """The pin, layer, milliseconds since the first frame and pixels of each record from
+        offset."""
+        while offset + RECORD_HEADER.size <= self._end:
+            pin, relative, flags, length = RECORD_HEADER.unpack_from(self._map, offset)
+            if pin == END_OF_RECORDS:
+                return
+            start = offset + RECORD_HEADER.size
+            payload = self._map[start:start + length]
+            offset = start + length
+            pixels = zlib.decompress(payload) if flags & FLAG_ZLIB else payload
+            layer = flags >> FLAG_LAYER_SHIFT & MAX_LAYER
+            yield pin.decode("ascii").strip(), layer, relative, pixels
+
+    def close(self):
+        """Unmaps the file."""
+        self._map.close()
+
+
+class FramePlayer:
+    """
+    Plays a recording back in real time, from start_ms into it, as if its first frame had
+    the timestamp started_at - start_ms. Only frames for pins are played.
+    """
+
+    def __init__(self, recording: FrameRecording, start_ms: int, started_at: int, pins: set[str]):
+        self.recording = recording
+        self.pins = pins
+        self._start_ms = start_ms
+        self._time_shift = started_at - start_ms
+        self._records = recording.records(recording.seek(start_ms))
+        self._pending: Optional[RgbFrame] = None
+        self._advance()
+
+    def _advance(self):
+        for pin, layer, relative, pixels in self._records:
+            if pin in self.pins and relative >= self._start_ms:
+                self._pending = RgbFrame(pin, relative + self._time_shift,
+                                         RgbFrameOptions(False, layer), pixels)
+                return
+        self._pending = None
+
+    def finished(self) -> bool:
+        """True once every frame has been played."""
+        return self._pending is None
+
+    def next_timestamp(self) -> Optional[int]:
+        """The timestamp of the next frame to be played, None when finished."""
+        return self._pending.timestamp if self._pending is not None else None
+
+    def frames_until(self, timestamp: int) -> list[RgbFrame]:
+        """Removes and returns the frames to be played up to timestamp, in recorded order."""
+        frames = list[RgbFrame]()
+        while self._pending is not None and self._pending.timestamp <= timestamp:
+            frames.append(self._pending)
+            self._advance()
+        return frames
+
+
+class RecordingControl:
+    """Switches recording of the received frames on and off. Thread safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recorder: Optional[FrameRecorder] = None
+
+    def start(self, name: str) -> str:
+        """Records to a new recording, stopping any running. Returns its path."""
+        path = recording_path(name)
+        self.stop()
+        os.makedirs(RECORDINGS_DIR, exist_ok=True)
+        recorder = FrameRecorder(path)
+        with self._lock:
+            self._recorder = recorder
+        return path
+
+    def stop(self) -> Optional[FrameRecorder]:
+        """Stops recording and closes the recording. Returns its recorder if one was running."""
+        with self._lock:
+            recorder = self._recorder
+            self._recorder = None
+        if recorder is not None:
+            recorder.close()
+        return recorder
+
+    def record(self, frames: list[RgbFrame], now_millis: int):
+        """Records frames if recording is on."""
+        recorder = self._recorder
+        if recorder is not None:
+            for frame in frames:
+                recorder.record(frame, now_millis)
+
+
+class PlaybackRequest:
+    """Asks the NeoPixel process to play a recording, or to stop playing if name is empty."""
+
+    name: str
+    # Milliseconds into the recording to start from
+    start_ms: int
+    # Epoch milliseconds to play the start_ms frame at, 0 for now
+    started_at: int
+
+    def __init__(self, name: str, start_ms: int = 0, started_at: int = 0):
+        self.name = name
+        self.start_ms = start_ms
+        self.started_at = started_at
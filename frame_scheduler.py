@@ -0,0 +1,262 @@
+"""
+The frame scheduler. Buffers frames per pin in timestamp order until they are due.
+"""
+
+import heapq
+import itertools
+from typing import Iterable, Optional, Union
+
+from rgb_frame import RgbFrame, RgbFrameOptions
+
+
+class FrameStore:
+    """
+    Preallocated storage for the pixels of one pin's buffered frames. Each frame is copied
+    into a fixed size slot of one bytearray, so buffering a frame allocates nothing.
+    """
+
+    capacity: int
+    # Bytes per slot, longer frames are truncated to it
+    frame_bytes: int
+
+    def __init__(self, capacity: int, frame_bytes: int):
+        self.capacity = capacity
+        self.frame_bytes = frame_bytes
+        self._data = memoryview(bytearray(capacity * frame_bytes))
+        # Popped from the end, so slots fill from the start of the buffer
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def free_slots(self) -> int:
+        """The number of frames which can still be stored."""
+        return len(self._free)
+
+    def put(self, pixels: Union[bytes, bytearray, memoryview]) -> tuple[int, int]:
+        """Copies pixels into a free slot. Returns the slot and the number of bytes stored."""
+        slot = self._free.pop()
+        length = min(len(pixels), self.frame_bytes)
+        start = slot * self.frame_bytes
+        self._data[start:start + length] = memoryview(pixels)[:length]
+        return slot, length
+
+    def read(self, slot: int, length: int) -> bytes:
+        """A copy of the pixels in a slot, which stays in use."""
+        start = slot * self.frame_bytes
+        return self._data[start:start + length].tobytes()
+
+    def take(self, slot: int, length: int) -> bytes:
+        """A copy of the pixels in a slot, which is freed."""
+        pixels = self.read(slot, length)
+        self._free.append(slot)
+        return pixels
+
+    def release(self, slot: int):
+        """Frees a slot without reading it."""
+        self._free.append(slot)
+
+
+class FrameScheduler:
+    """
+    Per-pin min-heaps of buffered frames keyed by timestamp, with their pixels in the pin's
+    FrameStore. Frames with equal timestamps keep their arrival order. The frames of a pin's
+    overlay layers share its heap and store, so they count against the same buffer.
+    A pin buffers nothing until it is given a store with configure().
+    """
+
+    def __init__(self):
+        # Timestamp, arrival counter, slot, length and layer of each buffered frame
+        self._heaps = dict[str, list[tuple[int, int, int, int, int]]]()
+        self._stores = dict[str, FrameStore]()
+        # The number of buffered overlay layer frames of each pin
+        self._overlay_frames = dict[str, int]()
+        self._counter = itertools.count()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def configure(self, pin: str, capacity: int, frame_bytes: int) -> int:
+        """
+        Gives a pin storage for capacity frames of frame_bytes each. Frames buffered in
+        different storage are moved over, earliest first. Returns how many didn't fit.
+        """
+        store = self._stores.get(pin)
+        if store is not None and (store.capacity, store.frame_bytes) == (capacity, frame_bytes):
+            return 0
+        buffered = self.pop_all_due(pin, float("inf")) if store is not None else []
+        self._stores[pin] = FrameStore(capacity, frame_bytes)
+        self.push_many(buffered[:capacity])
+        return max(0, len(buffered) - capacity)
+
+    def remove(self, pin: str):
+        """Drops a pin's buffered frames and frees its storage."""
+        self.clear(pin)
+        self._heaps.pop(pin, None)
+        self._overlay_frames.pop(pin, None)
+        self._stores.pop(pin, None)
+
+    def empty(self) -> bool:
+        """True if no frames are buffered for any pin."""
+        return self._size == 0
+
+    def count(self, pin: str) -> int:
+        """The number of frames buffered for a pin."""
+        return len(self._heaps.get(pin, ()))
+
+    def free_slots(self, pin: str) -> int:
+        """The number of frames which can still be buffered for a pin."""
+        store = self._stores.get(pin)
+        return store.free_slots() if store is not None else 0
+
+    def capacity(self, pin: str) -> int:
+        """The number of frames a pin can buffer, 0 if it has no storage."""
+        store = self._stores.get(pin)
+        return store.capacity if store is not None else 0
+
+    def pins(self) -> list[str]:
+        """The pins which have buffered frames."""
+        return [pin for pin, heap in self._heaps.items() if heap]
+
+    def push(self, frame: RgbFrame) -> bool:
+        """
+        Buffers a frame. O(log n) in the number of frames buffered for its pin.
+        Returns False if the pin's storage is full.
+        """
+        store = self._stores.get(frame.pin)
+        if store is None or store.free_slots() == 0:
+            return False
+        slot, length = store.put(frame.pixels)
+        heap = self._heaps.setdefault(frame.pin, [])
+        heapq.heappush(heap, (frame.timestamp, next(self._counter), slot, length,
+                              frame.options.layer))
+        self._count_frame(frame.pin, frame.options.layer, 1)
+        return True
+
+    def push_many(self, frames: Iterable[RgbFrame]) -> list[bool]:
+        """
+        Buffers many frames at once, re-heapifying each pin's heap once.
+        Returns whether each frame fit in its pin's storage.
+        """
+        touched = set[str]()
+        accepted = list[bool]()
+        for frame in frames:
+            store = self._stores.get(frame.pin)
+            if store is None or store.free_slots() == 0:
+                accepted.append(False)
+                continue
+            slot, length = store.put(frame.pixels)
+            self._heaps.setdefault(frame.pin, []).append(
+                (frame.timestamp, next(self._counter), slot, length, frame.options.layer)
+            )
+            touched.add(frame.pin)
+            self._count_frame(frame.pin, frame.options.layer, 1)
+            accepted.append(True)
+        for pin in touched:
+            heapq.heapify(self._heaps[pin])
+        return accepted
+
+    def next_timestamp(self, pin: Optional[str] = None) -> Optional[int]:
+        """The earliest buffered timestamp for a pin, or across all pins if pin is None."""
+        if pin is not None:
+            heap = self._heaps.get(pin)
+            return heap[0][0] if heap else None
+        timestamps = [heap[0][0] for heap in self._heaps.values() if heap]
+        return min(timestamps) if timestamps else None
+
+    def _count_frame(self, pin: str, layer: int, change: int):
+        self._size += change
+        if layer != 0:
+            self._overlay_frames[pin] = self._overlay_frames.get(pin, 0) + change
+
+    def _pop(self, pin: str) -> RgbFrame:
+        return self._take(pin, heapq.heappop(self._heaps[pin]))
+
+    def _take(self, pin: str, entry: tuple[int, int, int, int, int]) -> RgbFrame:
+        timestamp, _, slot, length, layer = entry
+        self._count_frame(pin, layer, -1)
+        pixels = self._stores[pin].take(slot, length)
+        return RgbFrame(pin, timestamp, RgbFrameOptions(False, layer), pixels)
+
+    def peek(self, pin: str, layer: int = 0) -> Optional[RgbFrame]:
+        """A copy of the pin's earliest buffered frame of a layer, which stays buffered."""
+        heap = self._heaps.get(pin)
+        if not heap:
+            return None
+        if self._overlay_frames.get(pin):
+            entry = min((e for e in heap if e[4] == layer), default=None)
+        else:
+            entry = heap[0] if layer == 0 else None
+        if entry is None:
+            return None
+        timestamp, _, slot, length, _ = entry
+        pixels = self._stores[pin].read(slot, length)
+        return RgbFrame(pin, timestamp, RgbFrameOptions(False, layer), pixels)
+
+    def pop_due(self, pin: str, latest: int) -> Optional[RgbFrame]:
+        """Removes and returns the pin's earliest frame if its timestamp is at or before latest."""
+        heap = self._heaps.get(pin)
+        if heap and heap[0][0] <= latest:
+            return self._pop(pin)
+        return None
+
+    def pop_due_layers(self, pin: str, latest: int) -> list[RgbFrame]:
+        """
+        Removes and returns the earliest frame of each of the pin's layers which has a
+        timestamp at or before latest, so a base stream and its overlays advance together.
+        """
+        if not self._overlay_frames.get(pin):
+            frame = self.pop_due(pin, latest)
+            return [frame] if frame is not None else []
+        heap = self._heaps[pin]
+        earliest = dict[int, tuple[int, int, int, int, int]]()
+        later = list[tuple[int, int, int, int, int]]()
+        while heap and heap[0][0] <= latest:
+            entry = heapq.heappop(heap)
+            if entry[4] in earliest:
+                later.append(entry)
+            else:
+                earliest[entry[4]] = entry
+        # Their slots were never freed, so they go back as they were
+        for entry in later:
+            heapq.heappush(heap, entry)
+        return [self._take(pin, entry) for entry in earliest.values()]
+
+    def pop_all_due(self, pin: str, latest: float) -> list[RgbFrame]:
+        """Removes and returns the pin's frames due by latest, oldest first."""
+        heap = self._heaps.get(pin)
+        due = list[RgbFrame]()
+        while heap and heap[0][0] <= latest:
+            due.append(self._pop(pin))
+        return due
+
+    def drop_before(self, pin: str, timestamp: int) -> list[int]:
+        """Removes the pin's frames with timestamps before the given timestamp.
+        Returns their timestamps."""
+        heap = self._heaps.get(pin)
+        dropped = list[int]()
+        while heap and heap[0][0] < timestamp:
+            dropped.append(self._drop(pin))
+        return dropped
+
+    def drop_earliest(self, pin: str) -> Optional[int]:
+        """Removes the pin's frame with the earliest timestamp. Returns its timestamp."""
+        return self._drop(pin) if self._heaps.get(pin) else None
+
+    def _drop(self, pin: str) -> int:
+        # Frees the slot without copying the pixels out
+        timestamp, _, slot, _, layer = heapq.heappop(self._heaps[pin])
+        self._count_frame(pin, layer, -1)
+        self._stores[pin].release(slot)
+        return timestamp
+
+    def clear(self, pin: str, layer: Optional[int] = None):
+        """Drops every buffered frame for a pin, or only those of one of its layers."""
+        heap = self._heaps.get(pin)
+        if not heap:
+            return
+        kept = [entry for entry in heap if layer is not None and entry[4] != layer]
+        for _, _, slot, _, entry_layer in heap:
+            if layer is None or entry_layer == layer:
+                self._count_frame(pin, entry_layer, -1)
+                self._stores[pin].release(slot)
+        heapq.heapify(kept)
+        self._heaps[pin] = kept
@@ -0,0 +1,88 @@
+"""
+The interpolation policy of a pin. Upsamples a stream sent at a low frame rate: between two
+buffered frames the renderer shows frames blended from both at a target rate, so slow fades
+don't visibly step and the network carries no extra frames.
+
+A blended frame is two bytes.translate lookups, scaling each frame by its weight, and one
+addition of both as big integers. The tables are rounded so no byte of the sum carries into
+the next, which makes the addition a vectorized per byte sum.
+"""
+
+import functools
+from typing import Optional, Union
+
+from validation_result import ValidationResult, json_object
+
+# Interpolation never shows frames faster than this, nor faster than the strip can be shown
+MAX_TARGET_FPS = 240
+# Frames further apart than this are not interpolated between, as the stream paused or cut
+DEFAULT_MAX_GAP_MS = 250
+# The weights of interpolated frames are multiples of 1 / BLEND_STEPS
+BLEND_STEPS = 64
+
+
+class InterpolationPolicy:
+    """Whether, and how often, frames blended between a pin's buffered frames are shown."""
+
+    # Frames per second to show between buffered frames, 0 to show only the frames received
+    target_fps: int
+    # Buffered frames further apart than this many milliseconds are shown as they are
+    max_gap_ms: int
+
+    def __init__(self, target_fps: int = 0, max_gap_ms: int = DEFAULT_MAX_GAP_MS):
+        self.target_fps = target_fps
+        self.max_gap_ms = max_gap_ms
+
+    @property
+    def enabled(self) -> bool:
+        """True if interpolated frames are shown."""
+        return self.target_fps > 0
+
+    def check_validity(self) -> ValidationResult:
+        """Validates this policy."""
+        if not isinstance(self.target_fps, int) or not 0 <= self.target_fps <= MAX_TARGET_FPS:
+            return ValidationResult(
+                False, "Interpolation targetFps must be between 0 and " + str(MAX_TARGET_FPS)
+            )
+        if not isinstance(self.max_gap_ms, int) or self.max_gap_ms < 1:
+            return ValidationResult(False, "Interpolation maxGapMs must be at least 1")
+        return ValidationResult(True, "")
+
+    def to_dict(self) -> dict:
+        """The JSON serializable form of this policy."""
+        return {"targetFps": self.target_fps, "maxGapMs": self.max_gap_ms}
+
+
+def from_json(json_dict: Optional[dict]) -> InterpolationPolicy:
+    """Deserializes a policy from json, defaulting anything missing."""
+    json_dict = json_object(json_dict, "Interpolation")
+    return InterpolationPolicy(
+        json_dict.get("targetFps", 0),
+        json_dict.get("maxGapMs", DEFAULT_MAX_GAP_MS),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _weight_tables(step: int) -> tuple[bytes, bytes]:
+    # The earlier frame's table rounds up and the later frame's down, so the two sum to at
+    # most 255, and to exactly the channel where both frames have the same value
+    return (
+        bytes(value - value * step // BLEND_STEPS for value in range(256)),
+        bytes(value * step // BLEND_STEPS for value in range(256)),
+    )
+
+
+def interpolate(previous: Union[bytes, bytearray, memoryview],
+                following: Union[bytes, bytearray, memoryview],
+                fraction: float) -> bytes:
+    """
+    The pixels fraction of the way from previous to following, for as many LEDs as both
+    have.
+    """
+    step = min(BLEND_STEPS, max(0, round(fraction * BLEND_STEPS)))
+    length = min(len(previous), len(following))
+    previous_table, following_table = _weight_tables(step)
+    scaled_previous = bytes(previous[:length]).translate(previous_table)
+    scaled_following = bytes(following[:length]).translate(following_table)
+    total = int.from_bytes(scaled_previous, "big") + int.from_bytes(scaled_following, "big")
+    return total.to_bytes(length, "big")
@@ -0,0 +1,74 @@
+"""
+The lateness policy of a pin. Decides which buffered frames the renderer shows, skips or
+drops once the pipeline falls behind.
+"""
+
+from typing import Optional
+
+from validation_result import ValidationResult, json_object
+
+# Shows the latest due frame and skips older due frames, so an overloaded pin drops
+# frames instead of falling further behind
+LATENESS_CATCH_UP = "catchUp"
+# Shows frames only within window_ms of their timestamp, the rest are dropped
+LATENESS_STRICT = "strict"
+# Shows every frame in order until it is more than max_lateness_ms late
+LATENESS_IN_ORDER = "inOrder"
+LATENESS_MODES = (LATENESS_CATCH_UP, LATENESS_STRICT, LATENESS_IN_ORDER)
+
+DEFAULT_WINDOW_MS = 10
+DEFAULT_MAX_LATENESS_MS = 250
+
+
+class LatenessPolicy:
+    """How late a pin's frames may be shown, and which are skipped when it falls behind."""
+
+    # One of LATENESS_MODES
+    mode: str
+    # How many milliseconds after its timestamp a frame is still shown in strict mode
+    window_ms: int
+    # How many milliseconds after its timestamp a frame is still shown in the other modes
+    max_lateness_ms: int
+
+    def __init__(self,
+                 mode: str = LATENESS_STRICT,
+                 window_ms: int = DEFAULT_WINDOW_MS,
+                 max_lateness_ms: int = DEFAULT_MAX_LATENESS_MS):
+        self.mode = mode
+        self.window_ms = window_ms
+        self.max_lateness_ms = max_lateness_ms
+
+    def late_limit_ms(self) -> int:
+        """Frames more than this many milliseconds late are dropped."""
+        return self.window_ms if self.mode == LATENESS_STRICT else self.max_lateness_ms
+
+    def check_validity(self) -> ValidationResult:
+        """Validates this policy."""
+        if self.mode not in LATENESS_MODES:
+            return ValidationResult(
+                False, "Lateness policy mode must be one of " + ", ".join(LATENESS_MODES)
+            )
+        if (not isinstance(self.window_ms, int) or not isinstance(self.max_lateness_ms, int)
+                or self.window_ms < 0 or self.max_lateness_ms < 0):
+            return ValidationResult(
+                False, "Lateness policy windowMs and maxLatenessMs must not be negative"
+            )
+        return ValidationResult(True, "")
+
+    def to_dict(self) -> dict:
+        """The JSON serializable form of this policy."""
+        return {
+            "mode": self.mode,
+            "windowMs": self.window_ms,
+            "maxLatenessMs": self.max_lateness_ms,
+        }
+
+
+def from_json(json_dict: Optional[dict]) -> LatenessPolicy:
+    """Deserializes a policy from json, defaulting anything missing."""
+    json_dict = json_object(json_dict, "Lateness policy")
+    return LatenessPolicy(
+        json_dict.get("mode", LATENESS_STRICT),
+        json_dict.get("windowMs", DEFAULT_WINDOW_MS),
+        json_dict.get("maxLatenessMs", DEFAULT_MAX_LATENESS_MS),
+    )
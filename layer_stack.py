@@ -0,0 +1,210 @@
+"""
+Layer compositing. Each pin has a base layer, which streamed frames draw by default, and up
+to MAX_LAYER overlay layers drawn over it, each with an opacity, a blend mode and a priority.
+Frames select their layer with bits 3 to 5 of the options byte, so a notification or a local
+effect can show over a streamed base layer without the sender redrawing it.
+
+Black LEDs of an overlay are transparent in every blend mode, so an overlay only covers the
+LEDs it lights.
+"""
+
+from typing import Optional, Union
+
+from pixel_transform import optional_numpy
+from rgb_frame import MAX_LAYER
+from validation_result import ValidationResult
+
+# pylint: disable=too-few-public-methods
+
+# The overlay's color
+BLEND_NORMAL = "normal"
+# The sum of both colors, clipped to white
+BLEND_ADD = "add"
+# The inverse of the product of the inverses, which lightens like two projectors
+BLEND_SCREEN = "screen"
+# The product of both colors, which darkens
+BLEND_MULTIPLY = "multiply"
+# The brighter of both colors, per channel
+BLEND_LIGHTEN = "lighten"
+BLEND_MODES = (BLEND_NORMAL, BLEND_ADD, BLEND_SCREEN, BLEND_MULTIPLY, BLEND_LIGHTEN)
+
+# Below this many LEDs the per LED fallback is as fast as NumPy, whose per call overhead
+# dominates. Far below pixel_transform's NUMPY_MIN_LEDS, as the fallback here is a Python
+# loop rather than bytes.translate
+NUMPY_BLEND_MIN_LEDS = 16
+
+# Each channel of the blended color, from the base's and the overlay's
+_CHANNEL_BLENDS = {
+    BLEND_NORMAL: lambda base, over: over,
+    BLEND_ADD: lambda base, over: min(255, base + over),
+    BLEND_SCREEN: lambda base, over: 255 - (255 - base) * (255 - over) // 255,
+    BLEND_MULTIPLY: lambda base, over: base * over // 255,
+    BLEND_LIGHTEN: max,
+}
+
+
+class LayerSettings:
+    """How an overlay layer of a pin is drawn over the layers below it."""
+
+    pin: str
+    # 1 to MAX_LAYER, the base layer is always drawn first and as it is
+    layer: int
+    # One of BLEND_MODES
+    blend: str
+    # 0.0 to 1.0, how much of the blended color shows over the layers below
+    opacity: float
+    # Overlays are drawn in ascending priority, those of equal priority by layer
+    priority: int
+    # Removes the overlay and its pixels instead, so the layers below show again
+    remove: bool
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 pin: str,
+                 layer: int,
+                 *,
+                 blend: str = BLEND_NORMAL,
+                 opacity: float = 1.0,
+                 priority: int = 0,
+                 remove: bool = False):
+        self.pin = pin
+        self.layer = layer
+        self.blend = blend
+        self.opacity = opacity
+        self.priority = priority
+        self.remove = remove
+
+    def check_validity(self) -> ValidationResult:
+        """Validates these settings."""
+        if not isinstance(self.layer, int) or not 0 < self.layer <= MAX_LAYER:
+            return ValidationResult(False, "Layer must be between 1 and " + str(MAX_LAYER))
+        if self.blend not in BLEND_MODES:
+            return ValidationResult(False, "Layer blend must be one of " + ", ".join(BLEND_MODES))
+        if not isinstance(self.opacity, (int, float)) or not 0 <= self.opacity <= 1:
+            return ValidationResult(False, "Layer opacity must be between 0 and 1")
+        if not isinstance(self.priority, int):
+            return ValidationResult(False, "Layer priority must be an integer")
+        return ValidationResult(True, "")
+
+    def to_dict(self) -> dict:
+        """The JSON serializable form of these settings."""
+        return {
+            "pin": self.pin,
+            "layer": self.layer,
+            "blend": self.blend,
+            "opacity": self.opacity,
+            "priority": self.priority,
+        }
+
+
+def from_json(json_dict: dict) -> LayerSettings:
+    """Deserializes layer settings from json, defaulting anything missing."""
+    return LayerSettings(
+        str(json_dict.get("pin", "")).strip(),
+        json_dict.get("layer", 0),
+        blend=json_dict.get("blend", BLEND_NORMAL),
+        opacity=json_dict.get("opacity", 1.0),
+        priority=json_dict.get("priority", 0),
+        remove=bool(json_dict.get("remove", False)),
+    )
+
+
+def blend_pixels(base: bytearray, over: Union[bytes, bytearray], mode: str,
+                 opacity: float) -> bytearray:
+    """
+    The base pixels with the overlay pixels blended over them. Both are the same length.
+    Vectorized over the whole buffer with NumPy when it is installed, unless it is small.
+    """
+    alpha = round(opacity * 255)
+    numpy = optional_numpy() if len(over) >= NUMPY_BLEND_MIN_LEDS * 3 else None
+    if numpy is not None:
+        return _blend_numpy(numpy, base, over, mode, alpha)
+    channel_blend = _CHANNEL_BLENDS[mode]
+    blended = bytearray(base)
+    for led in range(0, len(over), 3):
+        if over[led] or over[led + 1] or over[led + 2]:
+            for i in range(led, led + 3):
+                mixed = channel_blend(base[i], over[i])
+                blended[i] = (mixed * alpha + base[i] * (255 - alpha) + 127) // 255
+    return blended
+
+
+def _blend_numpy(numpy, base: bytearray, over: Union[bytes, bytearray], mode: str,
+                 alpha: int) -> bytearray:
+    # uint16 holds every intermediate, 255 * 255 + 127 at most
+    lower = numpy.frombuffer(base, numpy.uint8).astype(numpy.uint16)
+    upper = numpy.frombuffer(over, numpy.uint8).astype(numpy.uint16)
+    if mode == BLEND_ADD:
+        mixed = numpy.minimum(lower + upper, 255)
+    elif mode == BLEND_SCREEN:
+        mixed = 255 - (255 - lower) * (255 - upper) // 255
+    elif mode == BLEND_MULTIPLY:
+        mixed = lower * upper // 255
+    elif mode == BLEND_LIGHTEN:
+        mixed = numpy.maximum(lower, upper)
+    else:
+        mixed = upper
+    if alpha != 255:
+        mixed = (mixed * alpha + lower * (255 - alpha) + 127) // 255
+    # Black overlay LEDs leave the base as it was
+    lit = numpy.repeat(upper.reshape(-1, 3).any(axis=1), 3)
+    return bytearray(numpy.where(lit, mixed, lower).astype(numpy.uint8).tobytes())
+
+
+class LayerStack:
+    """
+    The layers of one pin and the output composed from them. The output is only
+    recomposited when a layer's pixels or settings have changed since it was last composed.
+    """
+
+    leds: int
+
+    def __init__(self, leds: int, settings: Optional[list[LayerSettings]] = None):
+        self.leds = leds
+        # The pixels each layer was last drawn with, layer 0 is the base
+        self._pixels = {0: bytearray(leds * 3)}
+        self._settings = {s.layer: s for s in settings} if settings is not None else {}
+        self._output = self._pixels[0]
+        self._changed = False
+
+    def pixels(self, layer: int) -> bytearray:
+        """The pixels a layer was last drawn with, black if it never was. Not to be modified."""
+        pixels = self._pixels.get(layer)
+        return pixels if pixels is not None else bytearray(self.leds * 3)
+
+    def set_pixels(self, layer: int, pixels: bytearray):
+        """Draws a layer, which takes ownership of pixels."""
+        if self._pixels.get(layer) != pixels:
+            self._pixels[layer] = pixels
+            self._changed = True
+
+    def configure(self, settings: LayerSettings):
+        """Changes how an overlay is drawn, or removes it."""
+        if settings.remove:
+            self._settings.pop(settings.layer, None)
+            self._pixels.pop(settings.layer, None)
+        else:
+            self._settings[settings.layer] = settings
+        self._changed = True
+
+    def settings(self) -> list[LayerSettings]:
+        """The settings of the overlays which have any."""
+        return list(self._settings.values())
+
+    def composite(self) -> bytearray:
+        """The base layer with every overlay drawn over it. Not to be modified."""
+        if not self._changed:
+            return self._output
+        overlays = [
+            self._settings.get(layer) or LayerSettings("", layer)
+            for layer in self._pixels
+            if layer != 0
+        ]
+        output = self._pixels[0]
+        for settings in sorted(overlays, key=lambda s: (s.priority, s.layer)):
+            if settings.opacity > 0:
+                output = blend_pixels(output, self._pixels[settings.layer], settings.blend,
+                                      settings.opacity)
+        self._output = output
+        self._changed = False
+        return output
@@ -3,9 +3,24 @@ The NeoPixel config object.
 """
 
 import json
+from typing import Optional
 
+import buffer_policy as buffering
+import color_correction as correction
+import interpolation as interpolating
+import lateness_policy as lateness
+from buffer_policy import BufferPolicy
+from color_correction import ColorCorrection
+from interpolation import InterpolationPolicy
+from lateness_policy import LatenessPolicy
+from rgb_frame import MAX_LEDS
 from validation_result import ValidationResult
 
+# pylint: disable=too-many-instance-attributes
+
+# The data pins LED strips can be connected to
+PINS = ("D10", "D12", "D18", "D21")
+
 
 class NeoPixelConfig:
     """Config class for NeoPixel LED strips"""
@@ -21,19 +36,51 @@ class NeoPixelConfig:
     # Int value from 0 to 100 representing the brightness of these LEDs
     brightness: int
 
-    def __init__(self, uuid: str, pin: str, leds: int, brightness: int):
+    # Which frames are shown, skipped or dropped when rendering falls behind
+    lateness_policy: LatenessPolicy
+
+    # Gamma, white balance and channel order applied to every frame
+    color_correction: ColorCorrection
+
+    # How much memory buffered frames may take, and what happens when they don't fit
+    buffer_policy: BufferPolicy
+
+    # Whether frames blended between buffered frames are shown, and how often
+    interpolation: InterpolationPolicy
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 uuid: str,
+                 pin: str,
+                 leds: int,
+                 brightness: int,
+                 *,
+                 lateness_policy: Optional[LatenessPolicy] = None,
+                 color_correction: Optional[ColorCorrection] = None,
+                 buffer_policy: Optional[BufferPolicy] = None,
+                 interpolation: Optional[InterpolationPolicy] = None):
         self.uuid = uuid
         self.pin = pin
         self.leds = leds
         self.brightness = brightness
+        self.lateness_policy = (
+            lateness_policy if lateness_policy is not None else LatenessPolicy()
+        )
+        self.color_correction = (
+            color_correction if color_correction is not None else ColorCorrection()
+        )
+        self.buffer_policy = buffer_policy if buffer_policy is not None else BufferPolicy()
+        self.interpolation = (
+            interpolation if interpolation is not None else InterpolationPolicy()
+        )
 
     def check_validity(self) -> ValidationResult:
         """Validates this config."""
         if self.uuid.isspace() or len(self.uuid) == 0:
             return ValidationResult(False, "LED strip id must be non-blank")
-        if self.leds < 1:
+        if not 0 < self.leds <= MAX_LEDS:
             return ValidationResult(
-                False, "LED strip " + self.uuid + " must have more than 0 LEDs."
+                False, "LED strip " + self.uuid + " must have 1 to " + str(MAX_LEDS) + " LEDs."
             )
         if self.brightness < 0 or self.brightness > 100:
             return ValidationResult(
@@ -42,16 +89,17 @@ class NeoPixelConfig:
                 + self.uuid
                 + " must have a brightness value between 0 and 100.",
             )
-        if (
-            not self.pin == "D10"
-            and not self.pin == "D12"
-            and not self.pin == "D18"
-            and not self.pin == "D21"
-        ):
+        if self.pin not in PINS:
             return ValidationResult(
                 False,
                 "LED strip " + self.uuid + " must be assined to pin D10, D12, D18 or D21",
             )
+        for result in (self.lateness_policy.check_validity(),
+                       self.buffer_policy.check_validity(self.leds),
+                       self.color_correction.check_validity(),
+                       self.interpolation.check_validity()):
+            if not result.valid:
+                return result
         return ValidationResult(True, "")
 
     def to_json(self) -> str:
@@ -62,14 +110,26 @@ class NeoPixelConfig:
                 "pin": self.pin,
                 "leds": self.leds,
                 "brightness": self.brightness,
+                "latenessPolicy": self.lateness_policy.to_dict(),
+                "colorCorrection": self.color_correction.to_dict(),
+                "bufferPolicy": self.buffer_policy.to_dict(),
+                "interpolation": self.interpolation.to_dict(),
             }
         )
 
 
 def from_json(json_dict: dict) -> NeoPixelConfig:
-    """Serializes a config from json."""
+    """Serializes a config from json. Raises ValueError if it or a policy isn't an object."""
+    if not isinstance(json_dict, dict):
+        raise ValueError("Config must be an object")
     uuid = json_dict.get("uuid", "").strip()
     pin = json_dict.get("pin", "").strip()
     leds = json_dict.get("leds", 0)
     brightness = json_dict.get("brightness", 0)
-    return NeoPixelConfig(uuid, pin, leds, brightness)
+    lateness_policy = lateness.from_json(json_dict.get("latenessPolicy"))
+    color_correction = correction.from_json(json_dict.get("colorCorrection"))
+    buffer_policy = buffering.from_json(json_dict.get("bufferPolicy"))
+    interpolation = interpolating.from_json(json_dict.get("interpolation"))
+    return NeoPixelConfig(uuid, pin, leds, brightness,
+                          lateness_policy=lateness_policy, color_correction=color_correction,
+                          buffer_policy=buffer_policy, interpolation=interpolation)
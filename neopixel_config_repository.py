@@ -2,28 +2,80 @@
 The SQLite repository. Does CRUD operations for config objects in the database.
 """
 
+import contextlib
+import json
 import logging
+import os
 import sqlite3
+import threading
+from typing import Iterator, Optional
 
+import buffer_policy as buffering
+import interpolation as interpolating
+import color_correction as correction
+import lateness_policy as lateness
 import neopixel_config as np_config
+import virtual_strip
 
 # Surpressing lint to allow catching more types of exceptions
 # pylint: disable=broad-exception-caught
 
+# Columns added after the table was first released, which older databases lack
+ADDED_COLUMNS = {
+    "lateness_policy": "TEXT",
+    "color_correction": "TEXT",
+    "buffer_policy": "TEXT",
+    "interpolation": "TEXT",
+}
+
+CONFIG_COLUMNS = (
+    "uuid, pin, leds, brightness, lateness_policy, color_correction, buffer_policy, "
+    "interpolation"
+)
+
 class NeoPixelConfigRepository:
-    """SQL Lite access class"""
+    """
+    SQL Lite access class. Keeps one connection open, and serves reads from an in-memory
+    copy of the table which every write invalidates.
+    """
 
     database_name: str
     logger: logging.Logger
+    # Configs by uuid, None until loaded and after each write
+    _by_uuid: Optional[dict[str, np_config.NeoPixelConfig]]
 
     def __init__(self, database_name: str, logger: logging.Logger):
         self.database_name = database_name
         self.logger = logger
+        # Flask serves requests on several threads, which take turns on the connection
+        self._lock = threading.RLock()
+        self._db: Optional[sqlite3.Connection] = None
+        # The process which opened the connection
+        self._db_pid = 0
+        self._by_uuid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Opened on first use. A connection inherited from the process this one was forked
+        # from is left to it and a new one opened, as SQLite connections can't cross a fork
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.database_name, check_same_thread=False)
+            self._db_pid = os.getpid()
+            # Readers don't block the writer, and commits don't wait for a full fsync
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        return self._db
+
+    def close(self):
+        """Closes the connection. It is reopened if the repository is used again."""
+        with self._lock:
+            if self._db is not None and self._db_pid == os.getpid():
+                self._db.close()
+            self._db = None
 
     def create(self):
         """Creates the table if it doesn't exist"""
         try:
-            with sqlite3.connect(self.database_name) as connection:
+            with self._writing() as connection:
                 cursor = connection.cursor()
                 cursor.execute(
                     """CREATE TABLE IF NOT EXISTS configs
@@ -31,7 +83,21 @@ class NeoPixelConfigRepository:
                                 uuid TEXT NOT NULL UNIQUE, 
                                 leds INTEGER NOT NULL, 
                                 pin INTEGER NOT NULL UNIQUE, 
-                                brightness INTEGER NOT NULL)"""
+                                brightness INTEGER NOT NULL,
+                                lateness_policy TEXT,
+                                color_correction TEXT,
+                                buffer_policy TEXT,
+                                interpolation TEXT)"""
+                )
+                cursor.execute("PRAGMA table_info(configs)")
+                columns = [row[1] for row in cursor.fetchall()]
+                for column, column_type in ADDED_COLUMNS.items():
+                    if column not in columns:
+                        cursor.execute(f"ALTER TABLE configs ADD COLUMN {column} {column_type}")
+                cursor.execute(
+                    """CREATE TABLE IF NOT EXISTS virtual_strips
+                                (id TEXT PRIMARY KEY NOT NULL,
+                                segments TEXT NOT NULL)"""
                 )
                 connection.commit()
         except sqlite3.Error as e:
@@ -40,31 +106,55 @@ class NeoPixelConfigRepository:
             self.logger.error(f"Error {e}")
 
     def get_configs(self) -> list[np_config.NeoPixelConfig]:
-        """Gets all configs from the database"""
-        config_list = list[np_config.NeoPixelConfig]()
+        """Gets all configs, from memory unless the table changed since they were read"""
+        with self._lock:
+            if self._by_uuid is None:
+                self._load()
+            return list(self._by_uuid.values()) if self._by_uuid is not None else []
+
+    def get_config(self, uuid: str) -> Optional[np_config.NeoPixelConfig]:
+        """Gets the config with a uuid, or None if there is none"""
+        with self._lock:
+            if self._by_uuid is not None:
+                return self._by_uuid.get(uuid)
+            return self._select_by_uuid(uuid)
+
+    def _load(self):
         try:
-            with sqlite3.connect(self.database_name) as connection:
-                cursor = connection.cursor()
-                cursor.execute(
-                    "SELECT uuid, pin, leds, brightness FROM configs"
-                )
-                connection.commit()
+            cursor = self._connection().execute(f"SELECT {CONFIG_COLUMNS} FROM configs")
+            config_list = [_to_config(result) for result in cursor]
+            self._by_uuid = {config.uuid: config for config in config_list}
+        except sqlite3.Error as e:
+            self.logger.error(f"sqlite3 error {e}")
+        except Exception as e:
+            self.logger.error(f"Error {e}")
 
-                for result in cursor:
-                    config = np_config.NeoPixelConfig(
-                        result[0], result[1], result[2], result[3]
-                    )
-                    config_list.append(config)
+    def _select_by_uuid(self, uuid: str) -> Optional[np_config.NeoPixelConfig]:
+        # uuid is UNIQUE, so SQLite looks it up by index
+        try:
+            cursor = self._connection().execute(
+                f"SELECT {CONFIG_COLUMNS} FROM configs WHERE uuid = ?", (uuid,)
+            )
+            result = cursor.fetchone()
+            return _to_config(result) if result is not None else None
         except sqlite3.Error as e:
             self.logger.error(f"sqlite3 error {e}")
         except Exception as e:
             self.logger.error(f"Error {e}")
-        return config_list
+        return None
+
+    @contextlib.contextmanager
+    def _writing(self) -> Iterator[sqlite3.Connection]:
+        # A transaction which invalidates the in-memory configs, committed when it exits
+        with self._lock:
+            self._by_uuid = None
+            with self._connection() as connection:
+                yield connection
 
     def save_config(self, config: np_config.NeoPixelConfig):
         """Saves a new config to the database"""
         try:
-            with sqlite3.connect(self.database_name) as connection:
+            with self._writing() as connection:
                 cursor = connection.cursor()
                 cursor.execute("SELECT id FROM configs ORDER BY id DESC LIMIT 1")
                 connection.commit()
@@ -74,9 +164,15 @@ class NeoPixelConfigRepository:
                 if sql_id == 0:
                     sql_id = 1
                 cursor.execute(
-                    """INSERT INTO configs (id, uuid, leds, pin, brightness) 
-                    VALUES (?, ?, ?, ?, ?)""",
-                    (sql_id, config.uuid, config.leds, config.pin, config.brightness),
+                    """INSERT INTO configs
+                    (id, uuid, leds, pin, brightness, lateness_policy, color_correction,
+                    buffer_policy, interpolation)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (sql_id, config.uuid, config.leds, config.pin, config.brightness,
+                     json.dumps(config.lateness_policy.to_dict()),
+                     json.dumps(config.color_correction.to_dict()),
+                     json.dumps(config.buffer_policy.to_dict()),
+                     json.dumps(config.interpolation.to_dict())),
                 )
                 connection.commit()
         except sqlite3.Error as e:
@@ -87,12 +183,16 @@ class NeoPixelConfigRepository:
     def update_config(self, config: np_config.NeoPixelConfig):
         """Updates an existing config in the database"""
         try:
-            with sqlite3.connect(self.database_name) as connection:
+            with self._writing() as connection:
                 cursor = connection.cursor()
                 cursor.execute(
-                    """UPDATE configs SET leds = ?, pin = ?, brightness = ?) 
-                    WHERE uuid = ?""",
-                    (config.leds, config.pin, config.brightness, config.uuid),
+                    """UPDATE configs SET leds = ?, pin = ?, brightness = ?, lateness_policy = ?,
+                    color_correction = ?, buffer_policy = ?, interpolation = ? WHERE uuid = ?""",
+                    (config.leds, config.pin, config.brightness,
+                     json.dumps(config.lateness_policy.to_dict()),
+                     json.dumps(config.color_correction.to_dict()),
+                     json.dumps(config.buffer_policy.to_dict()),
+                     json.dumps(config.interpolation.to_dict()), config.uuid),
                 )
                 connection.commit()
         except sqlite3.Error as e:
@@ -103,7 +203,7 @@ class NeoPixelConfigRepository:
     def delete_config(self, light_id: str):
         """Delets a config from the database"""
         try:
-            with sqlite3.connect(self.database_name) as connection:
+            with self._writing() as connection:
                 cursor = connection.cursor()
                 cursor.execute(
                     "DELETE FROM configs WHERE uuid = ?",
@@ -114,3 +214,55 @@ class NeoPixelConfigRepository:
             self.logger.error(f"sqlite3 error {e}")
         except Exception as e:
             self.logger.error(f"Error {e}")
+
+    def get_virtual_strips(self) -> list[virtual_strip.VirtualStrip]:
+        """Gets all virtual strips"""
+        try:
+            with self._lock:
+                cursor = self._connection().execute("SELECT id, segments FROM virtual_strips")
+                return [
+                    virtual_strip.from_json({"id": result[0], "segments": json.loads(result[1])})
+                    for result in cursor
+                ]
+        except sqlite3.Error as e:
+            self.logger.error(f"sqlite3 error {e}")
+        except Exception as e:
+            self.logger.error(f"Error {e}")
+        return []
+
+    def save_virtual_strip(self, strip: virtual_strip.VirtualStrip):
+        """Saves a virtual strip, replacing any with the same id"""
+        try:
+            with self._writing() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO virtual_strips (id, segments) VALUES (?, ?)",
+                    (strip.strip_id, json.dumps(strip.to_dict()["segments"])),
+                )
+                connection.commit()
+        except sqlite3.Error as e:
+            self.logger.error(f"sqlite3 error {e}")
+        except Exception as e:
+            self.logger.error(f"Error {e}")
+
+    def delete_virtual_strip(self, strip_id: str):
+        """Deletes a virtual strip"""
+        try:
+            with self._writing() as connection:
+                connection.execute("DELETE FROM virtual_strips WHERE id = ?", (strip_id,))
+                connection.commit()
+        except sqlite3.Error as e:
+            self.logger.error(f"sqlite3 error {e}")
+        except Exception as e:
+            self.logger.error(f"Error {e}")
+
+
+def _to_config(result: tuple) -> np_config.NeoPixelConfig:
+    policy = lateness.from_json(json.loads(result[4]) if result[4] else None)
+    colors = correction.from_json(json.loads(result[5]) if result[5] else None)
+    buffer = buffering.from_json(json.loads(result[6]) if result[6] else None)
+    upsampling = interpolating.from_json(json.loads(result[7]) if result[7] else None)
+    return np_config.NeoPixelConfig(
+        result[0], result[1], result[2], result[3],
+        lateness_policy=policy, color_correction=colors, buffer_policy=buffer,
+        interpolation=upsampling
+    )
@@ -1,135 +1,497 @@
 """
-The renderer class. Sends specified color data to the LED strip using the neopixel package.
+The renderer class. Sends specified color data to the LED strips, by default using the
+neopixel package.
 """
 
-from datetime import datetime
+import time
 from logging import Logger
+from typing import Optional
 
-import board
-from neopixel import NeoPixel
-
+from buffer_policy import OVERFLOW_BACKPRESSURE, OVERFLOW_EVICT_OLDEST, BufferPolicy
+from effects import EFFECT_NONE, EffectDescriptor, RunningEffect, create_effect, frame_period
+from frame_ack import MAX_RETRY_AFTER_MS
+from frame_clock import FrameClock
+from frame_recording import FramePlayer, FrameRecording, PlaybackRequest, recording_path
+from frame_scheduler import FrameScheduler
+from interpolation import InterpolationPolicy, interpolate
+from lateness_policy import LATENESS_CATCH_UP, LatenessPolicy
+from layer_stack import LayerSettings, LayerStack
 from neopixel_config import NeoPixelConfig
-from rgb_frame import RgbFrame
+from pixel_diff import changed_led_span
+from pixel_transform import PixelTransform
+from render_metrics import RenderMetrics
+from rgb_frame import RgbFrame, RgbFrameOptions, layer_key
+from strip_backends import Strip, StripFactory, neopixel_strip
+from virtual_strip import SegmentMap, VirtualStrip
+
+
+# Frames are rendered up to this many milliseconds before their timestamp
+RENDER_EARLY_MS = 1
+# Recorded frames are buffered this many milliseconds before they are due
+PLAYBACK_LOOKAHEAD_MS = 200
 
 
 class NeoPixelRenderer:
-    neopixels = dict[str, NeoPixel]()
-    buffered_frames = list[RgbFrame]()
+    neopixels: dict[str, Strip]
+    strip_factory: StripFactory
+    # The pixel data last written to each strip, so unchanged frames can be skipped
+    rendered_pixels: dict[str, bytearray]
+    # The base and overlay layers of each pin, which are composed into what it shows
+    layer_stacks: dict[str, LayerStack]
+    frame_scheduler: FrameScheduler
+    lateness_policies: dict[str, LatenessPolicy]
+    # The color correction, brightness and color order applied to each pin's frames
+    transforms: dict[str, PixelTransform]
+    # The current config of each pin
+    configs: dict[str, NeoPixelConfig]
+    # The effect running on each layer of each pin by layer_key(), until frames are
+    # streamed to that layer
+    effects: dict[str, RunningEffect]
+    # The last buffered base layer frame shown on each pin which interpolates, and when its
+    # next interpolated frame is due, in milliseconds since the epoch
+    key_frames: dict[str, RgbFrame]
+    next_interpolation_at: dict[str, float]
+    # The recording being played back, if any
+    playback: Optional[FramePlayer]
+    # Where the frames of each virtual strip go, for the current strips' LED counts
+    segment_map: SegmentMap
+    clock: FrameClock
+    metrics: RenderMetrics
     logger: Logger
 
-    def __init__(self, logger: Logger):
+    def __init__(self,
+                 logger: Logger,
+                 strip_factory: StripFactory = neopixel_strip,
+                 metrics: Optional[RenderMetrics] = None,
+                 clock: Optional[FrameClock] = None):
         self.logger = logger
+        self.strip_factory = strip_factory
+        self.metrics = metrics if metrics is not None else RenderMetrics()
+        self.clock = clock if clock is not None else FrameClock()
+        self.neopixels = dict[str, Strip]()
+        self.rendered_pixels = dict[str, bytearray]()
+        self.layer_stacks = dict[str, LayerStack]()
+        self.frame_scheduler = FrameScheduler()
+        self.lateness_policies = dict[str, LatenessPolicy]()
+        self.transforms = dict[str, PixelTransform]()
+        self.configs = dict[str, NeoPixelConfig]()
+        self.effects = dict[str, RunningEffect]()
+        self.key_frames = dict[str, RgbFrame]()
+        self.next_interpolation_at = dict[str, float]()
+        self.playback = None
+        self.segment_map = SegmentMap([], {})
 
     def update_config(self, config: NeoPixelConfig):
-        if config.pin in self.neopixels:
-            np = self.neopixels.pop(config.pin)
-            np.deinit()
-        np = self.__neopixel_from_config(config)
-        self.neopixels[config.pin] = np
+        """
+        Applies a config, changing only what differs from the pin's current config.
+        The strip is only recreated when its LED count changes, and buffered frames are kept.
+        """
+        # A config moved to another pin frees its old one
+        moved_from = [pin for pin, current in self.configs.items()
+                      if current.uuid == config.uuid and pin != config.pin]
+        for pin in moved_from:
+            self.remove_pin(pin)
+        current = self.configs.get(config.pin)
+        self.configs[config.pin] = config
+        self.lateness_policies[config.pin] = config.lateness_policy
+        if current is None or current.leds != config.leds:
+            self._create_strip(config)
+        elif (current.brightness != config.brightness
+              or current.color_correction.to_dict() != config.color_correction.to_dict()):
+            self.set_brightness(config.pin, config.brightness)
+        if (current is None or current.leds != config.leds
+                or current.buffer_policy.to_dict() != config.buffer_policy.to_dict()):
+            self._configure_buffer(config)
+        if current is None or current.leds != config.leds:
+            self._build_segment_map(list(self.segment_map.strips.values()))
+        if (current is not None
+                and current.interpolation.to_dict() != config.interpolation.to_dict()):
+            self._stop_interpolating(config.pin)
 
     def update_configs(self, config_list: list[NeoPixelConfig]):
-        # deinit all neopixels to free up the GPIO pins
-        for key in self.neopixels:
-            self.neopixels[key].deinit()
+        """Applies the full list of configs. Pins missing from it are freed."""
+        pins = {config.pin for config in config_list}
+        for pin in [p for p in self.neopixels if p not in pins]:
+            self.remove_pin(pin)
+        for config in config_list:
+            self.update_config(config)
 
-        self.neopixels.clear()
+    def remove_pin(self, pin: str):
+        """Frees a pin's GPIO and drops its buffered frames, effect and state."""
+        np = self.neopixels.pop(pin, None)
+        if np is not None:
+            np.deinit()
+        self.frame_scheduler.remove(pin)
+        for state in (self.rendered_pixels, self.layer_stacks, self.lateness_policies,
+                      self.transforms, self.configs):
+            state.pop(pin, None)
+        self._stop_interpolating(pin)
+        for key in [k for k, running in self.effects.items() if running.descriptor.pin == pin]:
+            del self.effects[key]
+        if self.playback is not None:
+            self.playback.pins.discard(pin)
+        self._build_segment_map(list(self.segment_map.strips.values()))
 
-        # Add configured NeoPixels to the dictionary
-        for config in config_list:
-            np = self.__neopixel_from_config(config)
-            self.neopixels[config.pin] = np
-
-        # Remove any buffered frames for NeoPixels which have been removed from the config
-        i = 0
-        while i < len(self.buffered_frames):
-            frame = self.buffered_frames[i]
-            keep_in_buffer = False
-            for pin in self.neopixels:
-                keep_in_buffer |= frame.pin == pin
-            if keep_in_buffer:
-                i += 1
-            else:
-                self.buffered_frames.remove(frame)
+    def _create_strip(self, config: NeoPixelConfig):
+        # deinit first to free up the GPIO pin
+        if config.pin in self.neopixels:
+            self.neopixels.pop(config.pin).deinit()
+        self.rendered_pixels.pop(config.pin, None)
+        self.neopixels[config.pin] = self.strip_factory(config)
+        self.transforms[config.pin] = PixelTransform(config.color_correction, config.brightness)
+        # The layers start black at the new LED count, overlays keep their settings
+        previous = self.layer_stacks.get(config.pin)
+        self.layer_stacks[config.pin] = LayerStack(
+            config.leds, previous.settings() if previous is not None else None
+        )
+        # Rebuild the running effects for the new LED count
+        for running in [r for r in self.effects.values() if r.descriptor.pin == config.pin]:
+            self.start_effect(running.descriptor)
 
-    def clear_buffer(self, pin: str):
-        self.buffered_frames[:] = [
-            f for f in self.buffered_frames if getattr(f, "pin", None) != pin
-        ]
+    def _configure_buffer(self, config: NeoPixelConfig):
+        # Storage for as many frames of the strip's length as the policy's budget holds
+        capacity = config.buffer_policy.capacity(config.leds)
+        overflow = self.frame_scheduler.configure(config.pin, capacity, config.leds * 3)
+        if overflow:
+            self.metrics.increment("evicted_frames_total", config.pin, overflow)
+
+    def update_virtual_strips(self, strips: list[VirtualStrip]):
+        """Replaces the virtual strips. Frames buffered for removed ones are dropped."""
+        ids = {strip.strip_id for strip in strips}
+        for strip_id in [s for s in self.segment_map.strips if s not in ids]:
+            self.frame_scheduler.remove(strip_id)
+        for strip in strips:
+            # Virtual strips buffer their frames under the default buffer policy
+            capacity = BufferPolicy().capacity(strip.leds)
+            self.frame_scheduler.configure(strip.strip_id, capacity, strip.leds * 3)
+        self._build_segment_map(strips)
+
+    def _build_segment_map(self, strips: list[VirtualStrip]):
+        self.segment_map = SegmentMap(strips, {pin: np.n for pin, np in self.neopixels.items()})
+
+    def start_effect(self, descriptor: EffectDescriptor):
+        """
+        Runs an effect on its pin's layer in place of any effect running there, or stops it
+        for none.
+        """
+        key = layer_key(descriptor.pin, descriptor.layer)
+        self.effects.pop(key, None)
+        if descriptor.effect_type == EFFECT_NONE:
+            return
+        np = self.neopixels.get(descriptor.pin)
+        if np is None:
+            self.logger.warning("Effect %s for unconfigured pin %s",
+                                descriptor.effect_type, descriptor.pin)
+            return
+        try:
+            effect = create_effect(descriptor, np.n)
+        except ValueError as e:
+            self.logger.error("Invalid effect %s: %s", descriptor.effect_type, str(e))
+            return
+        start = descriptor.start if descriptor.start != 0 else self.clock.now_millis()
+        self.effects[key] = RunningEffect(descriptor, effect, start)
+
+    def configure_layer(self, settings: LayerSettings):
+        """
+        Changes how an overlay of a pin is drawn, or removes it with its buffered frames and
+        effect. The pin shows the change straight away.
+        """
+        stack = self.layer_stacks.get(settings.pin)
+        if stack is None:
+            self.logger.warning("Layer %s for unconfigured pin %s", settings.layer, settings.pin)
+            return
+        if settings.remove:
+            self.frame_scheduler.clear(settings.pin, settings.layer)
+            self.effects.pop(layer_key(settings.pin, settings.layer), None)
+        stack.configure(settings)
+        self._show(settings.pin, stack.composite())
+
+    def start_playback(self, request: PlaybackRequest):
+        """Plays a recording to the configured pins, replacing any playing. Stops for no name."""
+        self.stop_playback()
+        if not request.name:
+            return
+        try:
+            recording = FrameRecording(recording_path(request.name))
+        except (OSError, ValueError) as e:
+            self.logger.error("Cannot play recording %s: %s", request.name, str(e))
+            return
+        started_at = request.started_at if request.started_at != 0 else self.clock.now_millis()
+        # Recorded frames for virtual strips play to them as well as those for pins
+        targets = set(self.neopixels) | set(self.segment_map.strips)
+        self.playback = FramePlayer(recording, request.start_ms, started_at, targets)
+        self.logger.info("Playing recording %s from %s ms", request.name, request.start_ms)
+
+    def stop_playback(self):
+        """Stops playing a recording. Frames already buffered are still rendered."""
+        if self.playback is not None:
+            self.playback.recording.close()
+            self.playback = None
+
+    def _feed_playback(self, now_as_millis: int):
+        frames = self.playback.frames_until(now_as_millis + PLAYBACK_LOOKAHEAD_MS)
+        if frames:
+            self.queue_frames(frames)
+        if self.playback.finished():
+            self.logger.info("Recording finished")
+            self.stop_playback()
+
+    def clear_buffer(self, pin: str, layer: int = 0):
+        self.frame_scheduler.clear(pin, layer)
 
     def render_frame(self, frame: RgbFrame):
-        np = self.neopixels[frame.pin]
-        frame_length = len(frame.rgb_data)
-        for i in range(np.n if np.n <= frame_length else frame_length):
-            np[i] = frame.rgb_data[i]
-        np.show()
+        self.render_now([frame])
+
+    def render_now(self, frames: list[RgbFrame]):
+        """Shows frames sent to be shown immediately rather than buffered."""
+        # They take over from an effect running on their layer, as buffered frames do
+        for frame in frames:
+            self.effects.pop(layer_key(frame.pin, frame.options.layer), None)
+        self.render_frames(frames)
+
+    def render_frames(self, frames: list[RgbFrame]):
+        """
+        Shows frames for pins and virtual strips. The frames for each layer of a pin are
+        composed into one buffer, then the layers into what the pin shows, so each pin is
+        written and shown at most once. Frames for pins go first, so the segments of virtual
+        strips show over them.
+        """
+        composed = dict[tuple[str, int], bytearray]()
+        for frame in sorted(frames, key=lambda f: f.pin not in self.neopixels):
+            layer = frame.options.layer
+            if frame.pin in self.neopixels:
+                buffer = self._composing(composed, frame.pin, layer)
+                # Frames shorter than the strip leave the rest of its LEDs as they were
+                length = min(len(buffer), frame.led_count * 3)
+                buffer[:length] = frame.pixels[:length]
+            elif frame.pin in self.segment_map.strips:
+                buffers = {
+                    pin: self._composing(composed, pin, layer)
+                    for pin in self.segment_map.pins(frame.pin)
+                    if pin in self.neopixels
+                }
+                self.segment_map.scatter(frame.pin, frame.pixels, buffers)
+            else:
+                self.logger.warning("Frame for unconfigured pin %s", frame.pin)
+                continue
+            self.metrics.increment("rendered_frames_total", frame.pin)
+            if frame.timestamp != 0:
+                self.metrics.observe("lateness_seconds", frame.pin,
+                                     self.clock.seconds_since(frame.timestamp))
+        for (pin, layer), pixels in composed.items():
+            self.layer_stacks[pin].set_pixels(layer, pixels)
+        # A layer drawn with the pixels it already had leaves the composed output as it was
+        for pin in dict.fromkeys(pin for pin, _ in composed):
+            self._show(pin, self.layer_stacks[pin].composite())
+
+    def _composing(self, composed: dict[tuple[str, int], bytearray], pin: str,
+                   layer: int) -> bytearray:
+        # The layer's buffer for this pass, starting from what it was last drawn with
+        if (pin, layer) not in composed:
+            composed[(pin, layer)] = bytearray(self.layer_stacks[pin].pixels(layer))
+        return composed[(pin, layer)]
+
+    def _show(self, pin: str, pixels: bytearray):
+        # Writes only the LEDs which changed since the last show
+        rendered = self.rendered_pixels.get(pin)
+        if rendered is None:
+            start, end = 0, len(pixels) // 3
+        else:
+            span = changed_led_span(rendered, pixels)
+            if span is None:
+                self.metrics.increment("unchanged_frames_total", pin)
+                return
+            start, end = span
+        self.rendered_pixels[pin] = pixels
+        self._write_and_show(pin, start, bytes(pixels[start * 3:end * 3]))
 
     def queue_empty(self):
-        return len(self.buffered_frames) == 0
+        return self.frame_scheduler.empty()
 
-    def queue_frame(self, frame: RgbFrame):
-        self.buffered_frames.append(frame)
-        self.buffered_frames = sorted(
-            self.buffered_frames, key=lambda frame: frame.timestamp
-        )
+    def idle(self) -> bool:
+        """True if no frames are buffered, no effects are running and nothing is playing."""
+        return self.frame_scheduler.empty() and not self.effects and self.playback is None
+
+    def queue_frame(self, frame: RgbFrame) -> bool:
+        """
+        Buffers the frame. Returns False if the pin's buffer is full and its buffer policy
+        doesn't evict buffered frames to make room.
+        """
+        if self.frame_scheduler.free_slots(frame.pin) == 0 and not self._evict(frame.pin):
+            self.metrics.increment("rejected_frames_total", frame.pin)
+            return False
+        # Streamed frames take over from an effect running on their layer
+        self.effects.pop(layer_key(frame.pin, frame.options.layer), None)
+        self.frame_scheduler.push(frame)
+        return True
+
+    def _evict(self, pin: str) -> bool:
+        # Drops the pin's earliest buffered frame if its buffer policy allows
+        if not self._evicts(pin) or self.frame_scheduler.drop_earliest(pin) is None:
+            return False
+        self.metrics.increment("evicted_frames_total", pin)
+        return True
+
+    def retry_after_ms(self, pin: str) -> int:
+        """
+        Milliseconds until a frame rejected for the pin is worth sending again, when the
+        earliest buffered frame is shown and frees its slot, at most MAX_RETRY_AFTER_MS. 0
+        unless the pin's buffer policy applies backpressure.
+        """
+        config = self.configs.get(pin)
+        if config is None or config.buffer_policy.overflow != OVERFLOW_BACKPRESSURE:
+            return 0
+        timestamp = self.frame_scheduler.next_timestamp(pin)
+        if timestamp is None:
+            return 0
+        wait_ms = int(self.clock.seconds_until(timestamp - RENDER_EARLY_MS) * 1000)
+        return max(1, min(wait_ms, MAX_RETRY_AFTER_MS))
+
+    def next_frame_timeout(self) -> Optional[float]:
+        """
+        Seconds until the next buffered, effect or recorded frame is due, None if nothing is
+        buffered, running or playing.
+        """
+        due = [running.next_frame_at for running in self.effects.values()]
+        # Only pins with a buffered frame to interpolate towards
+        due.extend(at for pin, at in self.next_interpolation_at.items()
+                   if self.frame_scheduler.count(pin))
+        if self.playback is not None:
+            # Recorded frames are buffered ahead of when they are due
+            due.append(self.playback.next_timestamp() - PLAYBACK_LOOKAHEAD_MS + RENDER_EARLY_MS)
+        timestamp = self.frame_scheduler.next_timestamp()
+        if timestamp is not None:
+            due.append(timestamp)
+        if not due:
+            return None
+        return self.clock.seconds_until(min(due) - RENDER_EARLY_MS)
+
+    def queue_frames(self, frames: list[RgbFrame]) -> list[bool]:
+        """Buffers many frames in one pass. Returns whether each frame was accepted."""
+        if any(self._evicts(frame.pin) for frame in frames):
+            # Each eviction has to see the frames of the batch buffered before it
+            return [self.queue_frame(frame) for frame in frames]
+        accepted = self.frame_scheduler.push_many(frames)
+        for frame, frame_accepted in zip(frames, accepted):
+            if frame_accepted:
+                self.effects.pop(layer_key(frame.pin, frame.options.layer), None)
+            else:
+                self.metrics.increment("rejected_frames_total", frame.pin)
+        return accepted
+
+    def _evicts(self, pin: str) -> bool:
+        config = self.configs.get(pin)
+        return config is not None and config.buffer_policy.overflow == OVERFLOW_EVICT_OLDEST
 
     def render_queue(self):
-        now = datetime.now()
-        now_as_millis = int(now.timestamp() * 1000)
-        # Render the frame in the queue if it is within a 100th of a second
-        threshold = int((1 / 100) * 1000)
-        i = 0
+        now_as_millis = self.clock.now_millis()
         frames_to_render = list[RgbFrame]()
+        if self.playback is not None:
+            self._feed_playback(now_as_millis)
 
-        while i < len(self.buffered_frames):
-            frame = self.buffered_frames[i]
-            diff = abs(frame.timestamp - now_as_millis)
-            if diff <= threshold:
-                has_frame_with_matching_pin = False
-                for ftr in frames_to_render:
-                    has_frame_with_matching_pin |= ftr.pin == frame.pin
-                if has_frame_with_matching_pin:
-                    i += 1
-                else:
-                    frames_to_render.append(frame)
-                    self.buffered_frames.remove(frame)
-            elif frame.timestamp < (now_as_millis - 1000):
-                # Remove frames with timestamps older than 1 second ago
-                # Somehow it got missed, so remove it from the buffer
+        for pin in self.frame_scheduler.pins():
+            policy = self.lateness_policies.get(pin) or LatenessPolicy()
+            # Frames later than the policy allows can never be shown, remove them
+            late_limit = now_as_millis - policy.late_limit_ms()
+            for timestamp in self.frame_scheduler.drop_before(pin, late_limit):
+                self.metrics.increment("dropped_frames_total", pin)
                 self.logger.warning(
-                    "Buffered frame drop! Frame timestamp: "
-                    + str(frame.timestamp)
-                    + " system time one second ago: "
-                    + str(now_as_millis - 1000)
-                    + " pin: "
-                    + str(frame.pin)
+                    "Buffered frame drop! Frame timestamp: %s system time: %s pin: %s",
+                    timestamp,
+                    now_as_millis,
+                    pin,
                 )
-                self.buffered_frames.remove(frame)
+            # At most one frame per layer of a pin is rendered each pass
+            latest = now_as_millis + RENDER_EARLY_MS
+            if policy.mode == LATENESS_CATCH_UP:
+                # Skip to the newest due frame of each layer rather than falling further behind
+                due = self.frame_scheduler.pop_all_due(pin, latest)
+                newest = {frame.options.layer: frame for frame in due}
+                if len(due) > len(newest):
+                    self.metrics.increment("skipped_frames_total", pin, len(due) - len(newest))
+                frames_to_render.extend(newest.values())
             else:
-                i += 1
+                due = self.frame_scheduler.pop_due_layers(pin, latest)
+                frames_to_render.extend(due)
+            interpolation = self._interpolation(pin)
+            if interpolation is not None:
+                frames_to_render.extend(
+                    self._interpolated_frames(pin, interpolation, due, now_as_millis)
+                )
 
-        for frame in frames_to_render:
-            self.render_frame(frame)
+        frames_to_render.extend(self._due_effect_frames(now_as_millis))
 
-    def set_brightness(self, pin: str, brightness: int):
+        self.render_frames(frames_to_render)
+
+        for pin in self.neopixels:
+            self.metrics.set_gauge("buffered_frames", pin, self.frame_scheduler.count(pin))
+
+    def _interpolation(self, pin: str) -> Optional[InterpolationPolicy]:
+        # The pin's policy if it interpolates, virtual strips never do
+        config = self.configs.get(pin)
+        if config is None or not config.interpolation.enabled:
+            return None
+        return config.interpolation
+
+    def _interpolated_frames(self,
+                             pin: str,
+                             interpolation: InterpolationPolicy,
+                             due: list[RgbFrame],
+                             now_as_millis: int) -> list[RgbFrame]:
+        # A buffered base layer frame shown this pass is the start of the next interpolation,
+        # otherwise a frame is blended between the last one shown and the next buffered one
+        shown = [frame for frame in due if frame.options.layer == 0]
+        period = max(1000 / interpolation.target_fps, frame_period(self.neopixels[pin].n) * 1000)
+        if shown:
+            self.key_frames[pin] = shown[-1]
+            self.next_interpolation_at[pin] = now_as_millis + period
+            return []
+        previous = self.key_frames.get(pin)
+        if previous is None or self.next_interpolation_at.get(pin, 0) > now_as_millis:
+            return []
+        following = self.frame_scheduler.peek(pin)
+        if following is None or following.timestamp - previous.timestamp > interpolation.max_gap_ms:
+            # Nothing to interpolate towards until another frame is buffered
+            self.next_interpolation_at.pop(pin, None)
+            return []
+        self.next_interpolation_at[pin] = now_as_millis + period
+        span = following.timestamp - previous.timestamp
+        fraction = (now_as_millis - previous.timestamp) / span if span > 0 else 1.0
+        pixels = interpolate(previous.pixels, following.pixels, fraction)
+        self.metrics.increment("interpolated_frames_total", pin)
+        # Timestamp 0 as interpolated frames have no deadline to be late for
+        return [RgbFrame(pin, 0, RgbFrameOptions(False), pixels)]
+
+    def _stop_interpolating(self, pin: str):
+        self.key_frames.pop(pin, None)
+        self.next_interpolation_at.pop(pin, None)
+
+    def _due_effect_frames(self, now_as_millis: int) -> list[RgbFrame]:
+        frames = list[RgbFrame]()
+        for running in self.effects.values():
+            if running.next_frame_at > now_as_millis + RENDER_EARLY_MS:
+                continue
+            elapsed = (now_as_millis - running.start) / 1000
+            pixels = running.effect.pixels(max(0.0, elapsed))
+            # Timestamp 0 as effect frames have no deadline to be late for
+            options = RgbFrameOptions(False, running.descriptor.layer)
+            frames.append(RgbFrame(running.descriptor.pin, 0, options, pixels))
+            running.next_frame_at = now_as_millis + frame_period(running.effect.leds) * 1000
+        return frames
+
+    def _write_and_show(self, pin: str, start: int, pixels: bytes):
+        # Only the changed LEDs, corrected in one pass. The NeoPixel library takes a color per
+        # LED through its public slice assignment, so they are handed over as tuples
         np = self.neopixels[pin]
-        np.brightness = brightness / 100
-
-    def __neopixel_from_config(self, config: NeoPixelConfig):
-        pin = self.__board_pin_from_string(config.pin)
-        # Config value is 0-100, NeoPixel API is 0.0-1.0
-        brightness = config.brightness / 100
-        return NeoPixel(pin, config.leds, brightness=brightness, auto_write=False)
-
-    def __board_pin_from_string(self, pin: str):
-        # For Raspberry Pis pin D10 is recommended as the Neopixel data pin
-        # because it can be configured for use without sudo
-        # Add dtparam=spi=on and enable_uart=1 to /boot/firmware/config.txt
-        if pin == "D10":
-            return board.D10
-        if pin == "D12":
-            return board.D12
-        if pin == "D18":
-            return board.D18
-        if pin == "D21":
-            return board.D21
-        return None
+        changed = self.transforms[pin].apply(pixels)
+        np[start:start + len(pixels) // 3] = list(zip(changed[0::3], changed[1::3], changed[2::3]))
+        show_start = time.monotonic()
+        np.show()
+        self.metrics.observe("show_seconds", pin, time.monotonic() - show_start)
+
+    def set_brightness(self, pin: str, brightness: int):
+        """Changes a pin's brightness and shows the current frame again at the new brightness."""
+        self.transforms[pin] = PixelTransform(self.configs[pin].color_correction, brightness)
+        rendered = self.rendered_pixels.get(pin)
+        if rendered is not None:
+            self._write_and_show(pin, 0, bytes(rendered[:self.neopixels[pin].n * 3]))
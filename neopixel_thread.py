@@ -5,43 +5,230 @@ queue for the neopixel_renderer.
 
 import logging
 import multiprocessing as mp
-from queue import Empty
+import threading
+import time
+from queue import Empty, Queue
+from typing import Union
 
 import neopixel_config as npc
+from effects import EffectDescriptor
+from frame_ack import FrameAck
+from frame_recording import PlaybackRequest
+from layer_stack import LayerSettings
 from neopixel_renderer import NeoPixelRenderer
-from rgb_frame import RgbFrame
+from render_channels import RenderChannels
+from render_metrics import MetricsRequest, RenderMetrics
+from rgb_frame import FrameBatch, RgbFrame
+from shared_frame_ring import SharedFrameRef
+from strip_backends import StripFactory, neopixel_strip
+from virtual_strip import SegmentMap, VirtualStrip, VirtualStrips
 
 
-def neopixel_thread(queue: mp.Queue, logger: logging.Logger):
+# Render each pin on its own worker thread, so a slow show() on one strip
+# doesn't delay the frames of the others
+RENDER_WORKER_PER_PIN = False
+
+
+def neopixel_thread(channels: RenderChannels,
+                    logger: logging.Logger,
+                    strip_factory: StripFactory = neopixel_strip):
     """Starts the thread. This will run in the background until the process is killed."""
     logger.info("Starting neopixel thread...")
-    # One hundredth of a second
-    queue_timeout_fast = 1 / 100
-    # One second
-    queue_timeout_slow = 1
-    idle = False
-    renderer = NeoPixelRenderer(logger)
+    # Shared by the render workers of every pin
+    metrics = RenderMetrics()
+    if RENDER_WORKER_PER_PIN:
+        _dispatch_to_workers(channels, logger, strip_factory, metrics)
+    else:
+        renderer = NeoPixelRenderer(logger, strip_factory, metrics, channels.clock)
+        _render_loop(channels.queue, renderer, logger, channels)
+
+
+def _render_loop(queue: Union[mp.Queue, Queue],
+                 renderer: NeoPixelRenderer,
+                 logger: logging.Logger,
+                 channels: RenderChannels):
     while True:
+        # Sleep until the next buffered frame is due or a new message arrives.
+        # With nothing buffered, block until a message arrives.
         try:
-            queue_msg = queue.get(
-                timeout=queue_timeout_fast if not idle else queue_timeout_slow
-            )
+            queue_msg = queue.get(timeout=renderer.next_frame_timeout())
         except Empty:
             queue_msg = None
-        if queue_msg is not None and isinstance(queue_msg, npc.NeoPixelConfig):
-            logger.debug("Received NeoPixelConfig %s", queue_msg.to_json())
-            _update_config(renderer, logger, queue_msg)
-        elif queue_msg is not None and __is_config_list(queue_msg):
-            logger.debug("Received NeoPixelConfig list")
-            for cfg in queue_msg:
-                logger.debug("Config %s", cfg.to_json())
-                _update_config(renderer, logger, cfg)
-        elif queue_msg is not None and isinstance(queue_msg, RgbFrame):
-            _handle_new_frame(renderer, queue_msg)
-        idle = renderer.queue_empty() and queue_msg is None
-        if not renderer.queue_empty():
+        # Handle everything which arrived while rendering before rendering again, so a backlog
+        # is left to the lateness policy instead of building up in the queue
+        while queue_msg is not None:
+            _handle_message(renderer, logger, channels, queue_msg)
+            try:
+                queue_msg = queue.get_nowait()
+            except Empty:
+                queue_msg = None
+        if not renderer.idle():
             renderer.render_queue()
 
+
+def _handle_message(renderer: NeoPixelRenderer,
+                    logger: logging.Logger,
+                    channels: RenderChannels,
+                    queue_msg):
+    ack_queue = channels.ack_queue
+    if isinstance(queue_msg, npc.NeoPixelConfig):
+        logger.debug("Received NeoPixelConfig %s", queue_msg.to_json())
+        _update_config(renderer, logger, queue_msg)
+    elif __is_config_list(queue_msg):
+        logger.debug("Received NeoPixelConfig list")
+        _update_configs(renderer, logger, queue_msg)
+    elif isinstance(queue_msg, RgbFrame):
+        # A single frame pickled onto the queue rather than written to a shared memory ring
+        renderer.metrics.increment("queued_frames_total", queue_msg.pin)
+        _observe_transit(renderer.metrics, [queue_msg])
+        _handle_new_frame(renderer, ack_queue, queue_msg)
+    elif isinstance(queue_msg, FrameBatch):
+        _observe_transit(renderer.metrics, queue_msg.frames)
+        _handle_frame_batch(renderer, ack_queue, queue_msg)
+    elif isinstance(queue_msg, SharedFrameRef):
+        _handle_shared_frame(renderer, logger, channels, queue_msg)
+    elif isinstance(queue_msg, VirtualStrips):
+        logger.debug("Received %s virtual strips", len(queue_msg.strips))
+        _update_virtual_strips(renderer, logger, queue_msg)
+    elif isinstance(queue_msg, EffectDescriptor):
+        logger.debug("Received %s effect for pin %s", queue_msg.effect_type, queue_msg.pin)
+        renderer.start_effect(queue_msg)
+    elif isinstance(queue_msg, LayerSettings):
+        logger.debug("Received layer %s settings for pin %s", queue_msg.layer, queue_msg.pin)
+        renderer.configure_layer(queue_msg)
+    elif isinstance(queue_msg, PlaybackRequest):
+        renderer.start_playback(queue_msg)
+    elif isinstance(queue_msg, MetricsRequest):
+        channels.metrics_queue.put_nowait(renderer.metrics.snapshot())
+
+
+def _handle_shared_frame(renderer: NeoPixelRenderer,
+                         logger: logging.Logger,
+                         channels: RenderChannels,
+                         ref: SharedFrameRef):
+    frame = channels.frame_rings[ref.pin].read(ref)
+    if frame is not None:
+        _observe_transit(renderer.metrics, [frame])
+        _handle_new_frame(renderer, channels.ack_queue, frame)
+        return
+    logger.warning("Shared memory frame %s lost on pin %s", ref.seq, ref.pin)
+    if ref.stream_id != 0:
+        # Rejected, so a client waiting on each frame's ack sends the next
+        channels.ack_queue.put_nowait([FrameAck(ref.stream_id, ref.timestamp, False)])
+
+
+def _dispatch_to_workers(channels: RenderChannels,
+                         logger: logging.Logger,
+                         strip_factory: StripFactory,
+                         metrics: RenderMetrics):
+    """Routes each message to its pin's render worker, which starts with the pin's config."""
+    workers = dict[str, Queue]()
+
+    def start_worker(pin: str) -> Queue:
+        if pin not in workers:
+            workers[pin] = Queue()
+            renderer = NeoPixelRenderer(logger, strip_factory, metrics, channels.clock)
+            threading.Thread(
+                name="render_worker_" + pin,
+                target=_render_loop,
+                args=(workers[pin], renderer, logger, channels),
+                daemon=True,
+            ).start()
+            workers[pin].put_nowait(virtual_strips)
+        return workers[pin]
+
+    # The pin of each config uuid, so a config moved to another pin frees its old one
+    config_pins = dict[str, str]()
+    # The frames of each virtual strip go to the worker of each of its pins
+    virtual_strips = VirtualStrips([])
+    segment_map = SegmentMap([], {})
+    while True:
+        queue_msg = channels.queue.get()
+        if isinstance(queue_msg, npc.NeoPixelConfig):
+            old_pin = config_pins.get(queue_msg.uuid)
+            if old_pin is not None and old_pin != queue_msg.pin and old_pin in workers:
+                workers[old_pin].put_nowait([])
+            config_pins[queue_msg.uuid] = queue_msg.pin
+            start_worker(queue_msg.pin).put_nowait(queue_msg)
+        elif __is_config_list(queue_msg):
+            config_pins = {cfg.uuid: cfg.pin for cfg in queue_msg}
+            for cfg in queue_msg:
+                start_worker(cfg.pin)
+            # Each worker gets the configs of its pin, an empty list frees a removed pin
+            for pin, worker in workers.items():
+                worker.put_nowait([cfg for cfg in queue_msg if cfg.pin == pin])
+        elif isinstance(queue_msg, (RgbFrame, SharedFrameRef, FrameBatch)):
+            _route_frames(workers, logger, channels, segment_map, queue_msg)
+        elif isinstance(queue_msg, (EffectDescriptor, LayerSettings)) and queue_msg.pin in workers:
+            workers[queue_msg.pin].put_nowait(queue_msg)
+        elif isinstance(queue_msg, (PlaybackRequest, VirtualStrips)):
+            # Each worker plays the recorded frames of its own pin, and scatters the frames
+            # of virtual strips into its own pin
+            if isinstance(queue_msg, VirtualStrips):
+                virtual_strips = queue_msg
+                segment_map = SegmentMap(queue_msg.strips, {})
+            for worker in workers.values():
+                worker.put_nowait(queue_msg)
+        elif isinstance(queue_msg, MetricsRequest):
+            channels.metrics_queue.put_nowait(metrics.snapshot())
+
+
+def _route_frames(workers: dict[str, Queue],
+                  logger: logging.Logger,
+                  channels: RenderChannels,
+                  segment_map: SegmentMap,
+                  queue_msg: Union[RgbFrame, SharedFrameRef, FrameBatch]):
+    if isinstance(queue_msg, FrameBatch):
+        frames_by_pin = dict[str, list[RgbFrame]]()
+        for frame in queue_msg.frames:
+            for pin, pin_frame in _fan_out(segment_map, workers, frame):
+                frames_by_pin.setdefault(pin, []).append(pin_frame)
+        pin_messages = [(pin, FrameBatch(frames)) for pin, frames in frames_by_pin.items()]
+    elif isinstance(queue_msg, RgbFrame):
+        pin_messages = _fan_out(segment_map, workers, queue_msg)
+    else:
+        pin_messages = [(queue_msg.pin, queue_msg)]
+
+    for pin, pin_msg in pin_messages:
+        if pin in workers:
+            workers[pin].put_nowait(pin_msg)
+            continue
+        if isinstance(pin_msg, SharedFrameRef):
+            # Reading the frame frees its slot
+            frame = channels.frame_rings[pin].read(pin_msg)
+            frames = [frame] if frame is not None else []
+        else:
+            frames = pin_msg.frames if isinstance(pin_msg, FrameBatch) else [pin_msg]
+        logger.warning("%s frames for unconfigured pin %s dropped", len(frames), pin)
+        acks = [FrameAck(f.stream_id, f.timestamp, False) for f in frames if f.stream_id != 0]
+        if acks:
+            channels.ack_queue.put_nowait(acks)
+
+
+def _fan_out(segment_map: SegmentMap,
+             workers: dict[str, Queue],
+             frame: RgbFrame) -> list[tuple[str, RgbFrame]]:
+    """The worker pins a frame goes to. A virtual strip's frame goes to each of its pins."""
+    pins = [p for p in segment_map.pins(frame.pin) if p in workers]
+    if not pins:
+        return [(frame.pin, frame)]
+    # Only the first worker acknowledges the frame
+    copies = [(pins[0], frame)]
+    for pin in pins[1:]:
+        copy = RgbFrame(frame.pin, frame.timestamp, frame.options, frame.pixels)
+        copy.received_at, copy.queued_at = frame.received_at, frame.queued_at
+        copies.append((pin, copy))
+    return copies
+
+
+def _observe_transit(metrics: RenderMetrics, frames: list[RgbFrame]):
+    now = time.monotonic()
+    for frame in frames:
+        if frame.queued_at != 0:
+            metrics.observe("decode_seconds", frame.pin, frame.queued_at - frame.received_at)
+            metrics.observe("queue_transit_seconds", frame.pin, now - frame.queued_at)
+
+
 def __is_config_list(queue_msg):
     if isinstance(queue_msg, list):
         return all(isinstance(m, (int, npc.NeoPixelConfig)) for m in queue_msg)
@@ -57,13 +244,82 @@ def _update_config(renderer: NeoPixelRenderer,
         logger.error("Invalid NeoPixelConfig! %s", validation_result.reason)
 
 
-def _handle_new_frame(renderer: NeoPixelRenderer,frame: RgbFrame):
+def _update_configs(renderer: NeoPixelRenderer,
+                    logger: logging.Logger,
+                    config_list: list[npc.NeoPixelConfig]):
+    started_at = time.monotonic()
+    valid_configs = list[npc.NeoPixelConfig]()
+    for cfg in config_list:
+        logger.debug("Config %s", cfg.to_json())
+        validation_result = cfg.check_validity()
+        if validation_result.valid:
+            valid_configs.append(cfg)
+        else:
+            logger.error("Invalid NeoPixelConfig! %s", validation_result.reason)
+    renderer.update_configs(valid_configs)
+    # The first list is the saved configs, so this includes importing the hardware libraries
+    logger.info("Applied %s configs in %.1f ms",
+                len(valid_configs), (time.monotonic() - started_at) * 1000)
+
+
+def _update_virtual_strips(renderer: NeoPixelRenderer,
+                           logger: logging.Logger,
+                           virtual_strips: VirtualStrips):
+    valid_strips = list[VirtualStrip]()
+    for strip in virtual_strips.strips:
+        validation_result = strip.check_validity()
+        if validation_result.valid:
+            valid_strips.append(strip)
+        else:
+            logger.error("Invalid virtual strip! %s", validation_result.reason)
+    renderer.update_virtual_strips(valid_strips)
+
+
+def _handle_new_frame(renderer: NeoPixelRenderer, ack_queue: mp.Queue, frame: RgbFrame):
     if frame.options.clear_buffer:
-        renderer.clear_buffer(frame.pin)
+        renderer.clear_buffer(frame.pin, frame.options.layer)
 
     # If the timestamp is set to 0, render now.
     # Otherwise queue it to be rendered in the future.
     if frame.timestamp == 0:
         renderer.render_frame(frame)
+        accepted = True
     else:
-        renderer.queue_frame(frame)
+        accepted = renderer.queue_frame(frame)
+
+    if frame.stream_id != 0:
+        retry_after_ms = renderer.retry_after_ms(frame.pin) if not accepted else 0
+        ack_queue.put_nowait([FrameAck(frame.stream_id, frame.timestamp, accepted, retry_after_ms)])
+
+
+def _handle_frame_batch(renderer: NeoPixelRenderer, ack_queue: mp.Queue, batch: FrameBatch):
+    frames_to_queue = list[RgbFrame]()
+    frames_to_render = list[RgbFrame]()
+    for frame in batch.frames:
+        if frame.options.clear_buffer:
+            renderer.clear_buffer(frame.pin, frame.options.layer)
+            frames_to_queue = [
+                f for f in frames_to_queue
+                if (f.pin, f.options.layer) != (frame.pin, frame.options.layer)
+            ]
+        if frame.timestamp == 0:
+            frames_to_render.append(frame)
+        else:
+            frames_to_queue.append(frame)
+    # The batch's immediate frames are shown together, one show() per pin
+    renderer.render_now(frames_to_render)
+
+    # Frames superseded by a later clear in the same batch count as accepted
+    rejected = {
+        id(frame)
+        for frame, accepted in zip(frames_to_queue, renderer.queue_frames(frames_to_queue))
+        if not accepted
+    }
+    acks = [
+        FrameAck(frame.stream_id, frame.timestamp, id(frame) not in rejected,
+                 renderer.retry_after_ms(frame.pin) if id(frame) in rejected else 0)
+        for frame in batch.frames
+        if frame.stream_id != 0
+    ]
+    if acks:
+        ack_queue.put_nowait(acks)
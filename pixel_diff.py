@@ -0,0 +1,33 @@
+"""
+Pixel diffing. Finds which LEDs changed between two frames of packed RGB data.
+"""
+
+from typing import Optional, Union
+
+# LEDs compared per slice, comparing slices runs at memcmp speed
+CHUNK_LEDS = 64
+
+Pixels = Union[bytes, bytearray, memoryview]
+
+
+def changed_led_span(old: Pixels, new: Pixels) -> Optional[tuple[int, int]]:
+    """
+    The [start, end) range of LEDs which differ between old and new, or None if they match.
+    Both must be the same length. Each end is found a chunk at a time, then narrowed
+    to the exact LED.
+    """
+    length = len(new)
+    if old == new:
+        return None
+    chunk = CHUNK_LEDS * 3
+    start = 0
+    while old[start:start + chunk] == new[start:start + chunk]:
+        start += chunk
+    while old[start:start + 3] == new[start:start + 3]:
+        start += 3
+    end = length
+    while end - chunk > start and old[end - chunk:end] == new[end - chunk:end]:
+        end -= chunk
+    while old[end - 3:end] == new[end - 3:end]:
+        end -= 3
+    return start // 3, end // 3
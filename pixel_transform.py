@@ -0,0 +1,80 @@
+"""
+The pixel transform. Applies a pin's color correction, brightness and color order to a whole
+frame buffer at once with bytes.translate lookup tables, or with NumPy for large buffers
+when it is installed.
+"""
+
+import functools
+from typing import Union
+
+from color_correction import CHANNELS, ColorCorrection
+
+# pylint: disable=too-few-public-methods
+
+Pixels = Union[bytes, bytearray, memoryview]
+
+# Below this many LEDs bytes.translate is as fast as NumPy, whose per call overhead dominates
+NUMPY_MIN_LEDS = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def optional_numpy():
+    """
+    The numpy module, or None if it isn't installed. NumPy is optional, every use of it has
+    a fallback needing nothing outside the standard library. It is imported on first use
+    rather than when the NeoPixel process starts.
+    """
+    try:
+        import numpy  # pylint: disable=import-error,import-outside-toplevel
+    except ImportError:
+        return None
+    return numpy
+
+
+def channel_table(gamma: float, scale: float) -> bytes:
+    """The 256 entry lookup table mapping a channel value through gamma, then scale."""
+    return bytes(
+        min(255, int(round(((value / 255) ** gamma) * scale * 255))) for value in range(256)
+    )
+
+
+class PixelTransform:
+    """
+    Maps packed RGB pixels to the bytes the LEDs expect. Built once per config, applying
+    it is a table lookup per byte.
+    """
+
+    # True if applying the transform returns the pixels unchanged
+    identity: bool
+
+    def __init__(self, correction: ColorCorrection, brightness: int):
+        # Brightness is 0-100, applied here so the strip library can leave it at 1.0
+        tables = [
+            channel_table(correction.gamma, gain * brightness / 100) for gain in correction.gain
+        ]
+        # The source channel and lookup table of each output byte of an LED
+        self._order = [CHANNELS.index(channel) for channel in correction.color_order]
+        self._tables = [tables[source] for source in self._order]
+        identity_table = bytes(range(256))
+        self.identity = self._order == [0, 1, 2] and all(t == identity_table for t in tables)
+        # Built on the first frame large enough to use NumPy
+        self._np_tables = None
+
+    def apply(self, pixels: Pixels) -> bytes:
+        """The transformed copy of pixels, which must hold whole LEDs."""
+        if self.identity:
+            return bytes(pixels)
+        numpy = optional_numpy() if len(pixels) >= NUMPY_MIN_LEDS * 3 else None
+        if numpy is not None:
+            if self._np_tables is None:
+                self._np_tables = [numpy.frombuffer(t, numpy.uint8) for t in self._tables]
+            rgb = numpy.frombuffer(pixels, numpy.uint8).reshape(-1, 3)
+            out = numpy.empty(rgb.shape, numpy.uint8)
+            for channel, (index, table) in enumerate(zip(self._order, self._np_tables)):
+                out[:, channel] = table.take(rgb[:, index])
+            return out.tobytes()
+        source = bytes(pixels)
+        out = bytearray(len(source))
+        for channel, (index, table) in enumerate(zip(self._order, self._tables)):
+            out[channel::3] = source[index::3].translate(table)
+        return bytes(out)
@@ -0,0 +1,36 @@
+"""
+The render channels. The queues and shared memory connecting the other processes
+to the NeoPixel process.
+"""
+
+import multiprocessing as mp
+
+from frame_clock import FrameClock
+from shared_frame_ring import SharedFrameRing
+
+# pylint: disable=too-few-public-methods
+
+
+class RenderChannels:
+    """
+    Everything the NeoPixel process communicates through. Created before the child processes
+    start, so every process inherits the same queues and rings.
+    """
+
+    # Configs, frames and requests for the NeoPixel process
+    queue: mp.Queue
+    # Lists of FrameAcks for the WebSocket process
+    ack_queue: mp.Queue
+    # Replies to MetricsRequests
+    metrics_queue: mp.Queue
+    # Shared memory frame rings by pin
+    frame_rings: dict[str, SharedFrameRing]
+    # The epoch clock frames are rendered by and time sync replies are stamped with
+    clock: FrameClock
+
+    def __init__(self):
+        self.queue = mp.Queue()
+        self.ack_queue = mp.Queue()
+        self.metrics_queue = mp.Queue()
+        self.frame_rings = dict[str, SharedFrameRing]()
+        self.clock = FrameClock()
@@ -0,0 +1,140 @@
+"""
+The render metrics. Counters, gauges and histograms collected per pin in the NeoPixel process,
+cheap enough to leave on while streaming, and exported as JSON or Prometheus text.
+"""
+
+import bisect
+import threading
+
+# pylint: disable=too-few-public-methods
+
+# Histogram bucket upper bounds in seconds
+DURATION_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                    0.05, 0.1, 0.25)
+# Lateness can be negative when a frame is rendered early
+LATENESS_BUCKETS = (-0.001, 0.0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+HISTOGRAM_BUCKETS = {
+    "decode_seconds": DURATION_BUCKETS,
+    "queue_transit_seconds": DURATION_BUCKETS,
+    "lateness_seconds": LATENESS_BUCKETS,
+    "show_seconds": DURATION_BUCKETS,
+}
+
+HELP = {
+    "decode_seconds": "Time to decode a frame message in the WebSocket process",
+    "queue_transit_seconds": "Time from queueing a frame to the NeoPixel process receiving it",
+    "lateness_seconds": "Time a frame was shown after its timestamp",
+    "show_seconds": "Duration of show() calls",
+    "buffered_frames": "Frames buffered for rendering",
+    "rendered_frames_total": "Frames shown",
+    "unchanged_frames_total": "Frames skipped because no pixel changed",
+    "dropped_frames_total": "Buffered frames dropped as later than the lateness policy allows",
+    "skipped_frames_total": "Due frames skipped to catch up to the newest due frame",
+    "interpolated_frames_total": "Frames blended between buffered frames and shown",
+    "rejected_frames_total": "Frames rejected because the buffer was full",
+    "evicted_frames_total": "Buffered frames evicted to make room for newer frames",
+    "queued_frames_total": "Single frames sent over the queue instead of shared memory",
+}
+
+METRIC_PREFIX = "cc_"
+
+
+class Histogram:
+    """Counts observations into fixed buckets."""
+
+    bounds: tuple[float, ...]
+    counts: list[int]
+    total: float
+    count: int
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        # The last bucket is everything above the largest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Adds one observation."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        """The bucket counts (not cumulative), sum and count."""
+        return {
+            "buckets": dict(zip([str(b) for b in self.bounds] + ["+Inf"], self.counts)),
+            "sum": self.total,
+            "count": self.count,
+        }
+
+
+class RenderMetrics:
+    """Thread safe metrics by name and pin. Render workers of every pin share one instance."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = dict[str, dict[str, Histogram]]()
+        self._counters = dict[str, dict[str, int]]()
+        self._gauges = dict[str, dict[str, float]]()
+
+    def observe(self, name: str, pin: str, value: float):
+        """Adds an observation to one of the HISTOGRAM_BUCKETS histograms."""
+        with self._lock:
+            by_pin = self._histograms.setdefault(name, {})
+            histogram = by_pin.get(pin)
+            if histogram is None:
+                histogram = by_pin[pin] = Histogram(HISTOGRAM_BUCKETS[name])
+            histogram.observe(value)
+
+    def increment(self, name: str, pin: str, amount: int = 1):
+        """Adds to a counter."""
+        with self._lock:
+            by_pin = self._counters.setdefault(name, {})
+            by_pin[pin] = by_pin.get(pin, 0) + amount
+
+    def set_gauge(self, name: str, pin: str, value: float):
+        """Sets a gauge."""
+        with self._lock:
+            self._gauges.setdefault(name, {})[pin] = value
+
+    def snapshot(self) -> dict:
+        """A JSON serializable copy of every metric."""
+        with self._lock:
+            return {
+                "histograms": {
+                    name: {pin: h.to_dict() for pin, h in by_pin.items()}
+                    for name, by_pin in self._histograms.items()
+                },
+                "counters": {name: dict(by_pin) for name, by_pin in self._counters.items()},
+                "gauges": {name: dict(by_pin) for name, by_pin in self._gauges.items()},
+            }
+
+
+def to_prometheus(snapshot: dict) -> str:
+    """Formats a RenderMetrics snapshot in the Prometheus text exposition format."""
+    lines = list[str]()
+    for kind, metric_type in (("counters", "counter"), ("gauges", "gauge")):
+        for name, by_pin in snapshot[kind].items():
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {metric_type}")
+            for pin, value in by_pin.items():
+                lines.append(f'{METRIC_PREFIX}{name}{{pin="{pin}"}} {value}')
+    for name, by_pin in snapshot["histograms"].items():
+        lines.append(f"# HELP {METRIC_PREFIX}{name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+        for pin, histogram in by_pin.items():
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append(
+                    f'{METRIC_PREFIX}{name}_bucket{{pin="{pin}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{METRIC_PREFIX}{name}_sum{{pin="{pin}"}} {histogram["sum"]}')
+            lines.append(f'{METRIC_PREFIX}{name}_count{{pin="{pin}"}} {histogram["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequest:
+    """Asks the NeoPixel process to put a metrics snapshot on the metrics queue."""
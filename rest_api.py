@@ -0,0 +1,153 @@
+"""
+The config REST API. Imported by main() only after the other processes have started, so
+none of them pay for importing Flask.
+"""
+
+import threading
+from queue import Empty
+from typing import Optional
+
+from flask import Flask, Response, jsonify, request
+
+import neopixel_config as np_config
+import virtual_strip
+from neopixel_config_repository import NeoPixelConfigRepository
+from render_channels import RenderChannels
+from render_metrics import MetricsRequest, to_prometheus
+from validation_result import ValidationResult
+
+
+def create_app(name: str, channels: RenderChannels, cfg_repository: NeoPixelConfigRepository):
+    """The Flask app serving the REST API, which hands config changes to channels."""
+    app = Flask(name)
+    # Serializes /metrics requests, so each gets its own reply from the NeoPixel process
+    metrics_lock = threading.Lock()
+
+    @app.route("/time", methods=["GET"])
+    def current_time():
+        """Endpoint to get the current time of the clock frames are rendered by.
+        For millisecond accurate sync use the UDP time sync service instead."""
+        return jsonify({"millisSinceEpoch": channels.clock.now_millis()})
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Endpoint to get the render pipeline metrics in Prometheus text format, or JSON"""
+        with metrics_lock:
+            # Discard the reply to an earlier request which timed out
+            try:
+                while True:
+                    channels.metrics_queue.get_nowait()
+            except Empty:
+                pass
+            channels.queue.put_nowait(MetricsRequest())
+            try:
+                snapshot = channels.metrics_queue.get(timeout=1)
+            except Empty:
+                return (jsonify({"error": "NeoPixel process did not respond"}), 503)
+        if request.args.get("format") == "json":
+            return jsonify(snapshot)
+        return Response(to_prometheus(snapshot), mimetype="text/plain; version=0.0.4")
+
+    _add_config_routes(app, channels, cfg_repository)
+    _add_segment_routes(app, channels, cfg_repository)
+    return app
+
+
+def _add_config_routes(app: Flask, channels: RenderChannels,
+                       cfg_repository: NeoPixelConfigRepository):
+    @app.route("/configuration", methods=["GET", "PATCH", "POST", "DELETE"])
+    def configuration():
+        """Endpoint to get, update, create, or delete NeoPixel configs"""
+        if request.method == "GET":
+            return handle_get()
+        if request.method == "PATCH":
+            return handle_patch()
+        if request.method == "POST":
+            return handle_post()
+        if request.method == "DELETE":
+            uuid = request.args.get("uuid")
+            if uuid is not None:
+                return handle_delete(uuid)
+            return (jsonify({"error": "No uuid url parameter specified"}), 400)
+        return (jsonify({"error": "Unsupported method " + request.method}), 400)
+
+    def handle_get():
+        config_list = cfg_repository.get_configs()
+        jsonified_config_list = "["
+        i = 0
+        while i < len(config_list):
+            jsonified_config_list += config_list[i].to_json()
+            if i < len(config_list) - 1:
+                jsonified_config_list += ","
+            i += 1
+        jsonified_config_list += "]"
+        return Response('{"configList": ' + jsonified_config_list + "}",
+                        mimetype="application/json")
+
+    def handle_patch():
+        if request.is_json:
+            updated_config, result = _parse_config(request.get_json())
+            if result.valid:
+                if cfg_repository.get_config(updated_config.uuid) is not None:
+                    cfg_repository.update_config(updated_config)
+                    channels.queue.put_nowait(updated_config)
+                    return Response(status=201)
+                return (jsonify({"error": "No config found with uuid " + updated_config.uuid}),
+                        400)
+            return (jsonify({"error": "Error parsing config JSON " + result.reason}), 400)
+        return (jsonify({"error": "Request must be JSON"}), 400)
+
+    def handle_post():
+        if request.is_json:
+            config, result = _parse_config(request.get_json())
+            if result.valid:
+                cfg_repository.save_config(config)
+                channels.queue.put_nowait(config)
+                return Response(status=201)
+            return (jsonify({"error": "Error parsing config JSON " + result.reason}), 400)
+        return (jsonify({"error": "Request must be JSON"}), 400)
+
+    def handle_delete(uuid):
+        cfg_repository.delete_config(uuid)
+        # Update the queue consumers of the config change
+        config_list = cfg_repository.get_configs()
+        channels.queue.put_nowait(config_list)
+        return Response(status=201)
+
+
+def _parse_config(json_dict) -> tuple[Optional[np_config.NeoPixelConfig], ValidationResult]:
+    # The config and whether it is valid, which json of the wrong shape never is
+    try:
+        config = np_config.from_json(json_dict)
+    except ValueError as e:
+        return None, ValidationResult(False, str(e))
+    return config, config.check_validity()
+
+
+def _add_segment_routes(app: Flask, channels: RenderChannels,
+                        cfg_repository: NeoPixelConfigRepository):
+    @app.route("/segments", methods=["GET", "PUT", "DELETE"])
+    def segments():
+        """Endpoint to get, create or replace, or delete virtual strips"""
+        if request.method == "GET":
+            strips = [strip.to_dict() for strip in cfg_repository.get_virtual_strips()]
+            return jsonify({"virtualStrips": strips})
+        if request.method == "PUT":
+            json_dict = request.get_json() if request.is_json else None
+            if not isinstance(json_dict, dict):
+                return (jsonify({"error": "Request must be a JSON object"}), 400)
+            strip = virtual_strip.from_json(json_dict)
+            result = strip.check_validity()
+            if not result.valid:
+                return (jsonify({"error": "Error parsing virtual strip JSON " + result.reason}),
+                        400)
+            cfg_repository.save_virtual_strip(strip)
+        elif request.method == "DELETE":
+            strip_id = request.args.get("id")
+            if strip_id is None:
+                return (jsonify({"error": "No id url parameter specified"}), 400)
+            cfg_repository.delete_virtual_strip(strip_id)
+        # Update the queue consumers of the change
+        strips = cfg_repository.get_virtual_strips()
+        channels.queue.put_nowait(virtual_strip.VirtualStrips(strips))
+        return Response(status=201)
@@ -2,35 +2,118 @@
 The RGB frame. Contains color data and rendering options.
 """
 
-# pylint: disable=too-few-public-methods
+import struct
+from typing import Optional, Union
+
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+# Options byte, 4 byte ASCII pin name, 8 byte little endian timestamp
+FRAME_HEADER = struct.Struct("<B4sQ")
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+
+# Bit 0 of the options byte clears the pin's buffer, bits 3 to 5 are the layer
+CLEAR_BUFFER_BIT = 0x01
+LAYER_SHIFT = 3
+MAX_LAYER = 0x07
+# The most LEDs a frame or LED strip can have, as sparse and fill payloads count them in a uint16
+MAX_LEDS = 0xFFFF
+
 
 class RgbFrameOptions:
     """The options object for RGB frames."""
 
     clear_buffer: bool
+    # The layer of the pin the frame draws, 0 for the base layer and 1 up for overlays
+    layer: int
 
-    def __init__(self, clear_buffer: bool):
+    def __init__(self, clear_buffer: bool, layer: int = 0):
         self.clear_buffer = clear_buffer
+        self.layer = layer
+
+    def to_byte(self) -> int:
+        """The options byte with these options' bits set."""
+        return (CLEAR_BUFFER_BIT if self.clear_buffer else 0) | self.layer << LAYER_SHIFT
+
+
+def options_from_byte(options_byte: int) -> RgbFrameOptions:
+    """The rendering options of an options byte. Its encoding and batch bits are ignored."""
+    return RgbFrameOptions(bool(options_byte & CLEAR_BUFFER_BIT),
+                           options_byte >> LAYER_SHIFT & MAX_LAYER)
+
+
+def layer_key(pin: str, layer: int) -> str:
+    """The name a layer of a pin is tracked by, which for the base layer is the pin itself."""
+    return pin if layer == 0 else pin + "/" + str(layer)
 
 
 class RgbFrame:
     """
-    The RGB frame. Includes a LED strip, render options, a timestamp, 
+    The RGB frame. Includes a LED strip, render options, a timestamp,
     and the RGB values to be displayed.
+    The RGB values are stored as packed bytes, three per LED.
     """
     pin: str
     timestamp: int
     options: RgbFrameOptions
-    rgb_data: list[tuple[int, int, int]]
+    pixels: Union[bytes, bytearray, memoryview]
+    # The WebSocket connection which sent this frame, 0 if it doesn't need acknowledging
+    stream_id: int
+    # time.monotonic() when the WebSocket process received and queued the frame, 0 if unknown
+    received_at: float
+    queued_at: float
 
     def __init__(
         self,
         pin: str,
         timestamp: int,
         options: RgbFrameOptions,
-        rgb_data: list[tuple[int, int, int]],
+        pixels: Union[bytes, bytearray, memoryview],
+        stream_id: int = 0,
     ):
         self.pin = pin
         self.timestamp = timestamp
         self.options = options
-        self.rgb_data = rgb_data
+        self.pixels = pixels
+        self.stream_id = stream_id
+        self.received_at = 0.0
+        self.queued_at = 0.0
+        self._rgb_data: Optional[list[tuple[int, int, int]]] = None
+
+    @property
+    def led_count(self) -> int:
+        """The number of LEDs this frame has color data for."""
+        return len(self.pixels) // 3
+
+    @property
+    def rgb_data(self) -> list[tuple[int, int, int]]:
+        """The RGB values as a list of tuples. Built on first access."""
+        if self._rgb_data is None:
+            pixels = self.pixels
+            self._rgb_data = list(zip(pixels[0::3], pixels[1::3], pixels[2::3]))
+        return self._rgb_data
+
+    def __getstate__(self):
+        # memoryviews can't be pickled, and the tuple list is only a cache
+        state = self.__dict__.copy()
+        state["pixels"] = bytes(self.pixels)
+        state["_rgb_data"] = None
+        return state
+
+
+def parse_frame_header(message: bytes) -> tuple[int, str, int]:
+    """Parses the options byte, pin and timestamp of a binary frame message."""
+    if len(message) < FRAME_HEADER_SIZE:
+        raise ValueError(f"Frame message is {len(message)} bytes, header is {FRAME_HEADER_SIZE}")
+    options_byte, pin_bytes, timestamp = FRAME_HEADER.unpack_from(message)
+    # The GPIO pin the LED strip is connected to
+    pin = pin_bytes.decode("ascii").strip()
+    return options_byte, pin, timestamp
+
+
+class FrameBatch:
+    """Frames sent to the NeoPixel process together, buffered in one pass."""
+
+    frames: list[RgbFrame]
+
+    def __init__(self, frames: list[RgbFrame]):
+        self.frames = frames
@@ -0,0 +1,129 @@
+"""
+The shared memory frame ring. Moves pixel data from the WebSocket process to the
+NeoPixel process without pickling it. Only a small SharedFrameRef goes over the queue.
+"""
+
+import struct
+import threading
+from multiprocessing import shared_memory
+from typing import Optional
+
+from rgb_frame import RgbFrame, options_from_byte
+
+# pylint: disable=too-few-public-methods
+
+# Sequence number of the next slot to write, sequence number of the next slot to read
+RING_HEADER = struct.Struct("<QQ")
+# Sequence number, timestamp, options byte, pixel data length
+SLOT_HEADER = struct.Struct("<QQBxxxI")
+
+
+class SharedFrameRef:
+    """Points the consumer at a frame written to a shared memory ring."""
+
+    pin: str
+    seq: int
+    stream_id: int
+    # Copied from the frame, so it can be acknowledged even if the slot is lost
+    timestamp: int
+    # Copied from the frame for metrics
+    received_at: float
+    queued_at: float
+
+    def __init__(self, pin: str, seq: int, stream_id: int, timestamp: int = 0):
+        self.pin = pin
+        self.seq = seq
+        self.stream_id = stream_id
+        self.timestamp = timestamp
+        self.received_at = 0.0
+        self.queued_at = 0.0
+
+
+class SharedFrameRing:
+    """
+    A fixed-slot ring buffer of frames for one pin. Written by the WebSocket process,
+    read by the NeoPixel process. Slots are sized for the configured number of LEDs.
+    """
+
+    pin: str
+    leds: int
+    slots: int
+    slot_size: int
+
+    def __init__(self, pin: str, leds: int, slots: int, shm: shared_memory.SharedMemory):
+        self.pin = pin
+        self.leds = leds
+        self.slots = slots
+        self.slot_size = SLOT_HEADER.size + leds * 3
+        self._shm = shm
+        # Serializes writers, the WebSocket server runs one thread per connection
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, pin: str, leds: int, slots: int) -> "SharedFrameRing":
+        """Allocates a new zeroed ring in shared memory."""
+        size = RING_HEADER.size + slots * (SLOT_HEADER.size + leds * 3)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        RING_HEADER.pack_into(shm.buf, 0, 0, 0)
+        return cls(pin, leds, slots, shm)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_write_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._write_lock = threading.Lock()
+
+    def write(self, frame: RgbFrame) -> Optional[SharedFrameRef]:
+        """
+        Copies the frame into the next free slot.
+        Returns None if the frame doesn't fit or every slot is still waiting to be read.
+        """
+        length = len(frame.pixels)
+        if length > self.leds * 3:
+            return None
+        buf = self._shm.buf
+        with self._write_lock:
+            write_seq, read_seq = RING_HEADER.unpack_from(buf, 0)
+            if write_seq - read_seq >= self.slots:
+                return None
+            offset = self.__slot_offset(write_seq)
+            SLOT_HEADER.pack_into(
+                buf, offset, write_seq, frame.timestamp, frame.options.to_byte(), length
+            )
+            start = offset + SLOT_HEADER.size
+            buf[start:start + length] = frame.pixels
+            # Publish the slot only once it is fully written
+            struct.pack_into("<Q", buf, 0, write_seq + 1)
+        ref = SharedFrameRef(self.pin, write_seq, frame.stream_id, frame.timestamp)
+        ref.received_at = frame.received_at
+        ref.queued_at = frame.queued_at
+        return ref
+
+    def read(self, ref: SharedFrameRef) -> Optional[RgbFrame]:
+        """Copies a frame out of its slot and frees the slot. Returns None if it was lost."""
+        seq = ref.seq
+        buf = self._shm.buf
+        offset = self.__slot_offset(seq)
+        slot_seq, timestamp, options_byte, length = SLOT_HEADER.unpack_from(buf, offset)
+        frame = None
+        if slot_seq == seq:
+            start = offset + SLOT_HEADER.size
+            pixels = bytes(buf[start:start + length])
+            frame = RgbFrame(self.pin, timestamp, options_from_byte(options_byte), pixels,
+                             ref.stream_id)
+            frame.received_at = ref.received_at
+            frame.queued_at = ref.queued_at
+        struct.pack_into("<Q", buf, 8, seq + 1)
+        return frame
+
+    def close(self, unlink: bool = False):
+        """Detaches from the shared memory. The owning process should also unlink it."""
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+    def __slot_offset(self, seq: int) -> int:
+        return RING_HEADER.size + (seq % self.slots) * self.slot_size
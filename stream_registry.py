@@ -0,0 +1,72 @@
+"""
+The stream registry. Tracks the open WebSocket streams, which pins they own,
+where to deliver their frame acknowledgements, and which are paused by backpressure.
+"""
+
+import itertools
+import threading
+import time
+from typing import Callable
+
+from frame_ack import MAX_RETRY_AFTER_MS, FrameAck
+
+
+class StreamRegistry:
+    """
+    Thread safe registry of WebSocket streams. A stream owns every pin it has sent a frame
+    for until it closes, so two controllers can't interleave frames on one strip.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._deliver = dict[int, Callable[[list[FrameAck]], None]]()
+        self._pin_owners = dict[str, int]()
+        # time.monotonic() until which each stream's messages should not be read
+        self._paused_until = dict[int, float]()
+
+    def open(self, deliver: Callable[[list[FrameAck]], None]) -> int:
+        """Registers a stream. deliver is called with the stream's acks. Returns the stream id."""
+        with self._lock:
+            stream_id = next(self._ids)
+            self._deliver[stream_id] = deliver
+        return stream_id
+
+    def close(self, stream_id: int):
+        """Unregisters a stream and releases its pins."""
+        with self._lock:
+            self._deliver.pop(stream_id, None)
+            self._paused_until.pop(stream_id, None)
+            for pin in [p for p, owner in self._pin_owners.items() if owner == stream_id]:
+                del self._pin_owners[pin]
+
+    def claim_pin(self, stream_id: int, pin: str) -> bool:
+        """Gives the stream the pin unless another open stream owns it."""
+        with self._lock:
+            owner = self._pin_owners.setdefault(pin, stream_id)
+        return owner == stream_id
+
+    def deliver(self, acks: list[FrameAck]):
+        """Hands each open stream its acks, keeping their order."""
+        acks_by_stream = dict[int, list[FrameAck]]()
+        for ack in acks:
+            acks_by_stream.setdefault(ack.stream_id, []).append(ack)
+        for stream_id, stream_acks in acks_by_stream.items():
+            retry_after_ms = min(max(ack.retry_after_ms for ack in stream_acks),
+                                 MAX_RETRY_AFTER_MS)
+            with self._lock:
+                deliver = self._deliver.get(stream_id)
+                if retry_after_ms and deliver is not None:
+                    self._paused_until[stream_id] = time.monotonic() + retry_after_ms / 1000
+            if deliver is not None:
+                deliver(stream_acks)
+
+    def paused_for(self, stream_id: int) -> float:
+        """
+        Seconds to stop reading the stream's messages for, because a pin applying backpressure
+        rejected its frames. Not reading lets the sender's TCP window fill, which slows it down
+        even if it ignores its acks. At most MAX_RETRY_AFTER_MS, so the connection stays alive.
+        """
+        with self._lock:
+            paused_until = self._paused_until.pop(stream_id, 0.0)
+        return max(0.0, paused_until - time.monotonic())
@@ -0,0 +1,139 @@
+"""
+The LED strip backends. The renderer draws to anything with the Strip interface: NeoPixels
+on a Raspberry Pi, or a simulated strip for running the render path without hardware.
+"""
+
+import itertools
+import multiprocessing as mp
+import time
+from typing import Any, Callable, Optional, Protocol
+
+from neopixel_config import NeoPixelConfig
+
+# pylint: disable=too-few-public-methods
+
+
+class Strip(Protocol):
+    """The subset of the neopixel.NeoPixel API the renderer uses."""
+
+    n: int
+    brightness: float
+
+    def __setitem__(self, index: Any, value: Any):
+        ...
+
+    def show(self):
+        """Sends the pixel data to the LEDs."""
+
+    def deinit(self):
+        """Frees the GPIO pin."""
+
+
+StripFactory = Callable[[NeoPixelConfig], Strip]
+
+
+def neopixel_strip(config: NeoPixelConfig) -> Strip:
+    """Creates a NeoPixel strip on the configured board pin."""
+    # Imported here so only a process which drives the LEDs loads the hardware libraries
+    # pylint: disable=import-outside-toplevel,import-error
+    import board
+    from neopixel import RGB, NeoPixel
+
+    # For Raspberry Pis pin D10 is recommended as the Neopixel data pin
+    # because it can be configured for use without sudo
+    # Add dtparam=spi=on and enable_uart=1 to /boot/firmware/config.txt
+    board_pins = {"D10": board.D10, "D12": board.D12, "D18": board.D18, "D21": board.D21}
+    # The renderer's PixelTransform applies brightness and color order to whole frames, so
+    # the library passes bytes through as given and skips its per pixel brightness scaling
+    return NeoPixel(board_pins.get(config.pin), config.leds, brightness=1.0,
+                    auto_write=False, pixel_order=RGB)
+
+
+class ShowEvent:
+    """Reported by a simulated strip each time it is shown."""
+
+    pin: str
+    # The color of the first LED, which benchmarks use to tag frames
+    head: bytes
+    # Epoch milliseconds when show() was called
+    shown_at: float
+    # Milliseconds show() took
+    duration: float
+
+    def __init__(self, pin: str, head: bytes, shown_at: float, duration: float):
+        self.pin = pin
+        self.head = head
+        self.shown_at = shown_at
+        self.duration = duration
+
+
+class SimulatedStrip:
+    """
+    An in-memory strip. Writes cost write_cost_us per LED of CPU time, and show() blocks
+    as long as clocking the data out to WS2812 LEDs would.
+    """
+
+    n: int
+    brightness: float
+    pin: str
+    buf: bytearray
+    shows: int
+
+    def __init__(self, config: NeoPixelConfig, timing: "SimulatedStripFactory"):
+        self.n = config.leds
+        self.brightness = 1.0
+        self.pin = config.pin
+        self.buf = bytearray(config.leds * 3)
+        self.shows = 0
+        self._timing = timing
+        self._show_duration = (config.leds * timing.show_us_per_led + timing.reset_us) / 1_000_000
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(self.n)
+            self.buf[start * 3:stop * 3] = bytes(itertools.chain.from_iterable(value))
+            written = stop - start
+        else:
+            self.buf[index * 3:index * 3 + 3] = bytes(value)
+            written = 1
+        _spin(written * self._timing.write_cost_us / 1_000_000)
+
+    def show(self):
+        """Blocks for the time it would take to send the data to the LEDs."""
+        shown_at = time.time()
+        time.sleep(self._show_duration)
+        self.shows += 1
+        if self._timing.show_events is not None:
+            duration = (time.time() - shown_at) * 1000
+            self._timing.show_events.put_nowait(
+                ShowEvent(self.pin, bytes(self.buf[:3]), shown_at * 1000, duration)
+            )
+
+    def deinit(self):
+        """Nothing to free."""
+
+
+class SimulatedStripFactory:
+    """Creates SimulatedStrips. A class rather than a closure so it can be sent to a process."""
+
+    def __init__(self,
+                 write_cost_us: float = 0.0,
+                 show_us_per_led: float = 30.0,
+                 reset_us: float = 50.0,
+                 show_events: Optional[mp.Queue] = None):
+        self.write_cost_us = write_cost_us
+        self.show_us_per_led = show_us_per_led
+        self.reset_us = reset_us
+        self.show_events = show_events
+
+    def __call__(self, config: NeoPixelConfig) -> SimulatedStrip:
+        return SimulatedStrip(config, self)
+
+
+def _spin(seconds: float):
+    # Busy wait, a sleep would give up the CPU which bit-banging doesn't
+    if seconds <= 0:
+        return
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
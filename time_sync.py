@@ -0,0 +1,101 @@
+"""
+The time sync service. An NTP style exchange over UDP which lets a controller estimate the
+offset between its clock and the epoch clock frames are rendered by, to well under the
+latency of an HTTP request to /time.
+
+The client sends its transmit time t1, the server replies with t1, its receive time t2 and
+its transmit time t3, and the client notes its receive time t4. All in microseconds since the
+epoch. Then
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    delay = (t4 - t1) - (t3 - t2)
+and the sample with the least delay of several gives the best offset estimate.
+"""
+
+import socket
+import struct
+import time
+from logging import Logger
+from typing import Optional
+
+from frame_clock import FrameClock
+
+# pylint: disable=too-few-public-methods
+
+TIME_SYNC_PORT = 8008
+TIME_SYNC_MAGIC = b"CCTS"
+# Magic, t1
+SYNC_REQUEST = struct.Struct("<4sQ")
+# Magic, t1, t2, t3
+SYNC_REPLY = struct.Struct("<4sQQQ")
+
+
+class SyncSample:
+    """One time exchange, in microseconds."""
+
+    # Add to the client's clock to get the server's
+    offset: float
+    # Round trip time excluding the time the server held the request
+    delay: int
+
+    def __init__(self, t1: int, t2: int, t3: int, t4: int):
+        self.offset = ((t2 - t1) + (t3 - t4)) / 2
+        self.delay = (t4 - t1) - (t3 - t2)
+
+
+def sync_reply(request: bytes, received_at: int, clock: FrameClock) -> Optional[bytes]:
+    """The reply to a time sync request received at received_at, or None if it isn't one."""
+    if len(request) != SYNC_REQUEST.size:
+        return None
+    magic, client_sent_at = SYNC_REQUEST.unpack(request)
+    if magic != TIME_SYNC_MAGIC:
+        return None
+    return SYNC_REPLY.pack(TIME_SYNC_MAGIC, client_sent_at, received_at, clock.now_micros())
+
+
+def serve_time_sync(clock: FrameClock, logger: Logger, port: int = TIME_SYNC_PORT):
+    """Answers time sync requests until the process is killed."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.bind(("0.0.0.0", port))
+    logger.info("Serving time sync on UDP port %s", port)
+    while True:
+        request, addr = sock.recvfrom(64)
+        # Stamped before anything else, any work before t3 is excluded from the delay
+        received_at = clock.now_micros()
+        reply = sync_reply(request, received_at, clock)
+        if reply is not None:
+            sock.sendto(reply, addr)
+
+
+def measure_offset(host: str,
+                   port: int = TIME_SYNC_PORT,
+                   samples: int = 8,
+                   timeout: float = 0.5) -> Optional[SyncSample]:
+    """
+    Exchanges samples requests with a time sync server and returns the one with the least
+    delay, or None if none was answered. The client side, for controllers and tests.
+    """
+    best: Optional[SyncSample] = None
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
+        sock.settimeout(timeout)
+        for _ in range(samples):
+            sample = _exchange(sock, (host, port))
+            if sample is not None and (best is None or sample.delay < best.delay):
+                best = sample
+    return best
+
+
+def _exchange(sock: socket.socket, address: tuple[str, int]) -> Optional[SyncSample]:
+    sent_at = time.time_ns() // 1000
+    sock.sendto(SYNC_REQUEST.pack(TIME_SYNC_MAGIC, sent_at), address)
+    try:
+        while True:
+            reply = sock.recv(64)
+            received_at = time.time_ns() // 1000
+            if len(reply) != SYNC_REPLY.size:
+                continue
+            magic, t1, t2, t3 = SYNC_REPLY.unpack(reply)
+            # Skip late replies to an earlier request which timed out
+            if magic == TIME_SYNC_MAGIC and t1 == sent_at:
+                return SyncSample(t1, t2, t3, received_at)
+    except socket.timeout:
+        return None
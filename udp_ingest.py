@@ -0,0 +1,132 @@
+"""
+The UDP frame ingest. An unacknowledged alternative to the WebSocket stream for controllers
+on lossy networks, where a late frame is worse than a dropped one: a lost datagram is never
+resent, so it can't hold up the frames behind it the way a lost TCP segment does.
+
+Each datagram is a header, then a frame or batch message exactly as sent over the WebSocket:
+    header  <4sI  magic, sequence number
+Sequence numbers count up from any value per sender, wrapping at 2^32. A datagram with a
+sequence number at or before the sender's latest is out of order or a duplicate, and is
+discarded as its frames are older than ones already handed on. A sender silent for
+SENDER_TIMEOUT_S is forgotten, so it can restart from any sequence number.
+"""
+
+import socket
+import struct
+import time
+from logging import Logger
+from typing import Callable
+
+# pylint: disable=too-few-public-methods
+
+UDP_INGEST_PORT = 8009
+UDP_FRAME_MAGIC = b"CCFR"
+# Magic, sequence number
+DATAGRAM_HEADER = struct.Struct("<4sI")
+SEQUENCE_MODULUS = 1 << 32
+SENDER_TIMEOUT_S = 2.0
+# The largest UDP payload over IPv4
+MAX_DATAGRAM_BYTES = 65507
+# Room for a burst of frames while the handler thread is busy
+RECEIVE_BUFFER_BYTES = 1024 * 1024
+
+Sender = tuple[str, int]
+
+
+def parse_datagram(datagram: bytes) -> tuple[int, memoryview]:
+    """The sequence number and frame message of a datagram. Raises ValueError if malformed."""
+    if len(datagram) < DATAGRAM_HEADER.size:
+        raise ValueError(f"Datagram is {len(datagram)} bytes, header is {DATAGRAM_HEADER.size}")
+    magic, sequence = DATAGRAM_HEADER.unpack_from(datagram)
+    if magic != UDP_FRAME_MAGIC:
+        raise ValueError("Datagram magic is " + repr(magic))
+    return sequence, memoryview(datagram)[DATAGRAM_HEADER.size:]
+
+
+class SequenceFilter:
+    """The latest sequence number of each sender, which decides the datagrams to discard."""
+
+    def __init__(self, timeout: float = SENDER_TIMEOUT_S):
+        self.timeout = timeout
+        # Latest sequence number and when it arrived, in seconds, of each sender
+        self._latest = dict[Sender, tuple[int, float]]()
+
+    def accept(self, sender: Sender, sequence: int, now: float) -> bool:
+        """True if the datagram is the sender's latest, and records it as such."""
+        latest = self._latest.get(sender)
+        if latest is not None and now - latest[1] < self.timeout:
+            # Serial number arithmetic, so the count can wrap
+            ahead = (sequence - latest[0]) % SEQUENCE_MODULUS
+            if not 0 < ahead < SEQUENCE_MODULUS // 2:
+                return False
+        self._latest[sender] = (sequence, now)
+        return True
+
+    def expire(self, now: float) -> list[Sender]:
+        """Forgets the senders silent for longer than the timeout. Returns them."""
+        expired = [s for s, (_, seen_at) in self._latest.items() if now - seen_at >= self.timeout]
+        for sender in expired:
+            del self._latest[sender]
+        return expired
+
+
+def serve_udp_ingest(handle: Callable[[Sender, memoryview], None],
+                     expired: Callable[[Sender], None],
+                     logger: Logger,
+                     port: int = UDP_INGEST_PORT):
+    """
+    Hands the frame message of each datagram which is its sender's latest to handle, until
+    the process is killed. expired is called for each sender once it has gone silent.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+    sock.bind(("0.0.0.0", port))
+    # Wakes up to forget silent senders even when nothing arrives
+    sock.settimeout(SENDER_TIMEOUT_S)
+    logger.info("Receiving UDP frames on port %s", port)
+    sequences = SequenceFilter()
+    discarded = 0
+    while True:
+        try:
+            # A new buffer per datagram, as the frames decoded from it are views into it
+            datagram, sender = sock.recvfrom(MAX_DATAGRAM_BYTES)
+        except socket.timeout:
+            datagram = None
+        now = time.monotonic()
+        for silent in sequences.expire(now):
+            expired(silent)
+        if datagram is None:
+            continue
+        try:
+            sequence, message = parse_datagram(datagram)
+        except ValueError as e:
+            logger.warning("Invalid UDP datagram from %s: %s", sender[0], str(e))
+            continue
+        if not sequences.accept(sender, sequence, now):
+            discarded += 1
+            logger.debug("UDP datagram %s from %s out of order, %s discarded so far",
+                         sequence, sender[0], discarded)
+            continue
+        handle(sender, message)
+
+
+class UdpFrameSender:
+    """
+    Sends frame messages as datagrams with consecutive sequence numbers. The client side,
+    for controllers and tests.
+    """
+
+    def __init__(self, host: str, port: int = UDP_INGEST_PORT, first_sequence: int = 0):
+        self._address = (host, port)
+        self._sequence = first_sequence % SEQUENCE_MODULUS
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+
+    def send(self, message: bytes):
+        """Sends a frame or batch message, as the WebSocket stream would."""
+        self._sock.sendto(DATAGRAM_HEADER.pack(UDP_FRAME_MAGIC, self._sequence) + message,
+                          self._address)
+        self._sequence = (self._sequence + 1) % SEQUENCE_MODULUS
+
+    def close(self):
+        """Closes the socket."""
+        self._sock.close()
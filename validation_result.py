@@ -2,6 +2,8 @@
 The validation result of a NeoPixel config.
 """
 
+from typing import Optional
+
 # pylint: disable=too-few-public-methods
 
 class ValidationResult:
@@ -13,3 +15,12 @@ class ValidationResult:
     def __init__(self, valid: bool, reason: str):
         self.valid = valid
         self.reason = reason
+
+
+def json_object(json_dict: Optional[dict], name: str) -> dict:
+    """A section of config json, empty if missing. Raises ValueError if it isn't an object."""
+    if json_dict is None:
+        return {}
+    if not isinstance(json_dict, dict):
+        raise ValueError(f"{name} must be an object")
+    return json_dict
@@ -0,0 +1,189 @@
+"""
+Virtual strips. A logical strip made of segments of the physical strips, each a range of
+LEDs on a pin, optionally reversed. Frames address a virtual strip by its id in place of a
+pin, and their pixels are scattered into the segments in order.
+"""
+
+from typing import Union
+
+from neopixel_config import PINS
+from rgb_frame import MAX_LEDS
+from validation_result import ValidationResult
+
+# pylint: disable=too-few-public-methods
+
+# Virtual strip ids fill the 4 byte pin field of the frame header
+MAX_ID_LENGTH = 4
+
+
+class Segment:
+    """A range of LEDs of the strip on one pin."""
+
+    pin: str
+    # The first LED of the range on the strip
+    offset: int
+    # The number of LEDs
+    length: int
+    # True if the first LED of the segment is the last LED of the range
+    reversed: bool
+
+    def __init__(self, pin: str, offset: int, length: int, reversed_: bool = False):
+        self.pin = pin
+        self.offset = offset
+        self.length = length
+        self.reversed = reversed_
+
+    def check_validity(self) -> ValidationResult:
+        """Validates this segment."""
+        if self.pin not in PINS:
+            return ValidationResult(False, "Segment pin must be one of " + ", ".join(PINS))
+        if not isinstance(self.offset, int) or not isinstance(self.length, int):
+            return ValidationResult(False, "Segment offset and length must be integers")
+        if self.offset < 0 or self.length < 1:
+            return ValidationResult(
+                False, "Segment offset must not be negative and length must be at least 1"
+            )
+        if self.offset + self.length > MAX_LEDS:
+            return ValidationResult(False, "Segment must end within " + str(MAX_LEDS) + " LEDs")
+        return ValidationResult(True, "")
+
+    def to_dict(self) -> dict:
+        """The JSON serializable form of this segment."""
+        return {
+            "pin": self.pin,
+            "offset": self.offset,
+            "length": self.length,
+            "reversed": self.reversed,
+        }
+
+
+class VirtualStrip:
+    """A logical strip, its pixels laid out over its segments in order."""
+
+    strip_id: str
+    segments: list[Segment]
+
+    def __init__(self, strip_id: str, segments: list[Segment]):
+        self.strip_id = strip_id
+        self.segments = segments
+
+    @property
+    def leds(self) -> int:
+        """The number of LEDs of all the segments."""
+        return sum(segment.length for segment in self.segments)
+
+    def check_validity(self) -> ValidationResult:
+        """Validates this virtual strip and its segments."""
+        if not 0 < len(self.strip_id) <= MAX_ID_LENGTH or not self.strip_id.isalnum():
+            return ValidationResult(
+                False, "Virtual strip id must be 1 to " + str(MAX_ID_LENGTH) + " letters or digits"
+            )
+        if self.strip_id in PINS:
+            return ValidationResult(False, "Virtual strip id must not be a pin")
+        if not self.segments:
+            return ValidationResult(False, "Virtual strip " + self.strip_id + " has no segments")
+        for segment in self.segments:
+            result = segment.check_validity()
+            if not result.valid:
+                return result
+        if self.leds > MAX_LEDS:
+            return ValidationResult(
+                False, "Virtual strip " + self.strip_id + " must have at most " + str(MAX_LEDS)
+                + " LEDs"
+            )
+        return ValidationResult(True, "")
+
+    def to_dict(self) -> dict:
+        """The JSON serializable form of this virtual strip."""
+        return {"id": self.strip_id, "segments": [s.to_dict() for s in self.segments]}
+
+
+def from_json(json_dict: dict) -> VirtualStrip:
+    """Deserializes a virtual strip from json."""
+    segments = json_dict.get("segments")
+    return VirtualStrip(
+        str(json_dict.get("id", "")).strip(),
+        [
+            Segment(
+                str(segment.get("pin", "")).strip(),
+                segment.get("offset", 0),
+                segment.get("length", 0),
+                bool(segment.get("reversed", False)),
+            )
+            for segment in (segments if isinstance(segments, list) else [])
+            if isinstance(segment, dict)
+        ],
+    )
+
+
+class VirtualStrips:
+    """Every virtual strip, sent to the NeoPixel process whenever one changes."""
+
+    strips: list[VirtualStrip]
+
+    def __init__(self, strips: list[VirtualStrip]):
+        self.strips = strips
+
+
+class SegmentMap:
+    """
+    The scatter tables of the virtual strips: for each, the slices of a frame which go to
+    each pin, clipped to the LEDs the pins' strips have. Built whenever the virtual strips
+    or the strips' LED counts change, so a frame is scattered with slice assignments only.
+    """
+
+    strips: dict[str, VirtualStrip]
+
+    def __init__(self, strips: list[VirtualStrip], leds_by_pin: dict[str, int]):
+        self.strips = {strip.strip_id: strip for strip in strips}
+        # Pin, destination slice and source slice of each copy
+        self._tables = dict[str, list[tuple[str, slice, slice]]]()
+        for strip in strips:
+            table = list[tuple[str, slice, slice]]()
+            source = 0
+            for segment in strip.segments:
+                length = min(segment.length, leds_by_pin.get(segment.pin, 0) - segment.offset)
+                if length > 0:
+                    # A clipped reversed segment loses its first LEDs, which were past the end
+                    first = source + segment.length - length if segment.reversed else source
+                    table.extend(_segment_copies(segment, first, length))
+                source += segment.length
+            self._tables[strip.strip_id] = table
+
+    def pins(self, strip_id: str) -> list[str]:
+        """The pins a virtual strip has LEDs on."""
+        strip = self.strips.get(strip_id)
+        return list(dict.fromkeys(s.pin for s in strip.segments)) if strip is not None else []
+
+    def scatter(self,
+                strip_id: str,
+                pixels: Union[bytes, bytearray, memoryview],
+                buffers: dict[str, bytearray]):
+        """
+        Copies a virtual strip's pixels into the buffers of its pins. Pins without a buffer
+        are skipped. Missing pixels at the end of a short frame are black.
+        """
+        strip = self.strips[strip_id]
+        frame_bytes = strip.leds * 3
+        # bytes, as strided copies out of a memoryview need a contiguous buffer
+        if not isinstance(pixels, bytes) or len(pixels) != frame_bytes:
+            pixels = bytes(pixels[:frame_bytes]).ljust(frame_bytes, b"\0")
+        for pin, destination, source in self._tables[strip_id]:
+            buffer = buffers.get(pin)
+            if buffer is not None:
+                buffer[destination] = pixels[source]
+
+
+def _segment_copies(segment: Segment, source: int, length: int) -> list[tuple[str, slice, slice]]:
+    start = segment.offset * 3
+    end = (segment.offset + length) * 3
+    if not segment.reversed:
+        return [(segment.pin, slice(start, end), slice(source * 3, (source + length) * 3))]
+    # Reversed LED order, keeping each LED's bytes in order, is one strided copy per channel
+    copies = list[tuple[str, slice, slice]]()
+    for channel in range(3):
+        last = (source + length - 1) * 3 + channel
+        before_first = source * 3 + channel - 3
+        copies.append((segment.pin, slice(start + channel, end, 3),
+                       slice(last, before_first if before_first >= 0 else None, -3)))
+    return copies